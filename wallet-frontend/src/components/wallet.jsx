@@ -9,6 +9,8 @@ const WalletHome = () => {
   const [user, setUser] = useState(null);
   const [balance, setBalance] = useState(0.0);
   const [transactions, setTransactions] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [syncToken, setSyncToken] = useState(null);
   const [loading, setLoading] = useState(true);
 
   // Shared currency for withdraw + send money
@@ -70,6 +72,8 @@ const WalletHome = () => {
         setUser(res.data);
         setBalance(parseFloat(res.data.wallet_balance) || 0.0);
         setTransactions(res.data.transactions || []);
+        setNextCursor(res.data.transactions_next_cursor || null);
+        setSyncToken(res.data.sync_token || null);
         if (res.data.wallet_currency) {
           setWalletCurrency(res.data.wallet_currency);
           setCurrencyTo(res.data.wallet_currency);
@@ -116,6 +120,8 @@ const WalletHome = () => {
           }).then((res) => {
             setBalance(parseFloat(res.data.wallet_balance) || 0.0);
             setTransactions(res.data.transactions || []);
+            setNextCursor(res.data.transactions_next_cursor || null);
+            setSyncToken(res.data.sync_token || null);
           });
         }, 2000);
       } else {
@@ -150,16 +156,61 @@ const WalletHome = () => {
     }
   };
 
+  // Merge changed rows into the list (upsert by transaction_id, newest first)
+  const mergeTransactions = (prev, changes) => {
+    const byId = new Map(prev.map((tx) => [tx.transaction_id, tx]));
+    changes.forEach((tx) => byId.set(tx.transaction_id, tx));
+    return Array.from(byId.values()).sort((a, b) => (a.timestamp < b.timestamp ? 1 : -1));
+  };
+
   const fetchTransactions = async () => {
     try {
       const token = localStorage.getItem("access_token");
-      const res = await axios.get("/user/profile/", {
+      if (!syncToken) {
+        const res = await axios.get("/user/profile/", {
+          headers: { Authorization: `Bearer ${token}` },
+        });
+        setTransactions(res.data.transactions || []);
+        setNextCursor(res.data.transactions_next_cursor || null);
+        setSyncToken(res.data.sync_token || null);
+        setBalance(parseFloat(res.data.wallet_balance) || balance);
+        return;
+      }
+
+      // Only fetch what changed since the last sync; 304 means nothing did
+      let since = syncToken;
+      let hasMore = true;
+      while (hasMore) {
+        const res = await axios.get("/wallet/sync/", {
+          headers: { Authorization: `Bearer ${token}` },
+          params: { since },
+          validateStatus: (s) => (s >= 200 && s < 300) || s === 304,
+        });
+        if (res.status === 304) break;
+        setTransactions((prev) => mergeTransactions(prev, res.data.changes || []));
+        setBalance(parseFloat(res.data.wallet_balance) || 0.0);
+        since = res.data.sync_token;
+        hasMore = res.data.has_more;
+      }
+      setSyncToken(since);
+    } catch (err) {
+      console.error("Fetch transactions error:", err);
+    }
+  };
+
+  // Load the next page of history using the cursor from the previous page
+  const loadMoreTransactions = async () => {
+    if (!nextCursor) return;
+    try {
+      const token = localStorage.getItem("access_token");
+      const res = await axios.get("/transactions/", {
         headers: { Authorization: `Bearer ${token}` },
+        params: { cursor: nextCursor },
       });
-      setTransactions(res.data.transactions || []);
-      setBalance(parseFloat(res.data.wallet_balance) || balance);
+      setTransactions((prev) => [...prev, ...(res.data.results || [])]);
+      setNextCursor(res.data.next_cursor || null);
     } catch (err) {
-      console.error("Fetch transactions error:", err);
+      console.error("Load more transactions error:", err);
     }
   };
 
@@ -212,6 +263,8 @@ const WalletHome = () => {
           currency_to: currencyTo,
           receiver_email: receiverEmail,
           pin,
+          // settle at the previewed rate while the quote is still valid
+          ...(preview?.quote_id && { quote_id: preview.quote_id }),
         },
         { headers: { Authorization: `Bearer ${token}` } }
       );
@@ -246,22 +299,24 @@ const WalletHome = () => {
 
       const token = localStorage.getItem("access_token");
 
+      // Price into the recipient's wallet currency, which is what they are credited in
       const previewRes = await axios.post(
         "/convert-preview/",
-        { amount: transferAmount, currency_to: currencyTo },
+        { amount: transferAmount, recipient: transferRecipient },
         { headers: { Authorization: `Bearer ${token}` } }
       );
 
       const previewData = {
         converted_amount: previewRes.data.converted_amount,
         rate: previewRes.data.rate,
-        currency: currencyTo,
+        currency: previewRes.data.currency_to,
+        quote_id: previewRes.data.quote_id,
       };
 
       setTransferPreview(previewData);
 
       const confirmed = window.confirm(
-        `Recipient will receive ${previewData.converted_amount} ${currencyTo} (rate: ${previewData.rate}). Continue?`
+        `Recipient will receive ${previewData.converted_amount} ${previewData.currency} (rate: ${previewData.rate}). Continue?`
       );
       if (!confirmed) return;
 
@@ -270,8 +325,9 @@ const WalletHome = () => {
         {
           recipient: transferRecipient,
           amount: transferAmount,
-          currency_to: currencyTo,
           pin,
+          // settle at the rate the user just confirmed
+          ...(previewData.quote_id && { quote_id: previewData.quote_id }),
         },
         { headers: { Authorization: `Bearer ${token}` } }
       );
@@ -750,7 +806,10 @@ const handleFlutterwaveWithdraw = async () => {
           <label>Currency to send/withdraw: </label>
           <select
             value={currencyTo}
-            onChange={(e) => setCurrencyTo(e.target.value)}
+            onChange={(e) => {
+              setCurrencyTo(e.target.value);
+              setPreview(null);
+            }}
           >
             {currencies.map((c) => (
               <option key={c.code} value={c.code}>{c.code}</option>
@@ -765,7 +824,10 @@ const handleFlutterwaveWithdraw = async () => {
             type="number"
             placeholder={`Amount (${walletCurrency})`}
             value={withdrawAmount}
-            onChange={(e) => setWithdrawAmount(e.target.value)}
+            onChange={(e) => {
+              setWithdrawAmount(e.target.value);
+              setPreview(null);
+            }}
           />
           <input
             type="email"
@@ -844,7 +906,7 @@ const handleFlutterwaveWithdraw = async () => {
 
               {transferPreview && (
                 <small>
-                  Preview: {transferPreview.converted_amount} {currencyTo} (rate:{" "}
+                  Preview: {transferPreview.converted_amount} {transferPreview.currency} (rate:{" "}
                   {transferPreview.rate})
                 </small>
               )}
@@ -877,6 +939,11 @@ const handleFlutterwaveWithdraw = async () => {
             ))}
           </ul>
         )}
+        {nextCursor && (
+          <button onClick={loadMoreTransactions} style={styles.button}>
+            Load more
+          </button>
+        )}
       </div>
 
       <button onClick={handleLogout} style={styles.logout}>
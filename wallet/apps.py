@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class WalletConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'wallet'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .idempotency import install_write_tracker
+
+        # Lets @idempotent tell whether a failed request already committed anything
+        connection_created.connect(install_write_tracker, dispatch_uid='wallet_idempotency_write_tracker')
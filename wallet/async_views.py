@@ -0,0 +1,149 @@
+# wallet/async_views.py
+"""
+Async versions of the provider-backed endpoints for ASGI deployments.
+
+``initiate_stk`` and ``flutterwave_deposit`` in ``views.py`` hold a worker
+thread for the whole Safaricom/Flutterwave round trip. The views here await
+the provider through ``AsyncProviderClient`` instead, so under
+``wallet_backend/asgi.py`` one process can keep hundreds of provider calls
+in flight. Withdrawals only queue a payout (see ``payouts.py``). Database
+work still runs through ``sync_to_async`` and the shared helpers in
+``payments.py``.
+
+DRF's ``APIView`` is sync-only, so ``async_api_view`` does the parts these
+endpoints need: JWT authentication, JSON/form body parsing into
+``request.data`` and DRF-style ``{"detail": ...}`` errors. Request and
+response bodies match the sync endpoints.
+"""
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework.exceptions import APIException
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from . import flutterwave, ledger, mpesa, payments, payouts
+from .idempotency import async_idempotent
+from .ledger import InsufficientFunds
+from .utils import mpesa_msisdn, normalize_msisdn
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_body(request):
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}")
+    return request.POST
+
+
+def async_api_view(view_func):
+    """Authenticate the JWT, parse the body and require a logged-in user."""
+    @csrf_exempt
+    @require_POST
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            auth = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except APIException as e:
+            return JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+        if auth is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+        request.user, request.auth = auth
+
+        try:
+            request.data = _parse_body(request)
+        except ValueError as e:
+            return JsonResponse({"detail": f"JSON parse error - {e}"}, status=400)
+        return await view_func(request, *args, **kwargs)
+
+    return wrapper
+
+
+# ---------------- M-PESA STK PUSH ----------------
+@async_api_view
+@async_idempotent
+async def initiate_stk(request):
+    phone = request.data.get("phone")
+    amount = request.data.get("amount")
+
+    if not phone or not amount:
+        return JsonResponse({"error": "Phone and amount required"}, status=400)
+
+    phone = normalize_msisdn(phone)
+    if not phone:
+        return JsonResponse({"error": "Invalid phone number"}, status=400)
+
+    res = await mpesa.astk_push(mpesa_msisdn(phone), amount)
+    logger.info("STK push result: %s", res)
+
+    if isinstance(res, dict) and res.get("error"):
+        return JsonResponse(res, status=500)
+
+    await sync_to_async(payments.record_stk_push)(request.user, phone, amount, res)
+    return JsonResponse(res)
+
+
+# ---------------- M-PESA WITHDRAWAL ----------------
+@async_api_view
+@async_idempotent
+async def withdraw_from_wallet(request):
+    pin = request.data.get("pin")
+    if not pin:
+        return JsonResponse({"error": "PIN required for withdrawal"}, status=400)
+
+    if not await sync_to_async(request.user.check_pin)(pin):
+        return JsonResponse({"error": "Invalid PIN"}, status=401)
+
+    phone = normalize_msisdn(request.data.get("phone"))
+    if not phone:
+        return JsonResponse({"error": "Invalid phone number"}, status=400)
+
+    try:
+        amount = Decimal(str(request.data.get("amount")))
+    except InvalidOperation:
+        return JsonResponse({"error": "Invalid amount format"}, status=400)
+    if not amount.is_finite() or amount <= 0:
+        return JsonResponse({"error": "Amount must be a positive number"}, status=400)
+
+    # Queued for the run_payouts worker, as in the sync view.
+    try:
+        wallet, wallet_tx = await sync_to_async(payouts.enqueue_mpesa_withdrawal)(request.user, phone, amount)
+    except InsufficientFunds:
+        return JsonResponse({"error": "Insufficient balance"}, status=400)
+    except payouts.InvalidPayout as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    return JsonResponse({
+        'reference': wallet_tx.reference,
+        'wallet_balance': str(await sync_to_async(ledger.refresh_balance)(wallet)),
+        'message': 'Withdrawal queued — awaiting provider confirmation.',
+    }, status=202)
+
+
+# ---------------- FLUTTERWAVE DEPOSIT INITIATION ----------------
+@async_api_view
+@async_idempotent
+async def flutterwave_deposit(request):
+    amount = request.data.get("amount")
+    if not amount:
+        return JsonResponse({"error": "Amount required"}, status=400)
+
+    flw = await flutterwave.ainitialize_deposit(
+        amount=amount,
+        email=request.user.email,
+        phone=request.data.get("phone"),
+        name=request.user.get_full_name(),
+    )
+
+    if flw.get("error"):
+        return JsonResponse({"error": flw["error"]}, status=502)
+    if flw.get("status") != "success" or not flw.get("data"):
+        return JsonResponse({"error": flw.get("message", "Failed to initialize payment")}, status=400)
+
+    await sync_to_async(payments.record_flutterwave_deposit)(request.user, amount, flw["tx_ref"])
+    return JsonResponse({"payment_link": flw["data"]["link"]})
@@ -0,0 +1,136 @@
+# wallet/banks.py
+"""
+Flutterwave bank directory.
+
+Only the ``refresh_banks`` command calls ``flutterwave.fetch_banks``. Each
+refresh upserts the country's banks into ``Bank`` and publishes the active
+list to the cache as a ``BankDirectory``. Requests read the cache, then the
+table, and never block on the network. This covers the ``/api/banks/<country>/``
+listing and the ``account_bank`` check in ``flutterwave_withdraw``.
+
+The directory's ``etag`` is a hash of its contents, so clients can revalidate
+with ``If-None-Match`` and get a 304 until a refresh actually changes a bank.
+"""
+import hashlib
+import json
+import logging
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from . import flutterwave, singleflight
+from .models import Bank
+
+logger = logging.getLogger(__name__)
+
+BANKS_TTL = getattr(settings, "BANKS_CACHE_TTL", 60 * 60)
+# Transfers are sent in KES (see flutterwave.transfer_request)
+DEFAULT_COUNTRY = getattr(settings, "FLW_BANK_COUNTRY", "KE")
+
+
+class BankDirectoryError(Exception):
+    """Raised when banks cannot be fetched or none are stored for a country."""
+
+
+class BankDirectoryUnavailable(BankDirectoryError):
+    """Raised when another caller's reload of the directory did not finish in time."""
+
+
+class BankDirectory:
+    """Active banks of one country, as served to clients."""
+
+    def __init__(self, country, banks, updated_at=None):
+        self.country = country
+        self.banks = sorted(banks, key=lambda b: (b["name"].lower(), b["code"]))
+        self.codes = frozenset(b["code"] for b in self.banks)
+        self.updated_at = updated_at or timezone.now()
+        encoded = json.dumps(self.banks, sort_keys=True, separators=(",", ":")).encode()
+        self.etag = hashlib.sha256(encoded).hexdigest()[:32]
+
+    def __contains__(self, code):
+        return str(code) in self.codes
+
+
+def _cache_key(country):
+    return f"bank_directory_{country}"
+
+
+def refresh_banks(country=DEFAULT_COUNTRY):
+    """Fetch ``country``'s banks, persist them and publish a new directory."""
+    country = country.upper()
+    try:
+        data = flutterwave.fetch_banks(country).get("data") or []
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise BankDirectoryError(f"Failed to fetch banks for {country}: {e}") from e
+    fetched = {
+        str(b["code"]): b for b in data
+        if isinstance(b, dict) and b.get("code") and b.get("name")
+    }
+    if not fetched:
+        # Keep serving the stored list rather than wiping it
+        raise BankDirectoryError(f"Flutterwave returned no banks for {country}")
+
+    now = timezone.now()
+    with transaction.atomic():
+        Bank.objects.bulk_create(
+            [
+                Bank(country=country, code=code, name=str(b["name"])[:150],
+                     flutterwave_id=b.get("id"), active=True, updated_at=now)
+                for code, b in fetched.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["country", "code"],
+            update_fields=["name", "flutterwave_id", "active", "updated_at"],
+        )
+        retired = Bank.objects.filter(country=country, active=True).exclude(code__in=fetched).update(
+            active=False, updated_at=now
+        )
+    if retired:
+        logger.info("Retired %d banks no longer listed for %s", retired, country)
+
+    directory = load_directory(country)
+    cache.set(_cache_key(country), directory, BANKS_TTL)
+    return directory
+
+
+def load_directory(country):
+    """Stored directory for ``country``, or None if it was never refreshed."""
+    rows = list(Bank.objects.filter(country=country, active=True).values("code", "name", "updated_at"))
+    if not rows:
+        return None
+    updated_at = max(r.pop("updated_at") for r in rows)
+    return BankDirectory(country, rows, updated_at)
+
+
+def _reload_directory(country):
+    directory = load_directory(country)
+    if directory is None:
+        raise BankDirectoryError(f"No banks stored for {country} yet; run the refresh_banks command.")
+    cache.set(_cache_key(country), directory, BANKS_TTL)
+    return directory
+
+
+def get_directory(country=DEFAULT_COUNTRY):
+    """Bank directory from the cache or database; never calls Flutterwave."""
+    country = country.upper()
+    key = _cache_key(country)
+    directory = cache.get(key)
+    if directory is None:
+        # Concurrent misses share one reload (see wallet/singleflight.py).
+        try:
+            directory = singleflight.do(key, lambda: _reload_directory(country), recheck=lambda: cache.get(key))
+        except singleflight.SingleFlightTimeout as e:
+            raise BankDirectoryUnavailable(f"Timed out loading banks for {country}") from e
+    return directory
+
+
+def is_known_bank(code, country=DEFAULT_COUNTRY):
+    """True if ``code`` is an active bank, or when no directory is available to check against."""
+    try:
+        return code in get_directory(country)
+    except BankDirectoryError as e:
+        logger.warning("%s; skipping account_bank check", e)
+        return True
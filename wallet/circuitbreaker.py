@@ -0,0 +1,77 @@
+# wallet/circuitbreaker.py
+"""
+Circuit breaker for calls to external providers.
+
+After ``threshold`` consecutive failures the breaker opens and ``allow()``
+returns False for ``reset_timeout`` seconds, so callers skip a provider that
+is timing out instead of waiting on it. Once the timeout passes the breaker
+is half-open: the first caller to ``cache.add`` the trial key gets the one
+trial call and everyone else is still refused. Success closes the breaker,
+another failure re-opens it.
+
+State lives in the cache, so the breaker is only shared by workers that share
+a cache backend. With the default per-process LocMemCache each process trips
+and trials its own breaker (set ``REDIS_URL`` to share it).
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = getattr(settings, "CIRCUIT_BREAKER_THRESHOLD", 3)
+DEFAULT_RESET_TIMEOUT = getattr(settings, "CIRCUIT_BREAKER_RESET_TIMEOUT", 60)
+
+
+class CircuitOpen(Exception):
+    """Raised by ``call`` when the breaker is open."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=DEFAULT_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.cache_key = f"circuit_{name}"
+        self.trial_key = f"circuit_{name}_trial"
+
+    def _state(self):
+        return cache.get(self.cache_key) or {"failures": 0, "open_until": 0}
+
+    def is_open(self):
+        return time.time() < self._state()["open_until"]
+
+    def allow(self):
+        open_until = self._state()["open_until"]
+        if not open_until:
+            return True
+        if time.time() < open_until:
+            return False
+        # Half-open: one trial per reset_timeout, even if its caller never reports back
+        return cache.add(self.trial_key, True, self.reset_timeout)
+
+    def record_success(self):
+        cache.delete_many([self.cache_key, self.trial_key])
+
+    def record_failure(self):
+        state = self._state()
+        state["failures"] += 1
+        if state["failures"] >= self.threshold:
+            state["open_until"] = time.time() + self.reset_timeout
+            logger.warning("Circuit %s open for %ss after %d failures", self.name, self.reset_timeout, state["failures"])
+        cache.set(self.cache_key, state, None)
+        cache.delete(self.trial_key)
+
+    def call(self, fn, *args, **kwargs):
+        """Run ``fn`` through the breaker; raises CircuitOpen without calling it while open."""
+        if not self.allow():
+            raise CircuitOpen(f"Circuit {self.name} is open")
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
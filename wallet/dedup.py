@@ -0,0 +1,103 @@
+# wallet/dedup.py
+"""
+Exactly-once application of provider callbacks.
+
+Safaricom and Flutterwave redeliver callbacks, so every event is reduced to
+identity keys built from the provider's own ids: CheckoutRequestID and
+MpesaReceiptNumber for STK callbacks, ConversationID and TransactionReceipt
+for B2C results, and event type plus ``tx_ref``/reference/transfer id for
+Flutterwave.
+
+``claim()`` inserts one ``ProcessedEvent`` row per key inside the
+transaction that applies the event. The unique index rejects a second
+application, and a rolled-back apply releases its keys. Claimed keys are also
+written to the cache after commit, so ``seen()`` can drop most redeliveries
+with one cache read, before they are even stored.
+"""
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+
+from .models import ProcessedEvent
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = getattr(settings, "PROCESSED_EVENT_CACHE_TTL", 7 * 24 * 60 * 60)
+
+
+def _cache_key(key):
+    return f"processed_event_{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+# ---------------- EVENT IDENTITY ----------------
+def _stk_keys(payload):
+    result = payload.get("Body", {}).get("stkCallback", {})
+    keys = []
+    if result.get("CheckoutRequestID"):
+        keys.append(f"mpesa_stk:{result['CheckoutRequestID']}")
+    for item in result.get("CallbackMetadata", {}).get("Item", []):
+        if isinstance(item, dict) and item.get("Name") == "MpesaReceiptNumber" and item.get("Value"):
+            keys.append(f"mpesa_receipt:{item['Value']}")
+    return keys
+
+
+def _b2c_keys(payload):
+    result = payload.get("Result", {})
+    keys = []
+    if result.get("ConversationID"):
+        keys.append(f"mpesa_b2c:{result['ConversationID']}")
+    for param in result.get("ResultParameters", {}).get("ResultParameter", []):
+        if isinstance(param, dict) and param.get("Key") == "TransactionReceipt" and param.get("Value"):
+            keys.append(f"mpesa_receipt:{param['Value']}")
+    return keys
+
+
+def _flutterwave_keys(payload):
+    data = payload.get("data", {}) or {}
+    event = str(payload.get("event") or data.get("event") or payload.get("event_type") or "").lower()
+    if not event:
+        return []
+    keys = []
+    for name in ("id", "tx_ref", "txRef", "reference"):
+        value = data.get(name) or payload.get(name)
+        if value:
+            keys.append(f"flw:{event}:{name.lower()}:{value}")
+    return keys
+
+
+KEY_BUILDERS = {
+    'MPESA_STK': _stk_keys,
+    'MPESA_B2C': _b2c_keys,
+    'FLUTTERWAVE': _flutterwave_keys,
+}
+
+
+def event_keys(source, payload):
+    """Identity keys for a raw callback; empty when the payload carries no usable id."""
+    try:
+        return KEY_BUILDERS[source](payload)
+    except (AttributeError, TypeError):
+        return []
+
+
+# ---------------- CHECKS ----------------
+def seen(keys):
+    """Cheap pre-check: True if any key is already known to be applied."""
+    return bool(keys) and bool(cache.get_many([_cache_key(k) for k in keys]))
+
+
+def claim(keys, event=None):
+    """Record ``keys`` as applied in the current transaction; False if any was already claimed."""
+    for key in keys:
+        try:
+            with transaction.atomic():
+                ProcessedEvent.objects.create(key=key, event=event)
+        except IntegrityError:
+            logger.info("Duplicate delivery rejected: %s", key)
+            return False
+    if keys:
+        transaction.on_commit(lambda: cache.set_many({_cache_key(k): True for k in keys}, CACHE_TTL))
+    return True
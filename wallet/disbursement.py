@@ -0,0 +1,170 @@
+# wallet/disbursement.py
+"""
+Bulk disbursement: one wallet paying many recipients in a single commit.
+
+Used by the ``/api/transfers/bulk/`` endpoint and the ``bulk_disburse``
+management command. Recipients are resolved with one ``IN`` query, each
+currency pair is priced once, and all balance updates, ledger postings and
+``Transaction`` rows are written inside one atomic block.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+
+from . import fx, ledger
+from .models import Wallet, Transaction
+
+User = get_user_model()
+
+MAX_LINES = getattr(settings, "BULK_TRANSFER_MAX_LINES", 1000)
+
+
+class DisbursementError(Exception):
+    """Raised when a batch as a whole cannot be processed."""
+
+
+def parse_amount(raw):
+    try:
+        amount = Decimal(str(raw)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    return amount if amount > 0 else None
+
+
+def _resolve_recipients(identifiers):
+    """Map each username/email in ``identifiers`` to its user, in one query."""
+    emails = {i for i in identifiers if "@" in i}
+    usernames = set(identifiers) - emails
+    users = (
+        User.objects.filter(Q(email__in=emails) | Q(username__in=usernames))
+        .select_related("wallet")
+    )
+    found = {}
+    for user in users:
+        found.setdefault(user.email, user)
+        found.setdefault(user.username, user)
+    return found
+
+
+def disburse(sender, lines, description="Bulk disbursement"):
+    """Pay every ``{"recipient": ..., "amount": ...}`` in ``lines`` from ``sender``'s wallet.
+
+    Returns ``(results, sender_wallet)`` where ``results`` holds one entry
+    per input line with ``status`` ``success`` or ``failed``. Lines that fail
+    validation are reported and skipped; if the remaining total is not
+    covered by the balance every line fails and nothing is written.
+    """
+    if not lines:
+        raise DisbursementError("No transfers supplied.")
+    if len(lines) > MAX_LINES:
+        raise DisbursementError(f"A batch may contain at most {MAX_LINES} transfers.")
+
+    sender_wallet, _ = Wallet.objects.get_or_create(user=sender)
+
+    results = []
+    for index, line in enumerate(lines):
+        if not isinstance(line, dict):
+            results.append({"line": index, "recipient": "", "amount": None, "status": "failed",
+                            "error": "Each transfer must be an object with recipient and amount."})
+            continue
+        results.append({
+            "line": index,
+            "recipient": str(line.get("recipient") or "").strip(),
+            "amount": parse_amount(line.get("amount")),
+            "status": "failed",
+        })
+
+    users = _resolve_recipients({r["recipient"] for r in results if r["recipient"]})
+
+    # Validate lines and price each currency pair once
+    rates = {}
+    legs = []
+    for result in results:
+        if "error" in result:
+            continue
+        user = users.get(result["recipient"])
+        if result["amount"] is None:
+            result["error"] = "Positive amount is required."
+        elif not result["recipient"]:
+            result["error"] = "recipient is required."
+        elif user is None:
+            result["error"] = "Recipient not found."
+        elif user.pk == sender.pk:
+            result["error"] = "Cannot transfer to yourself."
+        elif not hasattr(user, "wallet"):
+            result["error"] = "Recipient has no wallet."
+        else:
+            recv_wallet = user.wallet
+            pair = (sender_wallet.currency, recv_wallet.currency)
+            if pair not in rates:
+                try:
+                    rates[pair] = fx.convert(Decimal("1"), *pair)[1:]
+                except Exception as e:
+                    rates[pair] = e
+            if isinstance(rates[pair], Exception):
+                result["error"] = f"Conversion failed: {rates[pair]}"
+                continue
+            rate, fx_version = rates[pair]
+            converted = (result["amount"] * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            if converted <= 0:
+                result["error"] = f"Amount is too small to convert to {recv_wallet.currency}."
+                continue
+            result.update(
+                converted_amount=converted,
+                currency=recv_wallet.currency,
+                exchange_rate=rate,
+                _fx_version=fx_version,
+                _user=user,
+            )
+            legs.append((recv_wallet, result["amount"], converted))
+
+    valid = [r for r in results if "_user" in r]
+    if valid:
+        try:
+            with transaction.atomic():
+                ledger.disburse(sender_wallet, legs, description=description)
+
+                history = []
+                for r in valid:
+                    recv_user = r["_user"]
+                    common = dict(
+                        transaction_type="TRANSFER",
+                        currency_from=sender_wallet.currency,
+                        currency_to=r["currency"],
+                        converted_amount=r["converted_amount"],
+                        exchange_rate=r["exchange_rate"],
+                        fx_rate_version=r["_fx_version"],
+                        status="SUCCESS",
+                    )
+                    history.append(Transaction(
+                        wallet=sender_wallet,
+                        amount=r["amount"],
+                        counterparty=recv_user.email,
+                        description=f"Sent to {recv_user.email} ({description})",
+                        **common,
+                    ))
+                    history.append(Transaction(
+                        wallet=recv_user.wallet,
+                        amount=r["converted_amount"],
+                        counterparty=sender.email,
+                        description=f"Received from {sender.email} ({description})",
+                        **common,
+                    ))
+                Transaction.objects.bulk_create(history)
+        except ledger.InsufficientFunds:
+            for r in valid:
+                r["error"] = "Insufficient balance."
+        else:
+            for r in valid:
+                r["status"] = "success"
+
+    for r in results:
+        r.pop("_user", None)
+        r.pop("_fx_version", None)
+        for key in ("amount", "converted_amount", "exchange_rate"):
+            if r.get(key) is not None:
+                r[key] = str(r[key])
+    return results, sender_wallet
@@ -0,0 +1,412 @@
+# wallet/events.py
+"""
+Inbound provider callbacks: stored first, applied by workers.
+
+The M-Pesa STK callback, B2C result and Flutterwave webhook views only
+verify the request and ``record()`` the raw payload as one ``InboundEvent``
+insert before acknowledging. A callback burst is never held up by wallet
+work, so providers do not time out and redeliver.
+
+The ``process_inbound_events`` command claims PENDING events with
+``SELECT ... FOR UPDATE SKIP LOCKED`` and applies them through ``HANDLERS``.
+Any number of workers can run. A handler that raises leaves the event for
+another attempt with backoff. ``EventNotReady`` covers callbacks that arrive
+before the request they answer was recorded. After
+``INBOUND_EVENT_MAX_ATTEMPTS`` the event is marked FAILED; ``replay()``
+queues events again. Redeliveries are caught by ``dedup.py`` and end as
+DUPLICATE without touching any wallet.
+
+With ``INBOUND_EVENTS_INLINE = True`` events are applied right after the
+insert, for local development without a worker.
+"""
+import logging
+import random
+import uuid
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import dedup, ledger
+from .models import CustomUser, InboundEvent, MpesaSTKRequest, Transaction, Wallet, WalletTransaction
+from .utils import normalize_msisdn
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = getattr(settings, "INBOUND_EVENT_MAX_ATTEMPTS", 10)
+RETRY_BACKOFF = getattr(settings, "INBOUND_EVENT_RETRY_BACKOFF", 5)
+LEASE_SECONDS = getattr(settings, "INBOUND_EVENT_LEASE_SECONDS", 60)
+INLINE = getattr(settings, "INBOUND_EVENTS_INLINE", False)
+
+
+class EventNotReady(Exception):
+    """The records this event refers to do not exist yet; retry later."""
+
+
+# ---------------- QUEUE ----------------
+def record(source, payload, apply=INLINE):
+    """Store a raw callback; the only database work done before the ACK.
+
+    With ``apply`` the event is processed straight away and its final
+    ``status`` set on the returned object. Returns None without storing
+    anything for a known redelivery.
+    """
+    if dedup.seen(dedup.event_keys(source, payload)):
+        logger.info("Dropped redelivered %s callback", source)
+        return None
+    event = InboundEvent.objects.create(source=source, payload=payload)
+    if apply:
+        claimed = _claim_ids([event.pk])
+        if claimed:
+            event.status = process(claimed[0])
+    return event
+
+
+def _claim_ids(ids):
+    now = timezone.now()
+    InboundEvent.objects.filter(pk__in=ids, status='PENDING').update(
+        status='PROCESSING',
+        locked_until=now + timedelta(seconds=LEASE_SECONDS),
+        attempts=F('attempts') + 1,
+    )
+    return list(InboundEvent.objects.filter(pk__in=ids, status='PROCESSING').order_by('id'))
+
+
+def claim_due(limit):
+    """Lease up to ``limit`` due events to this worker; other workers skip them."""
+    with transaction.atomic():
+        ids = list(
+            InboundEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        return _claim_ids(ids)
+
+
+def recover_expired_leases():
+    """Requeue events whose worker died mid-apply."""
+    return InboundEvent.objects.filter(status='PROCESSING', locked_until__lt=timezone.now()).update(
+        status='PENDING', locked_until=None, last_error='Lease expired'
+    )
+
+
+def replay(ids=None, status='FAILED'):
+    """Queue events again: the given ids, or every event in ``status``."""
+    events = InboundEvent.objects.filter(pk__in=ids) if ids else InboundEvent.objects.filter(status=status)
+    return events.exclude(status='PROCESSING').update(
+        status='PENDING', attempts=0, next_attempt_at=timezone.now(), locked_until=None
+    )
+
+
+def process(event):
+    """Apply one leased event and record the outcome; returns the new status."""
+    try:
+        with transaction.atomic():
+            # The dedup keys commit or roll back with the handler's writes.
+            if not dedup.claim(dedup.event_keys(event.source, event.payload), event):
+                InboundEvent.objects.filter(pk=event.pk, status='PROCESSING').update(
+                    status='DUPLICATE', locked_until=None, processed_at=timezone.now()
+                )
+                return 'DUPLICATE'
+            HANDLERS[event.source](event.payload)
+    except Exception as e:
+        if isinstance(e, EventNotReady):
+            logger.info("%s event %s not ready: %s", event.source, event.pk, e)
+        else:
+            logger.exception("%s event %s failed", event.source, event.pk)
+        if event.attempts >= MAX_ATTEMPTS:
+            status, fields = 'FAILED', {}
+        else:
+            delay = RETRY_BACKOFF * 2 ** (event.attempts - 1) + random.uniform(0, RETRY_BACKOFF)
+            status, fields = 'PENDING', {'next_attempt_at': timezone.now() + timedelta(seconds=delay)}
+        InboundEvent.objects.filter(pk=event.pk, status='PROCESSING').update(
+            status=status, locked_until=None, last_error=str(e)[:1000], **fields
+        )
+        return status
+
+    InboundEvent.objects.filter(pk=event.pk, status='PROCESSING').update(
+        status='DONE', locked_until=None, last_error='', processed_at=timezone.now()
+    )
+    return 'DONE'
+
+
+# ---------------- M-PESA STK CALLBACK ----------------
+def _item_value(items, name=None, idx=None):
+    """Value of the CallbackMetadata item called ``name``, falling back to position ``idx``."""
+    try:
+        if name:
+            for it in items:
+                if isinstance(it, dict) and it.get("Name") == name:
+                    return it.get("Value")
+        if idx is not None and idx < len(items):
+            it = items[idx]
+            return it.get("Value") if isinstance(it, dict) else None
+    except Exception:
+        return None
+    return None
+
+
+def _upsert_deposit_history(user, reference, amount, status, description):
+    wallet_obj, _ = Wallet.objects.get_or_create(user=user)
+    t = Transaction.objects.filter(provider='MPESA', provider_reference=reference).first()
+    if t:
+        t.status = status
+        t.amount = amount
+        t.converted_amount = amount
+        t.save()
+    else:
+        Transaction.objects.create(
+            wallet=wallet_obj,
+            transaction_type='DEPOSIT',
+            amount=amount,
+            currency_from='KES',
+            currency_to=getattr(wallet_obj, 'currency', 'KES'),
+            converted_amount=amount,
+            status=status,
+            provider='MPESA',
+            provider_reference=reference,
+            description=description,
+        )
+
+
+def apply_stk_callback(data):
+    result = data.get("Body", {}).get("stkCallback", {})
+    result_code = result.get("ResultCode")
+    reference = result.get("CheckoutRequestID") or result.get("MerchantRequestID")
+
+    # Callback metadata may be missing in failure cases
+    callback_meta = result.get("CallbackMetadata", {}).get("Item", [])
+    amount = (
+        _item_value(callback_meta, name="Amount") or
+        _item_value(callback_meta, name="TransAmount") or
+        _item_value(callback_meta, name="amount") or
+        _item_value(callback_meta, idx=0)
+    )
+    phone = normalize_msisdn(_item_value(callback_meta, name="PhoneNumber", idx=4))
+    mpesa_receipt = _item_value(callback_meta, name="MpesaReceiptNumber", idx=1)
+    if not reference:
+        reference = mpesa_receipt
+
+    try:
+        amount_val = Decimal(str(amount)) if amount is not None else None
+    except InvalidOperation:
+        amount_val = None
+
+    # ---------- PRIMARY MATCH: WalletTransaction ----------
+    user = None
+    tx_by_ref = None
+    if reference:
+        tx_by_ref = WalletTransaction.objects.select_for_update().filter(reference=reference).first()
+        if tx_by_ref and tx_by_ref.status != "pending":
+            # Only the pending -> final transition moves money.
+            logger.info("STK callback for %s already applied (status=%s)", reference, tx_by_ref.status)
+            return
+        if tx_by_ref:
+            user = tx_by_ref.user
+            if tx_by_ref.amount is not None:
+                amount_val = tx_by_ref.amount
+            logger.info("Found pending WalletTransaction by reference %s -> user=%s amount=%s", reference, user, amount_val)
+
+    # ---------- SECOND MATCH: MpesaSTKRequest ----------
+    if not user and reference:
+        stk = MpesaSTKRequest.objects.select_related('user').filter(checkout_request_id=reference).first()
+        if stk:
+            user = stk.user
+
+    # ---------- THIRD MATCH: phone number ----------
+    if not user and phone:
+        user = CustomUser.objects.filter(mobile_e164=phone).first()
+        if user:
+            logger.info("Matched user by mobile %s -> %s", phone, user)
+
+    if not user:
+        # initiate_stk may not have stored the request yet
+        raise EventNotReady(f"No user matched STK callback {reference}")
+
+    # ---------- SUCCESS ----------
+    if result_code == 0 and amount_val is not None:
+        wallet, _ = Wallet.objects.get_or_create(user=user)
+        ledger.credit(wallet, amount_val, ledger.MPESA_ACCOUNT, f'M-Pesa deposit {reference}')
+
+        if tx_by_ref:
+            tx_by_ref.status = 'success'
+            tx_by_ref.phone = phone or tx_by_ref.phone
+            tx_by_ref.save()
+        else:
+            WalletTransaction.objects.create(
+                user=user,
+                phone=phone,
+                amount=amount_val,
+                type="deposit",
+                status="success",
+                reference=reference or str(uuid.uuid4()),
+            )
+        _upsert_deposit_history(user, reference, amount_val, 'SUCCESS',
+                                f'M-Pesa deposit reference {reference} receipt {mpesa_receipt or "n/a"}')
+        logger.info("Credited %s to %s for STK %s", amount_val, user, reference)
+        return
+
+    # ---------- FAILURE ----------
+    amount_val = amount_val or Decimal('0.00')
+    if tx_by_ref:
+        tx_by_ref.status = 'failed'
+        tx_by_ref.phone = phone or tx_by_ref.phone
+        tx_by_ref.save()
+    else:
+        WalletTransaction.objects.create(
+            user=user,
+            phone=phone,
+            amount=amount_val,
+            type="deposit",
+            status="failed",
+            reference=reference or mpesa_receipt or f"none-{random.randint(100000, 999999)}",
+        )
+    _upsert_deposit_history(user, reference, amount_val, 'FAILED',
+                            f'Failed M-Pesa deposit reference {reference} receipt {mpesa_receipt or "n/a"}')
+
+
+# ---------------- M-PESA B2C RESULT ----------------
+def apply_b2c_result(data):
+    result_obj = data.get("Result", {})
+    result_code = result_obj.get("ResultCode")
+    params_list = result_obj.get("ResultParameters", {}).get("ResultParameter", [])
+    params = {p.get("Key"): p.get("Value") for p in params_list if isinstance(p, dict)}
+
+    # ConversationID/OriginatorConversationID come back exactly as returned
+    # by the payment request, so each result maps to one withdrawal.
+    conversation_id = result_obj.get("ConversationID")
+    originator_id = result_obj.get("OriginatorConversationID")
+
+    tx = None
+    if conversation_id:
+        tx = WalletTransaction.objects.select_for_update().filter(conversation_id=conversation_id).first()
+    if not tx and originator_id:
+        tx = WalletTransaction.objects.select_for_update().filter(originator_conversation_id=originator_id).first()
+
+    if not tx:
+        # The payout worker may not have stored the conversation ids yet
+        raise EventNotReady(f"No withdrawal for ConversationID={conversation_id} "
+                            f"OriginatorConversationID={originator_id}")
+
+    if tx.status != "pending":
+        logger.info("B2C result for %s already applied (status=%s)", tx.reference, tx.status)
+        return
+
+    if result_code == 0:
+        tx.status = "success"
+    else:
+        tx.status = "failed"
+        ledger.credit(Wallet.objects.get(user=tx.user), tx.amount, ledger.MPESA_ACCOUNT,
+                      f'M-Pesa withdrawal {tx.reference} failed')
+    tx.save()
+    Transaction.objects.filter(provider='MPESA', provider_reference=tx.reference).update(
+        status='SUCCESS' if result_code == 0 else 'FAILED',
+        updated_at=timezone.now(),
+    )
+    logger.info("B2C result %s for %s: receipt=%s", result_code, tx.reference, params.get("TransactionReceipt"))
+
+
+# ---------------- FLUTTERWAVE WEBHOOK ----------------
+def _apply_flutterwave_transfer(data, tx_data, event, status):
+    reference = tx_data.get("reference") or data.get("reference")
+    if not reference:
+        logger.warning("Transfer webhook without reference: %s", data)
+        return
+
+    tx = WalletTransaction.objects.select_for_update().filter(reference=reference, status="pending").first()
+    if not tx:
+        logger.warning("No pending WalletTransaction found for reference: %s", reference)
+        return
+
+    wallet = Wallet.objects.get(user=tx.user)
+    ev = str(event).lower()
+    if ev in ("transfer.completed", "transfer.successful") or status in ("successful", "success", "completed"):
+        tx.status = "success"
+        tx.save()
+        # The amount was reserved at initiation; only the history row is completed here
+        Transaction.objects.update_or_create(
+            provider="FLUTTERWAVE",
+            provider_reference=reference,
+            defaults={"status": "SUCCESS"},
+            create_defaults=dict(
+                wallet=wallet,
+                transaction_type="WITHDRAWAL",
+                amount=Decimal(tx.amount),
+                description=f"Flutterwave withdrawal: {reference}",
+                counterparty=tx.phone or None,
+                currency_from=wallet.currency,
+                currency_to=wallet.currency,
+                exchange_rate=Decimal("1.00"),
+                status="SUCCESS",
+            ),
+        )
+    elif ev in ("transfer.failed", "transfer.reversed") or status in ("failed", "error", "reversed"):
+        tx.status = "failed"
+        tx.save()
+        ledger.credit(wallet, tx.amount, ledger.FLUTTERWAVE_ACCOUNT, f'Flutterwave withdrawal {reference} {ev}')
+        Transaction.objects.filter(provider="FLUTTERWAVE", provider_reference=reference).update(
+            status="FAILED", updated_at=timezone.now()
+        )
+    logger.info("Flutterwave withdrawal webhook processed: reference=%s event=%s", reference, event)
+
+
+def apply_flutterwave_webhook(data):
+    tx_data = data.get("data", {})
+    status = (tx_data.get("status") or data.get("status") or "").lower()
+    event = data.get("event") or tx_data.get("event") or data.get("event_type")
+
+    if event and str(event).lower().startswith("transfer"):
+        _apply_flutterwave_transfer(data, tx_data, event, status)
+        return
+
+    # Payment/deposit webhook
+    tx_ref = tx_data.get("tx_ref") or tx_data.get("txRef") or data.get("tx_ref") or data.get("txRef")
+    if not tx_ref:
+        logger.warning("Webhook received without tx_ref: %s", data)
+        return
+
+    tx = WalletTransaction.objects.select_for_update().filter(reference=tx_ref, status="pending").first()
+    if not tx:
+        logger.warning("No matching WalletTransaction found for tx_ref: %s", tx_ref)
+        return
+
+    if status not in ("successful", "success", "completed"):
+        tx.status = "failed"
+        tx.save()
+        return
+
+    amount = tx_data.get("amount") or data.get("amount")
+    currency = tx_data.get("currency") or tx_data.get("currency_code")
+    customer_email = tx_data.get("customer", {}).get("email") or data.get("customer", {}).get("email")
+
+    tx.status = "success"
+    tx.save()
+    wallet = Wallet.objects.get(user=tx.user)
+    ledger.credit(wallet, amount, ledger.FLUTTERWAVE_ACCOUNT, f'Flutterwave deposit {tx_ref}')
+    Transaction.objects.get_or_create(
+        provider="FLUTTERWAVE",
+        provider_reference=tx_ref,
+        defaults=dict(
+            wallet=wallet,
+            transaction_type="DEPOSIT",
+            amount=Decimal(str(amount)),
+            description=f"Flutterwave deposit: {tx_ref}",
+            counterparty=customer_email,
+            currency_from=currency,
+            currency_to=wallet.currency,
+            exchange_rate=Decimal('1.00'),
+            status="SUCCESS",
+        ),
+    )
+    logger.info("Flutterwave webhook processed: tx_ref=%s, status=%s", tx_ref, status)
+
+
+HANDLERS = {
+    'MPESA_STK': apply_stk_callback,
+    'MPESA_B2C': apply_b2c_result,
+    'FLUTTERWAVE': apply_flutterwave_webhook,
+}
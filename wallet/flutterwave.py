@@ -1,12 +1,19 @@
 # wallet/flutterwave.py
 import os
 import uuid
+
+import httpx
 import requests
 from django.conf import settings
 
+from .http_client import AsyncProviderClient, ProviderClient
+
 FLW_SECRET = os.getenv("FLW_SECRET_KEY", settings.FLW_SECRET_KEY)
 FLW_BASE = "https://api.flutterwave.com/v3"
 
+client = ProviderClient("flutterwave", FLW_BASE)
+aclient = AsyncProviderClient("flutterwave", FLW_BASE)
+
 HEADERS = {
     "Authorization": f"Bearer {FLW_SECRET}",
     "Content-Type": "application/json"
@@ -15,10 +22,8 @@ HEADERS = {
 # ------------------------------------------------------------
 # 1. Initialize Deposit (Card / Mpesa)
 # ------------------------------------------------------------
-def initialize_deposit(amount, email, phone, name="", tx_ref=None, redirect_url=None):
-    tx_ref = tx_ref or str(uuid.uuid4())
-
-    payload = {
+def _deposit_payload(amount, email, phone, name, tx_ref, redirect_url):
+    return {
         "tx_ref": tx_ref,
         "amount": str(amount),
         "currency": "KES",
@@ -32,11 +37,15 @@ def initialize_deposit(amount, email, phone, name="", tx_ref=None, redirect_url=
         "customizations": {"title": "Wallet Deposit"}
     }
 
-    resp = requests.post(
-        f"{FLW_BASE}/payments",
+
+def initialize_deposit(amount, email, phone, name="", tx_ref=None, redirect_url=None):
+    tx_ref = tx_ref or str(uuid.uuid4())
+    payload = _deposit_payload(amount, email, phone, name, tx_ref, redirect_url)
+
+    resp = client.post(
+        "/payments",
         json=payload,
-        headers=HEADERS,
-        timeout=30
+        headers=HEADERS
     )
     resp.raise_for_status()
 
@@ -50,6 +59,25 @@ def flutterwave_initialize_deposit(amount, email, phone, name="", tx_ref=None, r
     return initialize_deposit(amount, email, phone, name=name, tx_ref=tx_ref, redirect_url=redirect_url)
 
 
+async def ainitialize_deposit(amount, email, phone, name="", tx_ref=None, redirect_url=None):
+    """Async ``initialize_deposit`` for the ASGI views; returns {"error": ...} if the call fails."""
+    tx_ref = tx_ref or str(uuid.uuid4())
+    payload = _deposit_payload(amount, email, phone, name, tx_ref, redirect_url)
+
+    try:
+        resp = await aclient.post(
+            "/payments",
+            json=payload,
+            headers=HEADERS
+        )
+        resp.raise_for_status()
+        data = resp.json()
+    except (httpx.HTTPError, ValueError) as e:
+        return {"error": f"Flutterwave request failed: {e}"}
+    data["tx_ref"] = tx_ref
+    return data
+
+
 # ------------------------------------------------------------
 # 2. Initiate Withdrawal (Bank or Mpesa)
 # ------------------------------------------------------------
@@ -66,11 +94,10 @@ def initiate_withdrawal(amount, account_bank, account_number, narration="Wallet
         "debit_currency": "KES"
     }
 
-    resp = requests.post(
-        f"{FLW_BASE}/transfers",
+    resp = client.post(
+        "/transfers",
         json=payload,
-        headers=HEADERS,
-        timeout=30
+        headers=HEADERS
     )
     try:
         resp.raise_for_status()
@@ -97,11 +124,10 @@ def create_beneficiary(account_bank, account_number, account_name="Recipient"):
         "currency": "KES",
     }
 
-    resp = requests.post(
-        f"{FLW_BASE}/beneficiaries",
+    resp = client.post(
+        "/beneficiaries",
         json=payload,
-        headers=HEADERS,
-        timeout=30
+        headers=HEADERS
     )
     resp.raise_for_status()
     return resp.json()
@@ -131,11 +157,10 @@ def initiate_transfer(beneficiary_code=None, amount=None, account_bank=None, acc
             # debit_currency optional
         })
 
-    resp = requests.post(
-        f"{FLW_BASE}/transfers",
+    resp = client.post(
+        "/transfers",
         json=payload,
-        headers=HEADERS,
-        timeout=30
+        headers=HEADERS
     )
     try:
         resp.raise_for_status()
@@ -154,27 +179,57 @@ def initiate_transfer(beneficiary_code=None, amount=None, account_bank=None, acc
     return data
 
 
+def transfer_request(amount, account_bank, account_number, reference, narration="Wallet Withdrawal"):
+    """POST a bank transfer and return the raw response.
+
+    Flutterwave rejects a second transfer with the same ``reference``, which
+    is what makes resending a payout safe.
+    """
+    payload = {
+        "account_bank": str(account_bank),
+        "account_number": str(account_number),
+        "amount": str(amount),
+        "currency": "KES",
+        "narration": narration,
+        "reference": reference,
+        "debit_currency": "KES"
+    }
+    return client.post("/transfers", json=payload, headers=HEADERS)
+
+
 # ------------------------------------------------------------
 # 3. Verify Withdrawal
 # ------------------------------------------------------------
 def verify_withdrawal(transfer_id):
-    resp = requests.get(
-        f"{FLW_BASE}/transfers/{transfer_id}",
-        headers=HEADERS,
-        timeout=30
+    resp = client.get(
+        f"/transfers/{transfer_id}",
+        headers=HEADERS
     )
     resp.raise_for_status()
     return resp.json()
 
 
+def find_transfer(reference):
+    """Return the transfer Flutterwave holds under ``reference``, or None if there is none."""
+    resp = client.get(
+        "/transfers",
+        params={"reference": reference},
+        headers=HEADERS
+    )
+    resp.raise_for_status()
+    for transfer in resp.json().get("data") or []:
+        if transfer.get("reference") == reference:
+            return transfer
+    return None
+
+
 # ------------------------------------------------------------
 # 4. Fetch Banks by Country
 # ------------------------------------------------------------
 def fetch_banks(country_code="KE"):
-    resp = requests.get(
-        f"{FLW_BASE}/banks/{country_code}",
-        headers=HEADERS,
-        timeout=30
+    resp = client.get(
+        f"/banks/{country_code}",
+        headers=HEADERS
     )
     resp.raise_for_status()
     return resp.json()
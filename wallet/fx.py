@@ -0,0 +1,236 @@
+# wallet/fx.py
+"""
+Exchange-rate table.
+
+One upstream call fetches the rate of every supported currency against
+``FX_BASE_CURRENCY``; any cross rate is then derived locally as
+``rate(base -> to) / rate(base -> from)``.
+
+Only the ``refresh_fx_rates`` command talks to the providers (see
+``wallet/fx_providers.py`` for the failover chain). Each refresh is
+stored as a new ``FxRate`` version and written to the cache; requests read
+the cache, then the latest version in the database, and never block on the
+network. The database is what readers actually depend on: with the default
+per-process LocMemCache the command's cache write never reaches the web
+workers, and each worker reloads the latest version from ``FxRate`` once per
+``FX_RATES_TTL`` (set ``REDIS_URL`` for a shared cache). Until the first
+refresh has run, and whenever the table is older than ``FX_MAX_STALENESS``,
+conversions fail with ``RatesUnavailable``.
+
+``issue_quote`` locks a priced conversion for ``FX_QUOTE_TTL`` so a transfer
+can settle at exactly the previewed rate without pricing inside its
+database transaction.
+"""
+import logging
+from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import singleflight
+from .fx_providers import FxProviderError, get_provider_chain
+from .models import CURRENCY_CHOICES, FxQuote, FxRate
+
+logger = logging.getLogger(__name__)
+
+FX_BASE_CURRENCY = getattr(settings, "FX_BASE_CURRENCY", "USD")
+FX_RATES_TTL = getattr(settings, "FX_RATES_TTL", 60)
+FX_MAX_STALENESS = timedelta(seconds=getattr(settings, "FX_MAX_STALENESS_SECONDS", 3600))
+FX_RATE_HISTORY = timedelta(days=getattr(settings, "FX_RATE_HISTORY_DAYS", 30))
+FX_QUOTE_TTL = timedelta(seconds=getattr(settings, "FX_QUOTE_TTL_SECONDS", 60))
+
+RATE_TABLE_CACHE_KEY = "fx_rate_table"
+CENTS = Decimal("0.01")
+# Matches Transaction.exchange_rate, so the stored rate reproduces converted_amount
+RATE_QUANTUM = Decimal("0.00000001")
+
+
+class FxError(Exception):
+    """Raised when rates cannot be fetched or a currency is not in the table."""
+
+
+class RatesUnavailable(FxError):
+    """Raised when no rate table has been stored yet or the latest one is too old to use."""
+
+
+class QuoteError(FxError):
+    """Raised when a quote is unknown, expired, already used or does not match the transfer."""
+
+
+class RateTable:
+    """Rates of every supported currency against one base currency."""
+
+    def __init__(self, base, rates, fetched_at=None, version=None, provider=""):
+        self.base = base
+        self.rates = dict(rates)
+        self.rates[base] = Decimal("1")
+        self.fetched_at = fetched_at or timezone.now()
+        self.version = version
+        self.provider = provider
+
+    def is_stale(self):
+        return timezone.now() - self.fetched_at > FX_MAX_STALENESS
+
+    def rate(self, from_currency, to_currency):
+        """Units of ``to_currency`` per one unit of ``from_currency``."""
+        if from_currency == to_currency:
+            return Decimal("1")
+        try:
+            rate = self.rates[to_currency] / self.rates[from_currency]
+        except KeyError as e:
+            raise FxError(f"No exchange rate for {e.args[0]}") from e
+        return rate.quantize(RATE_QUANTUM, rounding=ROUND_HALF_UP)
+
+    def convert(self, amount, from_currency, to_currency):
+        """Return ``(converted_amount, rate)`` with the amount rounded to cents."""
+        rate = self.rate(from_currency, to_currency)
+        return (Decimal(amount) * rate).quantize(CENTS, rounding=ROUND_HALF_UP), rate
+
+
+def fetch_rate_table(base=FX_BASE_CURRENCY):
+    """Fetch every supported currency against ``base`` in a single upstream call."""
+    codes = [code for code, _ in CURRENCY_CHOICES if code != base]
+    try:
+        provider, rates = get_provider_chain().fetch(base, codes)
+    except FxProviderError as e:
+        raise FxError(str(e)) from e
+
+    missing = [code for code in codes if code not in rates]
+    if missing:
+        logger.warning("FX provider %s returned no rate for %s", provider, ", ".join(missing))
+    logger.info("Fetched %d exchange rates against %s from %s", len(rates), base, provider)
+    return RateTable(base, rates, provider=provider)
+
+
+def store_rate_table(table):
+    """Persist ``table`` as a new FxRate version and publish it to the cache."""
+    with transaction.atomic():
+        latest = FxRate.objects.aggregate(v=Max("version"))["v"] or 0
+        table.version = latest + 1
+        FxRate.objects.bulk_create([
+            FxRate(version=table.version, base=table.base, currency=code, rate=rate,
+                   provider=table.provider, fetched_at=table.fetched_at)
+            for code, rate in table.rates.items() if code != table.base
+        ])
+    cache.set(RATE_TABLE_CACHE_KEY, table, FX_RATES_TTL)
+    return table
+
+
+def refresh_rates():
+    """Fetch, persist and cache a new rate table; prune history past ``FX_RATE_HISTORY``."""
+    table = store_rate_table(fetch_rate_table())
+    FxRate.objects.filter(fetched_at__lt=timezone.now() - FX_RATE_HISTORY).delete()
+    return table
+
+
+def load_rate_table():
+    """Latest stored rate table, or None if no refresh has run yet."""
+    latest = FxRate.objects.order_by("-version").values_list("version", flat=True).first()
+    if latest is None:
+        return None
+    rows = list(FxRate.objects.filter(version=latest))
+    return RateTable(rows[0].base, {r.currency: r.rate for r in rows}, rows[0].fetched_at, latest, rows[0].provider)
+
+
+def _cached_rate_table():
+    table = cache.get(RATE_TABLE_CACHE_KEY)
+    return None if table is None or table.is_stale() else table
+
+
+def _reload_rate_table():
+    table = load_rate_table()
+    if table is None:
+        raise RatesUnavailable("Exchange rates are not loaded yet; run the refresh_fx_rates command.")
+    cache.set(RATE_TABLE_CACHE_KEY, table, FX_RATES_TTL)
+    return table
+
+
+def get_rate_table():
+    """Last known rate table from the cache or database; never calls the provider."""
+    table = _cached_rate_table()
+    if table is None:
+        # Concurrent misses share one reload (see wallet/singleflight.py).
+        try:
+            table = singleflight.do(RATE_TABLE_CACHE_KEY, _reload_rate_table, recheck=_cached_rate_table)
+        except singleflight.SingleFlightTimeout as e:
+            raise RatesUnavailable("Timed out loading exchange rates; try again shortly.") from e
+    if table.is_stale():
+        raise RatesUnavailable(f"Exchange rates are stale (last refreshed {table.fetched_at.isoformat()}).")
+    return table
+
+
+def convert(amount, from_currency, to_currency):
+    """Return ``(converted_amount, rate, version)``; version is None when no conversion is needed."""
+    amount = Decimal(str(amount))
+    if from_currency == to_currency:
+        return amount.quantize(CENTS, rounding=ROUND_HALF_UP), Decimal("1"), None
+    table = get_rate_table()
+    converted, rate = table.convert(amount, from_currency, to_currency)
+    return converted, rate, table.version
+
+
+def convert_many(amount, from_currency, targets):
+    """
+    Price ``amount`` into every currency in ``targets`` from one rate table.
+    Returns ``{target: (converted_amount, rate) or FxError}``; nothing is locked.
+    """
+    amount = Decimal(str(amount)).quantize(CENTS, rounding=ROUND_HALF_UP)
+    table = None
+    results = {}
+    for target in targets:
+        if target == from_currency:
+            results[target] = (amount, Decimal("1"))
+            continue
+        table = table or get_rate_table()
+        try:
+            results[target] = table.convert(amount, from_currency, target)
+        except FxError as e:
+            results[target] = e
+    return results
+
+
+# ---------------- Quotes ----------------
+def issue_quote(user, amount, from_currency, to_currency):
+    """Price ``amount`` now and lock the result for ``FX_QUOTE_TTL``."""
+    amount = Decimal(str(amount)).quantize(CENTS, rounding=ROUND_HALF_UP)
+    converted, rate, version = convert(amount, from_currency, to_currency)
+    return FxQuote.objects.create(
+        user=user,
+        amount=amount,
+        currency_from=from_currency,
+        currency_to=to_currency,
+        converted_amount=converted,
+        rate=rate,
+        fx_rate_version=version,
+        expires_at=timezone.now() + FX_QUOTE_TTL,
+    )
+
+
+def get_quote(quote_id, user, amount, from_currency, to_currency):
+    """Return the caller's unused, unexpired quote matching this amount and currency pair."""
+    try:
+        quote = FxQuote.objects.get(quote_id=quote_id, user=user)
+    except (FxQuote.DoesNotExist, ValueError, ValidationError):
+        raise QuoteError("Quote not found.")
+    if quote.consumed_at is not None:
+        raise QuoteError("Quote has already been used.")
+    if quote.expires_at <= timezone.now():
+        raise QuoteError("Quote has expired; request a new preview.")
+    if (quote.amount, quote.currency_from, quote.currency_to) != (
+            Decimal(str(amount)).quantize(CENTS, rounding=ROUND_HALF_UP), from_currency, to_currency):
+        raise QuoteError("Quote does not match this transfer.")
+    return quote
+
+
+def consume_quote(quote):
+    """Mark ``quote`` used; call inside the transfer's atomic block so a rollback releases it."""
+    now = timezone.now()
+    used = FxQuote.objects.filter(pk=quote.pk, consumed_at__isnull=True, expires_at__gt=now).update(consumed_at=now)
+    if not used:
+        raise QuoteError("Quote has expired or was already used.")
+    quote.consumed_at = now
@@ -0,0 +1,162 @@
+# wallet/fx_providers.py
+"""
+Exchange-rate providers.
+
+Each ``FxProvider`` returns ``{currency: Decimal}`` rates against a base
+currency. ``ProviderChain`` tries providers in ``FX_PROVIDERS`` order, each
+behind its own circuit breaker, and returns the first success, so a
+degraded primary costs at most a few timeouts before it is skipped.
+
+Available providers:
+
+* ``exchangerate_host`` - api.exchangerate.host ``/live`` (needs ``EXCHANGE_API_KEY``)
+* ``open_er_api``       - open.er-api.com ``/v6/latest`` (no key)
+* ``file``              - JSON file at ``FX_RATES_FILE`` (tests, benchmarks, offline dev;
+                          see ``wallet/testdata/fx_rates.json``)
+"""
+import abc
+import json
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+
+import requests
+from django.conf import settings
+
+from .circuitbreaker import CircuitBreaker
+from .http_client import ProviderClient
+
+logger = logging.getLogger(__name__)
+
+FX_TIMEOUT = getattr(settings, "FX_TIMEOUT", 5)
+
+# Failover to the next provider replaces retries here.
+client = ProviderClient("fx", timeout=FX_TIMEOUT, retries=0)
+
+
+class FxProviderError(Exception):
+    """Raised when a provider cannot return rates."""
+
+
+def _decimal_rates(raw):
+    rates = {}
+    for code, value in raw.items():
+        try:
+            rate = Decimal(str(value))
+        except InvalidOperation:
+            continue
+        if rate > 0:
+            rates[code.upper()] = rate
+    return rates
+
+
+class FxProvider(abc.ABC):
+    name = None
+
+    @abc.abstractmethod
+    def fetch(self, base, currencies):
+        """Return ``{currency: rate}`` for one unit of ``base``."""
+
+    def _get_json(self, url, params=None):
+        try:
+            resp = client.get(url, params=params)
+            resp.raise_for_status()
+            return resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise FxProviderError(f"{self.name}: {e}") from e
+
+
+class ExchangeRateHostProvider(FxProvider):
+    name = "exchangerate_host"
+
+    def __init__(self, api_key=None, url=None):
+        self.api_key = api_key or getattr(settings, "EXCHANGE_API_KEY", None)
+        self.url = url or getattr(settings, "FX_EXCHANGERATE_HOST_URL", "https://api.exchangerate.host/live")
+
+    def fetch(self, base, currencies):
+        params = {"source": base, "currencies": ",".join(currencies)}
+        if self.api_key:
+            params["access_key"] = self.api_key
+        data = self._get_json(self.url, params)
+        if not isinstance(data, dict) or not isinstance(data.get("quotes"), dict):
+            raise FxProviderError(f"{self.name}: unexpected response {data}")
+        source = data.get("source", base)
+        return _decimal_rates({pair[len(source):]: v for pair, v in data["quotes"].items() if pair.startswith(source)})
+
+
+class OpenErApiProvider(FxProvider):
+    name = "open_er_api"
+
+    def __init__(self, url=None):
+        self.url = url or getattr(settings, "FX_OPEN_ER_API_URL", "https://open.er-api.com/v6/latest/{base}")
+
+    def fetch(self, base, currencies):
+        data = self._get_json(self.url.format(base=base))
+        if not isinstance(data, dict) or data.get("result") != "success" or not isinstance(data.get("rates"), dict):
+            raise FxProviderError(f"{self.name}: unexpected response {data}")
+        wanted = set(currencies)
+        return _decimal_rates({code: v for code, v in data["rates"].items() if code in wanted})
+
+
+class FileProvider(FxProvider):
+    """Reads ``{"base": "USD", "rates": {"KES": "129.25", ...}}`` from a JSON file."""
+    name = "file"
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, "FX_RATES_FILE", None)
+
+    def fetch(self, base, currencies):
+        if not self.path:
+            raise FxProviderError("file: FX_RATES_FILE is not set")
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            raise FxProviderError(f"file: {e}") from e
+        rates = _decimal_rates(data.get("rates", {}))
+        rates[data.get("base", base)] = Decimal("1")
+        if base not in rates:
+            raise FxProviderError(f"file: no rate for base {base}")
+        # Rebase if the file is quoted against a different currency.
+        return {code: rates[code] / rates[base] for code in currencies if code in rates}
+
+
+PROVIDERS = {
+    provider.name: provider
+    for provider in (ExchangeRateHostProvider, OpenErApiProvider, FileProvider)
+}
+
+
+class ProviderChain:
+    """Try providers in order, skipping any whose circuit breaker is open."""
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+        self.breakers = {p.name: CircuitBreaker(f"fx_{p.name}") for p in self.providers}
+
+    def fetch(self, base, currencies):
+        """Return ``(provider_name, rates)`` from the first provider that answers."""
+        errors = []
+        for provider in self.providers:
+            breaker = self.breakers[provider.name]
+            if not breaker.allow():
+                errors.append(f"{provider.name}: circuit open")
+                continue
+            started = time.monotonic()
+            try:
+                rates = provider.fetch(base, currencies)
+                if not rates:
+                    raise FxProviderError(f"{provider.name}: no rates returned")
+            except Exception as e:
+                breaker.record_failure()
+                logger.warning("FX provider %s failed after %.2fs: %s", provider.name, time.monotonic() - started, e)
+                errors.append(str(e))
+                continue
+            breaker.record_success()
+            return provider.name, rates
+        raise FxProviderError("All FX providers failed: " + "; ".join(errors))
+
+
+def get_provider_chain():
+    names = getattr(settings, "FX_PROVIDERS", ["exchangerate_host", "open_er_api"])
+    return ProviderChain(PROVIDERS[name]() for name in names)
@@ -0,0 +1,217 @@
+# wallet/http_client.py
+"""
+Shared HTTP client for payment and FX providers.
+
+Each ``ProviderClient`` owns one keep-alive ``requests.Session`` per process
+with a sized connection pool, so repeated calls to M-Pesa or Flutterwave
+reuse TCP/TLS connections instead of opening a new one per request.
+
+Every call gets a default ``(connect, read)`` timeout. Retries with jittered
+exponential backoff are applied by urllib3: connection failures are retried
+for any method (nothing reached the provider), while read errors and
+429/5xx responses are only retried for idempotent methods (GET, HEAD, PUT,
+DELETE, OPTIONS), never for POSTs that move money.
+
+``AsyncProviderClient`` is the httpx counterpart for async views under
+ASGI: one ``httpx.AsyncClient`` per event loop, so a single process can hold
+hundreds of in-flight provider calls without a thread each. It follows the
+same timeout and retry rules.
+
+``stats()`` reports per-client call counts, errors and latency.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .idempotency import note_side_effect
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = getattr(settings, "PROVIDER_HTTP_TIMEOUT", (3.05, 15))
+POOL_SIZE = getattr(settings, "PROVIDER_HTTP_POOL_SIZE", 20)
+MAX_RETRIES = getattr(settings, "PROVIDER_HTTP_RETRIES", 2)
+BACKOFF_FACTOR = getattr(settings, "PROVIDER_HTTP_BACKOFF", 0.3)
+SLOW_CALL_SECONDS = getattr(settings, "PROVIDER_HTTP_SLOW_SECONDS", 5)
+ASYNC_POOL_SIZE = getattr(settings, "PROVIDER_HTTP_ASYNC_POOL_SIZE", 200)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(Retry.DEFAULT_ALLOWED_METHODS)
+
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+
+def stats():
+    """Per-client ``{"calls", "errors", "total_ms", "max_ms", "avg_ms"}``."""
+    with _stats_lock:
+        return {
+            name: {**s, "avg_ms": round(s["total_ms"] / s["calls"], 1) if s["calls"] else 0.0}
+            for name, s in _stats.items()
+        }
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _record(name, method, url, elapsed_ms, error):
+    with _stats_lock:
+        s = _stats[name]
+        s["calls"] += 1
+        s["errors"] += int(error)
+        s["total_ms"] += elapsed_ms
+        s["max_ms"] = max(s["max_ms"], elapsed_ms)
+    log = logger.warning if elapsed_ms > SLOW_CALL_SECONDS * 1000 else logger.debug
+    log("%s %s %s took %.0fms", name, method, url.split("?")[0], elapsed_ms)
+
+
+def _absolute(base_url, url):
+    if base_url and not url.startswith(("http://", "https://")):
+        return f"{base_url}/{url.lstrip('/')}"
+    return url
+
+
+class ProviderClient:
+    def __init__(self, name, base_url="", timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, pool_size=POOL_SIZE):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Re-create after fork so worker processes don't share sockets.
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=BACKOFF_FACTOR,
+            backoff_jitter=BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        url = _absolute(self.base_url, url)
+        kwargs.setdefault("timeout", self.timeout)
+        if method.upper() not in IDEMPOTENT_METHODS:
+            note_side_effect()
+
+        started = time.monotonic()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            _record(self.name, method, url, (time.monotonic() - started) * 1000, error)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class AsyncProviderClient:
+    """httpx-based client for async views; same timeouts, retry rules and stats as ``ProviderClient``."""
+
+    def __init__(self, name, base_url="", timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, pool_size=ASYNC_POOL_SIZE):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        # httpx clients are bound to the loop that opened their connections.
+        self._clients = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = self._clients[loop] = self._build_client()
+        return client
+
+    def _build_client(self):
+        if isinstance(self.timeout, tuple):
+            connect, read = self.timeout
+            timeout = httpx.Timeout(read, connect=connect)
+        else:
+            timeout = httpx.Timeout(self.timeout)
+        # The transport's own retries cover connection failures only, which are
+        # safe for any method; status and read retries are handled in request().
+        transport = httpx.AsyncHTTPTransport(
+            retries=self.retries,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+        )
+        return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+    async def aclose(self):
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def _send(self, method, url, **kwargs):
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except (httpx.ReadError, httpx.ReadTimeout, httpx.RemoteProtocolError):
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, BACKOFF_FACTOR))
+
+    async def request(self, method, url, **kwargs):
+        url = _absolute(self.base_url, url)
+        if method.upper() not in IDEMPOTENT_METHODS:
+            note_side_effect()
+        started = time.monotonic()
+        error = True
+        try:
+            response = await self._send(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            _record(self.name, method, url, (time.monotonic() - started) * 1000, error)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
@@ -0,0 +1,295 @@
+# wallet/idempotency.py
+"""
+Idempotency-Key support for money-moving endpoints.
+
+A client that sends an ``Idempotency-Key`` header gets at-most-once
+execution per (user, key): the first request runs the view and its response
+is stored in ``IdempotencyKey`` (with a cache entry in front); replays with
+the same key and body get the stored response back without touching the
+wallet or the provider. A duplicate that arrives while the first request is
+still running waits for it to finish instead of racing it.
+
+The running request holds the key under a lease (``IDEMPOTENCY_LEASE_SECONDS``).
+If its worker dies, the next request with the same key and body takes the
+key over once the lease runs out, instead of getting 409 until the purge.
+
+A failed request (an exception or a 5xx) releases the key only if it changed
+nothing: no database write committed and no provider POST was sent.
+Writes are seen by an execute wrapper installed on every connection (see
+``WalletConfig.ready``). Provider calls report through ``note_side_effect``.
+Otherwise the error response is stored, and a retry replays it instead of
+running the side effects a second time.
+
+Apply ``@idempotent`` directly above the view function (below the DRF
+decorators) or on an ``APIView`` method. ``@async_idempotent`` does the same
+for the async views in ``async_views.py``.
+"""
+import hashlib
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.transaction import TransactionManagementError
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+KEY_TTL = getattr(settings, "IDEMPOTENCY_KEY_TTL", 24 * 60 * 60)
+WAIT_TIMEOUT = getattr(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 10)
+# Longer than the slowest view, including provider timeouts and retries
+LEASE_SECONDS = getattr(settings, "IDEMPOTENCY_LEASE_SECONDS", 120)
+POLL_INTERVAL = 0.1
+
+FAILED_AFTER_CHANGES = {"error": "The request failed after making changes and will not be repeated; check its status."}
+
+
+# ---------------- SIDE-EFFECT TRACKING ----------------
+class _SideEffects:
+    def __init__(self):
+        self.committed = False
+
+    def mark(self):
+        self.committed = True
+
+
+_side_effects = ContextVar("idempotency_side_effects", default=None)
+
+
+@contextmanager
+def _track_side_effects():
+    effects = _SideEffects()
+    token = _side_effects.set(effects)
+    try:
+        yield effects
+    finally:
+        _side_effects.reset(token)
+
+
+def note_side_effect():
+    """Record that the running idempotent request did something a retry must not repeat."""
+    effects = _side_effects.get()
+    if effects is not None:
+        effects.mark()
+
+
+def _track_writes(execute, sql, params, many, context):
+    effects = _side_effects.get()
+    if effects is not None and not effects.committed and sql.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+        try:
+            # Runs at once in autocommit, at the outermost commit otherwise, never on rollback
+            transaction.on_commit(effects.mark, using=context["connection"].alias)
+        except TransactionManagementError:
+            effects.mark()
+    return execute(sql, params, many, context)
+
+
+def install_write_tracker(sender, connection, **kwargs):
+    """``connection_created`` receiver that adds the write tracker to a new connection."""
+    if _track_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_track_writes)
+
+
+def _fingerprint(method, path, data):
+    if hasattr(data, "dict"):
+        data = data.dict()
+    body = json.dumps(data, sort_keys=True, default=str)
+    raw = f"{method}:{path}:{body}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _cache_key(user_id, key):
+    return f"idem_{user_id}_{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def _stored(record):
+    return {
+        "fingerprint": record.fingerprint,
+        "status": record.response_status,
+        "body": record.response_body,
+    }
+
+
+def _lease_expired(record, now):
+    # Rows written before leases existed fall back to their age
+    locked_until = record.locked_until or record.created_at + timedelta(seconds=LEASE_SECONDS)
+    return record.status == "IN_PROGRESS" and locked_until <= now
+
+
+def _claim(user, key, endpoint, fingerprint):
+    """Insert the IN_PROGRESS row, or take over one whose lease ran out; returns (record, created)."""
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user=user,
+                key=key,
+                endpoint=endpoint,
+                fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=KEY_TTL),
+                locked_until=now + timedelta(seconds=LEASE_SECONDS),
+            )
+        return record, True
+    except IntegrityError:
+        record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None:
+            # The holder released the key between our insert and this read
+            return _claim(user, key, endpoint, fingerprint)
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at__lte=now).delete()
+            return _claim(user, key, endpoint, fingerprint)
+        if record.fingerprint == fingerprint and _lease_expired(record, now):
+            # The holder died mid-request; only one waiter wins the takeover
+            locked_until = now + timedelta(seconds=LEASE_SECONDS)
+            if IdempotencyKey.objects.filter(
+                    pk=record.pk, status="IN_PROGRESS", locked_until=record.locked_until
+            ).update(locked_until=locked_until):
+                logger.warning("Taking over idempotency key %s after its lease expired", record.pk)
+                record.locked_until = locked_until
+                return record, True
+        return record, False
+
+
+def _wait_for_completion(record, ckey):
+    """Poll until the request holding ``record`` stores its response."""
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        stored = cache.get(ckey)
+        if stored:
+            return stored
+        current = IdempotencyKey.objects.filter(pk=record.pk).first()
+        if current is None:
+            return None
+        if current.status == "COMPLETED":
+            return _stored(current)
+        if _lease_expired(current, timezone.now()):
+            # A retry takes the key over (see _claim)
+            return None
+        time.sleep(POLL_INTERVAL)
+    return None
+
+
+def _begin(user, key, endpoint, fingerprint):
+    """
+    Claim ``key`` for this request.
+
+    Returns ``(record, None)`` when the caller should run the view, or
+    ``(None, (status, body, replayed))`` with the response to send instead.
+    """
+    if len(key) > 255:
+        return None, (400, {"error": f"{HEADER} must be at most 255 characters."}, False)
+
+    ckey = _cache_key(user.pk, key)
+    stored = cache.get(ckey)
+    if stored is None:
+        record, created = _claim(user, key, endpoint, fingerprint)
+        if created:
+            return record, None
+        if record.fingerprint != fingerprint:
+            return None, (422, {"error": f"{HEADER} was already used with a different request."}, False)
+        stored = _stored(record) if record.status == "COMPLETED" else _wait_for_completion(record, ckey)
+        if stored is None:
+            return None, (409, {"error": "A request with this Idempotency-Key is still being processed."}, False)
+
+    if stored["fingerprint"] != fingerprint:
+        return None, (422, {"error": f"{HEADER} was already used with a different request."}, False)
+    return None, (stored["status"], stored["body"], True)
+
+
+def _release(record):
+    IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+
+def _finish(record, status, body, committed=True):
+    """Store the response for replays; a server error that changed nothing releases the key instead."""
+    if status >= 500 and not committed:
+        _release(record)
+        return
+    record.status = "COMPLETED"
+    record.response_status = status
+    record.response_body = json.loads(json.dumps(body, cls=DjangoJSONEncoder))
+    record.locked_until = None
+    record.save(update_fields=["status", "response_status", "response_body", "locked_until"])
+    cache.set(_cache_key(record.user_id, record.key), _stored(record), KEY_TTL)
+
+
+def _abort(record, effects):
+    """The view raised: release the key, or pin a 500 if it had already changed something."""
+    if effects.committed:
+        logger.error("Idempotent request %s failed after committing changes", record.pk)
+        _finish(record, 500, FAILED_AFTER_CHANGES)
+    else:
+        _release(record)
+
+
+def idempotent(view_func):
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        request = next(a for a in args if isinstance(a, Request))
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return view_func(*args, **kwargs)
+
+        fingerprint = _fingerprint(request.method, request.path, request.data)
+        record, outcome = _begin(request.user, key, view_func.__name__, fingerprint)
+        if outcome is not None:
+            status, body, replayed = outcome
+            response = Response(body, status=status)
+            if replayed:
+                response["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            with _track_side_effects() as effects:
+                response = view_func(*args, **kwargs)
+        except Exception:
+            _abort(record, effects)
+            raise
+        _finish(record, response.status_code, getattr(response, "data", None), effects.committed)
+        return response
+
+    return wrapper
+
+
+def async_idempotent(view_func):
+    """``idempotent`` for async views that return a ``JsonResponse`` and set ``request.data``."""
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return await view_func(request, *args, **kwargs)
+
+        fingerprint = _fingerprint(request.method, request.path, request.data)
+        record, outcome = await sync_to_async(_begin)(request.user, key, view_func.__name__, fingerprint)
+        if outcome is not None:
+            status, body, replayed = outcome
+            response = JsonResponse(body, status=status, safe=False)
+            if replayed:
+                response["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            with _track_side_effects() as effects:
+                response = await view_func(request, *args, **kwargs)
+        except Exception:
+            await sync_to_async(_abort)(record, effects)
+            raise
+        body = json.loads(response.content or b"null")
+        await sync_to_async(_finish)(record, response.status_code, body, effects.committed)
+        return response
+
+    return wrapper
@@ -0,0 +1,270 @@
+# wallet/ledger.py
+"""
+Double-entry ledger for wallets.
+
+``Posting`` rows are the source of truth: every money movement is written as
+one ``LedgerEntry`` whose postings balance per currency. ``Wallet.balance`` is
+a cached projection of a wallet's postings, moved in the same transaction
+with a single statement instead of a Python read-modify-write:
+
+  * debit  -> UPDATE wallet SET balance = balance - x WHERE id = ? AND balance >= x
+  * credit -> UPDATE wallet SET balance = balance + x WHERE id = ?
+
+A debit that matches no row means the wallet did not hold enough funds, and
+``InsufficientFunds`` is raised. Transfers touch both rows inside one
+transaction, always in ascending primary-key order, so two opposite transfers
+between the same wallets cannot deadlock.
+
+``BalanceSnapshot`` rows (see the ``snapshot_balances`` command) let
+``balance_at`` and ``statement`` read one snapshot plus a short tail of
+postings instead of a wallet's whole history.
+"""
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Max, Sum, Value, When
+from django.utils import timezone
+
+from .models import Wallet, LedgerEntry, Posting, BalanceSnapshot
+
+# Account names for the non-wallet side of an entry
+WALLET_ACCOUNT = "wallet"
+EXTERNAL_ACCOUNT = "external:other"
+MPESA_ACCOUNT = "external:mpesa"
+FLUTTERWAVE_ACCOUNT = "external:flutterwave"
+FX_ACCOUNT = "clearing:fx"
+
+DEBIT = "DEBIT"
+CREDIT = "CREDIT"
+
+
+class InsufficientFunds(Exception):
+    """Raised when a conditional debit finds less than the requested amount."""
+
+
+def _to_decimal(amount):
+    amount = Decimal(str(amount)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    if amount <= 0:
+        raise ValueError(f"Ledger amount must be positive, got {amount}")
+    return amount
+
+
+# ---------------- PROJECTION UPDATES ----------------
+def _apply_debit(wallet, amount):
+    updated = Wallet.objects.filter(pk=wallet.pk, balance__gte=amount).update(
+        balance=F("balance") - amount, version=F("version") + 1
+    )
+    if not updated:
+        raise InsufficientFunds(f"Insufficient balance in wallet {wallet.pk}")
+
+
+def _apply_credit(wallet, amount):
+    updated = Wallet.objects.filter(pk=wallet.pk).update(
+        balance=F("balance") + amount, version=F("version") + 1
+    )
+    if not updated:
+        raise Wallet.DoesNotExist(f"Wallet {wallet.pk} does not exist")
+
+
+def _wallet_posting(entry, wallet, direction, amount):
+    return Posting(
+        entry=entry,
+        wallet=wallet,
+        account=WALLET_ACCOUNT,
+        direction=direction,
+        amount=amount,
+        currency=wallet.currency,
+    )
+
+
+def _system_posting(entry, account, direction, amount, currency):
+    return Posting(
+        entry=entry,
+        account=account,
+        direction=direction,
+        amount=amount,
+        currency=currency,
+    )
+
+
+# ---------------- MONEY MOVEMENTS ----------------
+def debit(wallet, amount, account=EXTERNAL_ACCOUNT, description=""):
+    """Take ``amount`` out of ``wallet`` into ``account`` if the balance covers it."""
+    amount = _to_decimal(amount)
+    with transaction.atomic():
+        _apply_debit(wallet, amount)
+        entry = LedgerEntry.objects.create(description=description[:255])
+        Posting.objects.bulk_create([
+            _wallet_posting(entry, wallet, DEBIT, amount),
+            _system_posting(entry, account, CREDIT, amount, wallet.currency),
+        ])
+    return entry
+
+
+def credit(wallet, amount, account=EXTERNAL_ACCOUNT, description=""):
+    """Move ``amount`` from ``account`` into ``wallet``."""
+    amount = _to_decimal(amount)
+    with transaction.atomic():
+        _apply_credit(wallet, amount)
+        entry = LedgerEntry.objects.create(description=description[:255])
+        Posting.objects.bulk_create([
+            _system_posting(entry, account, DEBIT, amount, wallet.currency),
+            _wallet_posting(entry, wallet, CREDIT, amount),
+        ])
+    return entry
+
+
+def transfer(sender_wallet, recv_wallet, amount, converted_amount=None, description=""):
+    """Move ``amount`` out of ``sender_wallet`` and ``converted_amount`` into ``recv_wallet``.
+
+    Cross-currency transfers pass through the FX clearing account so each
+    currency balances on its own. Row locks are taken by the UPDATE
+    statements themselves, which are issued in primary-key order.
+    """
+    amount = _to_decimal(amount)
+    converted_amount = amount if converted_amount is None else _to_decimal(converted_amount)
+
+    legs = [
+        (sender_wallet.pk, _apply_debit, sender_wallet, amount),
+        (recv_wallet.pk, _apply_credit, recv_wallet, converted_amount),
+    ]
+    legs.sort(key=lambda leg: leg[0])
+
+    with transaction.atomic():
+        for _, apply_leg, wallet, leg_amount in legs:
+            apply_leg(wallet, leg_amount)
+
+        entry = LedgerEntry.objects.create(description=description[:255])
+        postings = [_wallet_posting(entry, sender_wallet, DEBIT, amount)]
+        if sender_wallet.currency != recv_wallet.currency:
+            postings += [
+                _system_posting(entry, FX_ACCOUNT, CREDIT, amount, sender_wallet.currency),
+                _system_posting(entry, FX_ACCOUNT, DEBIT, converted_amount, recv_wallet.currency),
+            ]
+        postings.append(_wallet_posting(entry, recv_wallet, CREDIT, converted_amount))
+        Posting.objects.bulk_create(postings)
+    return entry
+
+
+def disburse(sender_wallet, legs, description=""):
+    """Pay many wallets out of ``sender_wallet`` in one transaction.
+
+    ``legs`` is a list of ``(recv_wallet, amount, converted_amount)``. The
+    sender is debited once for the total and all recipients are credited with
+    a single UPDATE, after locking every involved row in primary-key order.
+    Raises ``InsufficientFunds`` (and writes nothing) if the total is not covered.
+    """
+    legs = [(w, _to_decimal(a), _to_decimal(c)) for w, a, c in legs]
+    total = sum((amount for _, amount, _ in legs), Decimal("0.00"))
+
+    credits = defaultdict(Decimal)
+    for wallet, _, converted_amount in legs:
+        credits[wallet.pk] += converted_amount
+
+    with transaction.atomic():
+        locked = sorted({sender_wallet.pk, *credits})
+        list(Wallet.objects.select_for_update().filter(pk__in=locked).order_by("pk").values_list("pk", flat=True))
+
+        _apply_debit(sender_wallet, total)
+        Wallet.objects.filter(pk__in=credits).update(
+            balance=F("balance") + Case(
+                *[When(pk=pk, then=Value(amount)) for pk, amount in credits.items()],
+                output_field=DecimalField(max_digits=12, decimal_places=2),
+            ),
+            version=F("version") + 1,
+        )
+
+        entry = LedgerEntry.objects.create(description=description[:255])
+        postings = []
+        for wallet, amount, converted_amount in legs:
+            postings.append(_wallet_posting(entry, sender_wallet, DEBIT, amount))
+            if sender_wallet.currency != wallet.currency:
+                postings += [
+                    _system_posting(entry, FX_ACCOUNT, CREDIT, amount, sender_wallet.currency),
+                    _system_posting(entry, FX_ACCOUNT, DEBIT, converted_amount, wallet.currency),
+                ]
+            postings.append(_wallet_posting(entry, wallet, CREDIT, converted_amount))
+        Posting.objects.bulk_create(postings)
+    return entry
+
+
+def refresh_balance(wallet):
+    """Reload ``wallet.balance`` after a ledger update and return it."""
+    wallet.refresh_from_db(fields=["balance"])
+    return wallet.balance
+
+
+# ---------------- BALANCE QUERIES ----------------
+def _net(postings):
+    """Credits minus debits over a Posting queryset."""
+    total = postings.aggregate(
+        net=Sum(Case(When(direction=CREDIT, then=F("amount")), default=-F("amount")))
+    )["net"]
+    return Decimal(total or 0).quantize(Decimal("0.01"))
+
+
+def _replay_from(wallet, at=None):
+    """Return (latest snapshot taken at/before ``at``, postings after it)."""
+    snapshots = BalanceSnapshot.objects.filter(wallet=wallet)
+    postings = Posting.objects.filter(wallet=wallet)
+    if at is not None:
+        snapshots = snapshots.filter(taken_at__lte=at)
+        postings = postings.filter(created_at__lte=at)
+    snapshot = snapshots.order_by("-taken_at").first()
+    if snapshot:
+        postings = postings.filter(id__gt=snapshot.last_posting_id)
+    return snapshot, postings
+
+
+def balance_at(wallet, at=None):
+    """Ledger balance of ``wallet`` at time ``at`` (now when omitted)."""
+    snapshot, tail = _replay_from(wallet, at)
+    opening = snapshot.balance if snapshot else Decimal("0.00")
+    return opening + _net(tail)
+
+
+def compare_balance(wallet):
+    """Return (cached ``Wallet.balance``, ledger balance) read at the same posting cut-off.
+
+    The wallet row is locked first. Every ledger write updates that row in the
+    transaction that adds its postings, so nothing can land between the two reads
+    and the ledger side stops at the last posting committed before the lock.
+    """
+    with transaction.atomic():
+        cached = Wallet.objects.select_for_update().values_list("balance", flat=True).get(pk=wallet.pk)
+        snapshot, tail = _replay_from(wallet)
+        cutoff = tail.aggregate(last=Max("id"))["last"]
+        if cutoff is not None:
+            tail = tail.filter(id__lte=cutoff)
+        opening = snapshot.balance if snapshot else Decimal("0.00")
+        return cached, opening + _net(tail)
+
+
+def statement(wallet, start, end=None):
+    """Return (opening balance at ``start``, postings between ``start`` and ``end``)."""
+    opening = balance_at(wallet, start)
+    postings = Posting.objects.filter(wallet=wallet, created_at__gt=start)
+    if end is not None:
+        postings = postings.filter(created_at__lte=end)
+    return opening, postings.select_related("entry").order_by("id")
+
+
+def take_snapshot(wallet, at=None):
+    """Record the wallet's ledger balance as of ``at``; returns None when nothing changed.
+
+    Callers should pass a time slightly in the past so postings from
+    transactions still in flight are not skipped over.
+    """
+    at = at or timezone.now()
+    snapshot, tail = _replay_from(wallet, at)
+    last_posting_id = tail.order_by("-id").values_list("id", flat=True).first()
+    if last_posting_id is None:
+        return None
+    opening = snapshot.balance if snapshot else Decimal("0.00")
+    return BalanceSnapshot.objects.create(
+        wallet=wallet,
+        balance=opening + _net(tail),
+        last_posting_id=last_posting_id,
+        taken_at=at,
+    )
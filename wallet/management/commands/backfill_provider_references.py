@@ -0,0 +1,79 @@
+import re
+
+from django.core.management.base import BaseCommand
+
+from wallet.models import Transaction
+
+# Description formats written before Transaction.provider_reference existed
+DESCRIPTION_PATTERNS = [
+    (re.compile(r"^(?:Failed )?M-Pesa deposit reference (\S+)"), "MPESA"),
+    (re.compile(r"^M-Pesa withdraw reference (\S+)"), "MPESA"),
+    (re.compile(r"^Flutterwave withdraw reference (\S+)"), "FLUTTERWAVE"),
+    (re.compile(r"^Flutterwave withdrawal: (\S+)"), "FLUTTERWAVE"),
+    (re.compile(r"^Flutterwave deposit: (\S+)"), "FLUTTERWAVE"),
+]
+
+
+def parse_description(description):
+    """Return (provider, reference) parsed from a legacy description, or None."""
+    for pattern, provider in DESCRIPTION_PATTERNS:
+        match = pattern.match(description or "")
+        if match and match.group(1) not in ("None", "n/a"):
+            return provider, match.group(1)[:100]
+    return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Populate Transaction.provider/provider_reference from legacy descriptions. "
+        "Works in primary-key chunks and can be re-run safely."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        pending = Transaction.objects.filter(provider_reference__isnull=True).order_by("pk")
+
+        last_pk = 0
+        updated = skipped = 0
+        while True:
+            chunk = list(pending.filter(pk__gt=last_pk).only("pk", "description")[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+
+            parsed = {}
+            for row in chunk:
+                found = parse_description(row.description)
+                if not found:
+                    continue
+                if found in parsed:
+                    skipped += 1
+                else:
+                    parsed[found] = row
+
+            # A reference may already be claimed (e.g. the pending row and its
+            # completion row from before); the earliest row keeps it.
+            taken = set()
+            for provider in {p for p, _ in parsed}:
+                refs = [r for p, r in parsed if p == provider]
+                taken.update(
+                    (provider, ref) for ref in Transaction.objects.filter(
+                        provider=provider, provider_reference__in=refs
+                    ).values_list("provider_reference", flat=True)
+                )
+
+            rows = []
+            for (provider, ref), row in parsed.items():
+                if (provider, ref) in taken:
+                    skipped += 1
+                    continue
+                row.provider, row.provider_reference = provider, ref
+                rows.append(row)
+            Transaction.objects.bulk_update(rows, ["provider", "provider_reference"])
+            updated += len(rows)
+            self.stdout.write(f"Processed up to id {last_pk}: {updated} updated, {skipped} duplicates skipped")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill complete: {updated} updated, {skipped} duplicates skipped"))
@@ -0,0 +1,46 @@
+import csv
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet.disbursement import disburse, DisbursementError
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Pay many wallets from one sender in a single commit. The CSV needs "
+        "'recipient' (username or email) and 'amount' columns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("sender", help="Username or email of the paying user.")
+        parser.add_argument("csv_path", help="Path to the CSV file of transfers.")
+        parser.add_argument("--description", default="Bulk disbursement")
+
+    def handle(self, *args, **options):
+        sender_ref = options["sender"]
+        lookup = {"email": sender_ref} if "@" in sender_ref else {"username": sender_ref}
+        try:
+            sender = User.objects.get(**lookup)
+        except User.DoesNotExist:
+            raise CommandError(f"Sender {sender_ref} not found")
+
+        with open(options["csv_path"], newline="", encoding="utf-8-sig") as fh:
+            lines = [
+                {"recipient": row.get("recipient"), "amount": row.get("amount")}
+                for row in csv.DictReader(fh)
+            ]
+
+        try:
+            results, _ = disburse(sender, lines, description=options["description"])
+        except DisbursementError as e:
+            raise CommandError(str(e))
+
+        for result in results:
+            self.stdout.write(json.dumps(result))
+
+        succeeded = sum(1 for r in results if r["status"] == "success")
+        self.stdout.write(self.style.SUCCESS(f"{succeeded} of {len(results)} transfers succeeded"))
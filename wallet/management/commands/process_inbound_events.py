@@ -0,0 +1,71 @@
+import logging
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from wallet import events
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply stored M-Pesa and Flutterwave callbacks from the InboundEvent "
+        "table. Runs until stopped; use --once to drain what is due and exit. "
+        "Several workers can run at once, events are claimed with SKIP LOCKED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Maximum events applied at once (default 8).")
+        parser.add_argument("--poll", type=float, default=0.5,
+                            help="Seconds to wait when nothing is due (default 0.5).")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once nothing is due and nothing is in flight.")
+        parser.add_argument("--replay", type=int, nargs="+", metavar="ID",
+                            help="Queue these events again before processing.")
+        parser.add_argument("--replay-failed", action="store_true",
+                            help="Queue every FAILED event again before processing.")
+
+    def handle(self, *args, **options):
+        if options["replay"] or options["replay_failed"]:
+            replayed = events.replay(ids=options["replay"])
+            self.stdout.write(f"Queued {replayed} events for replay")
+
+        concurrency = max(1, options["concurrency"])
+        poll = options["poll"]
+        outcomes = Counter()
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = set()
+            while True:
+                free = concurrency - len(in_flight)
+                if free:
+                    try:
+                        events.recover_expired_leases()
+                        for event in events.claim_due(free):
+                            in_flight.add(pool.submit(events.process, event))
+                    except Exception:
+                        # Keep the worker alive through a database blip.
+                        logger.exception("Failed to claim inbound events")
+
+                if not in_flight:
+                    if options["once"]:
+                        break
+                    time.sleep(poll)
+                    continue
+
+                done, in_flight = wait(in_flight, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        outcomes[future.result()] += 1
+                    except Exception:
+                        logger.exception("Inbound event task failed")
+                        outcomes["ERROR"] += 1
+
+        elapsed = time.monotonic() - started
+        summary = ", ".join(f"{status.lower()}={count}" for status, count in sorted(outcomes.items())) or "nothing due"
+        self.stdout.write(self.style.SUCCESS(f"Processed {sum(outcomes.values())} events in {elapsed:.1f}s ({summary})"))
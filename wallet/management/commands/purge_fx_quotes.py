@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from wallet.models import FxQuote
+
+
+class Command(BaseCommand):
+    help = "Delete FX quotes that have expired."
+
+    def handle(self, *args, **options):
+        deleted, _ = FxQuote.objects.filter(expires_at__lte=timezone.now()).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired FX quotes"))
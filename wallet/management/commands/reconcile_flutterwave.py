@@ -0,0 +1,59 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from wallet import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Settle or refund sent Flutterwave withdrawals whose webhook never arrived, "
+        "using verify_withdrawal. Each final status is applied through the same "
+        "code path as the transfer webhook. Progress is written to --checkpoint "
+        "after every chunk, so an interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, default=600,
+                            help="Only withdrawals pending for at least this many seconds (default 600).")
+        parser.add_argument("--chunk-size", type=int, default=200,
+                            help="Rows read per query (default 200).")
+        parser.add_argument("--workers", type=int, default=8,
+                            help="Concurrent verify calls (default 8).")
+        parser.add_argument("--rate", type=float, default=10,
+                            help="Maximum verify calls per second, 0 for no limit (default 10).")
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Stop after this many withdrawals.")
+        parser.add_argument("--after-id", type=int, default=0,
+                            help="Start after this WalletTransaction id.")
+        parser.add_argument("--checkpoint", default=None,
+                            help="File holding the last checked id; read on start, removed once the run completes.")
+
+    def handle(self, *args, **options):
+        checkpoint = options["checkpoint"]
+        after_id = options["after_id"]
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                after_id = max(after_id, int(f.read().strip() or 0))
+            self.stdout.write(f"Resuming after id {after_id}")
+
+        def progress(last_id, report):
+            if checkpoint:
+                with open(checkpoint, "w") as f:
+                    f.write(str(last_id))
+            self.stdout.write(f"Checked up to id {last_id}: {report.checked} withdrawals")
+
+        report = reconcile.reconcile_flutterwave(
+            older_than=options["older_than"],
+            chunk_size=options["chunk_size"],
+            workers=max(1, options["workers"]),
+            rate=options["rate"],
+            limit=options["limit"],
+            after_id=after_id,
+            progress=progress,
+        )
+        if checkpoint and os.path.exists(checkpoint) and options["limit"] is None:
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(report.summary()))
+        if report.unresolved:
+            self.stdout.write(self.style.WARNING(f"{report.unresolved} withdrawals remain pending"))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from wallet import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Finalise pending M-Pesa STK deposits whose callback never arrived, using "
+        "the STK Push Query API. Answers are applied through the same code path as "
+        "the callback; deposits Safaricom cannot resolve yet are reported as stuck."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, default=120,
+                            help="Only deposits pending for at least this many seconds (default 120).")
+        parser.add_argument("--chunk-size", type=int, default=200,
+                            help="Rows read per query (default 200).")
+        parser.add_argument("--workers", type=int, default=8,
+                            help="Concurrent STK queries (default 8).")
+        parser.add_argument("--rate", type=float, default=10,
+                            help="Maximum STK queries per second, 0 for no limit (default 10).")
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Stop after this many deposits.")
+
+    def handle(self, *args, **options):
+        report = reconcile.reconcile_stk(
+            older_than=options["older_than"],
+            chunk_size=options["chunk_size"],
+            workers=max(1, options["workers"]),
+            rate=options["rate"],
+            limit=options["limit"],
+        )
+        self.stdout.write(self.style.SUCCESS(report.summary()))
+        if report.unresolved:
+            self.stdout.write(self.style.WARNING(f"{report.unresolved} deposits remain pending"))
@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet import banks
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch the Flutterwave bank list for each country and store it in the Bank "
+        "table. Run from cron, or with --loop as a long-lived refresher. Requests "
+        "only ever read the stored list."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("countries", nargs="*", default=[banks.DEFAULT_COUNTRY],
+                            help=f"ISO country codes (default {banks.DEFAULT_COUNTRY}).")
+        parser.add_argument("--loop", action="store_true", help="Keep refreshing every --interval seconds.")
+        parser.add_argument("--interval", type=int, default=24 * 60 * 60,
+                            help="Seconds between refreshes with --loop (default 86400).")
+
+    def handle(self, *args, **options):
+        if not options["loop"]:
+            for country in options["countries"]:
+                try:
+                    directory = banks.refresh_banks(country)
+                except banks.BankDirectoryError as e:
+                    raise CommandError(str(e))
+                self.stdout.write(self.style.SUCCESS(self._stored(directory)))
+            return
+
+        interval = options["interval"]
+        while True:
+            started = time.monotonic()
+            for country in options["countries"]:
+                try:
+                    self.stdout.write(self._stored(banks.refresh_banks(country)))
+                except Exception:
+                    # Keep the stored list in service and try again next tick.
+                    logger.exception("Bank refresh for %s failed", country)
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+    def _stored(self, directory):
+        return f"Stored {len(directory.banks)} banks for {directory.country} (etag {directory.etag})"
@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wallet import fx
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch exchange rates from the provider and store them as a new FxRate "
+        "version. Run once from cron, or with --loop as a long-lived refresher. "
+        "Requests only ever read the stored rates: from the cache when it is shared "
+        "(REDIS_URL), otherwise from the FxRate table, which each web worker reloads "
+        "once per FX_RATES_TTL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="Keep refreshing every --interval seconds.")
+        parser.add_argument("--interval", type=int, default=60,
+                            help="Seconds between refreshes with --loop (default 60).")
+
+    def handle(self, *args, **options):
+        if not options["loop"]:
+            try:
+                table = fx.refresh_rates()
+            except fx.FxError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(f"Stored FX rates version {table.version} ({len(table.rates)} currencies)"))
+            return
+
+        interval = options["interval"]
+        while True:
+            started = time.monotonic()
+            try:
+                table = fx.refresh_rates()
+                self.stdout.write(f"Stored FX rates version {table.version} ({len(table.rates)} currencies)")
+            except Exception:
+                # Keep the last stored version in service and try again next tick.
+                logger.exception("FX rate refresh failed")
+            time.sleep(max(0, interval - (time.monotonic() - started)))
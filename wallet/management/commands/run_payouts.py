@@ -0,0 +1,63 @@
+import logging
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from wallet import payouts
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Send queued M-Pesa B2C and Flutterwave payouts from the PayoutOutbox. "
+        "Runs until stopped; use --once to drain what is due and exit. Several "
+        "workers can run at once, rows are claimed with SKIP LOCKED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="Maximum payouts in flight at once (default 8).")
+        parser.add_argument("--poll", type=float, default=1.0,
+                            help="Seconds to wait when nothing is due (default 1).")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once nothing is due and nothing is in flight.")
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options["concurrency"])
+        poll = options["poll"]
+        outcomes = Counter()
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = set()
+            while True:
+                free = concurrency - len(in_flight)
+                if free:
+                    try:
+                        payouts.recover_expired_leases()
+                        for outbox in payouts.claim_due(free):
+                            in_flight.add(pool.submit(payouts.process, outbox))
+                    except Exception:
+                        # Keep the worker alive through a database blip.
+                        logger.exception("Failed to claim payouts")
+
+                if not in_flight:
+                    if options["once"]:
+                        break
+                    time.sleep(poll)
+                    continue
+
+                done, in_flight = wait(in_flight, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        outcomes[future.result() or "LEASE_LOST"] += 1
+                    except Exception:
+                        logger.exception("Payout worker task failed")
+                        outcomes["ERROR"] += 1
+
+        elapsed = time.monotonic() - started
+        summary = ", ".join(f"{status.lower()}={count}" for status, count in sorted(outcomes.items())) or "nothing due"
+        self.stdout.write(self.style.SUCCESS(f"Processed {sum(outcomes.values())} payouts in {elapsed:.1f}s ({summary})"))
@@ -0,0 +1,65 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from wallet import ledger
+from wallet.models import Wallet, BalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write a BalanceSnapshot for every wallet with postings since its last "
+        "snapshot. Run periodically (e.g. from cron) to keep ledger replays short."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lag", type=int, default=60,
+                            help="Only include postings older than this many seconds (default 60).")
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument("--verify", action="store_true",
+                            help="Report wallets whose cached balance disagrees with the ledger.")
+
+    def handle(self, *args, **options):
+        at = timezone.now() - timedelta(seconds=options["lag"])
+        chunk_size = options["chunk_size"]
+
+        last_snapshot = (
+            BalanceSnapshot.objects.filter(wallet=OuterRef("pk"))
+            .order_by("-taken_at")
+            .values("last_posting_id")[:1]
+        )
+        wallets = (
+            Wallet.objects.annotate(
+                last_posting_id=Max("postings__id"),
+                snapshot_posting_id=Subquery(last_snapshot),
+            )
+            .filter(last_posting_id__isnull=False)
+            .order_by("pk")
+        )
+
+        taken = mismatched = 0
+        last_pk = 0
+        while True:
+            chunk = list(wallets.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+
+            for wallet in chunk:
+                if wallet.snapshot_posting_id != wallet.last_posting_id:
+                    if ledger.take_snapshot(wallet, at):
+                        taken += 1
+
+                if options["verify"]:
+                    cached, ledger_balance = ledger.compare_balance(wallet)
+                    if ledger_balance != cached:
+                        mismatched += 1
+                        self.stderr.write(
+                            f"Wallet {wallet.wallet_id}: cached {cached} != ledger {ledger_balance}"
+                        )
+
+        self.stdout.write(self.style.SUCCESS(f"Snapshots written: {taken}"))
+        if options["verify"]:
+            self.stdout.write(f"Wallets out of sync: {mismatched}")
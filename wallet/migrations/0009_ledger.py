@@ -0,0 +1,73 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:06
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+def open_wallet_balances(apps, schema_editor):
+    """Post each existing balance as an opening entry so the ledger matches Wallet.balance."""
+    Wallet = apps.get_model('wallet', 'Wallet')
+    LedgerEntry = apps.get_model('wallet', 'LedgerEntry')
+    Posting = apps.get_model('wallet', 'Posting')
+
+    for wallet in Wallet.objects.exclude(balance=0).iterator():
+        entry = LedgerEntry.objects.create(description=f'Opening balance for wallet {wallet.wallet_id}')
+        wallet_side, equity_side = ('CREDIT', 'DEBIT') if wallet.balance > 0 else ('DEBIT', 'CREDIT')
+        amount = abs(wallet.balance)
+        Posting.objects.bulk_create([
+            Posting(entry=entry, wallet=wallet, account='wallet', direction=wallet_side,
+                    amount=amount, currency=wallet.currency),
+            Posting(entry=entry, account='equity:opening', direction=equity_side,
+                    amount=amount, currency=wallet.currency),
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0008_mpesastkrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('last_posting_id', models.BigIntegerField()),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('wallet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='wallet.wallet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['wallet', '-taken_at'], name='snapshot_wallet_taken_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Posting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=50)),
+                ('direction', models.CharField(choices=[('DEBIT', 'Debit'), ('CREDIT', 'Credit')], max_length=6)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('currency', models.CharField(choices=[('KES', 'Kenyan Shilling'), ('UGX', 'Ugandan Shilling'), ('TZS', 'Tanzanian Shilling'), ('RWF', 'Rwandan Franc'), ('BIF', 'Burundi Franc'), ('ZAR', 'South African Rand'), ('USD', 'US Dollar'), ('GBP', 'British Pound'), ('EUR', 'Euro'), ('AED', 'UAE Dirham'), ('SAR', 'Saudi Riyal'), ('EGP', 'Egyptian Pound'), ('NGN', 'Nigerian Naira')], default='KES', max_length=3)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='wallet.ledgerentry')),
+                ('wallet', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='wallet.wallet')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['wallet', 'id'], name='posting_wallet_id_idx'), models.Index(fields=['wallet', 'created_at'], name='posting_wallet_created_idx')],
+            },
+        ),
+        migrations.RunPython(open_wallet_balances, migrations.RunPython.noop),
+    ]
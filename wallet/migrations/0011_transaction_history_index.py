@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0010_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', '-timestamp', '-id'], name='txn_wallet_ts_id_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0012_sync_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customuser',
+            name='mobile',
+            field=models.CharField(blank=True, db_index=True, max_length=15, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(condition=models.Q(('is_verified', False)), fields=['user', '-created_at'], name='otp_user_unverified_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wallettransaction',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['type', 'id'], name='wallettx_pending_type_idx'),
+        ),
+    ]
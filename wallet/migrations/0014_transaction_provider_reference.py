@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0013_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='provider',
+            field=models.CharField(blank=True, choices=[('MPESA', 'M-Pesa'), ('FLUTTERWAVE', 'Flutterwave')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='provider_reference',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('provider_reference__isnull', False)), fields=('provider', 'provider_reference'), name='txn_provider_reference_uniq'),
+        ),
+    ]
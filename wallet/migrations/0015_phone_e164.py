@@ -0,0 +1,71 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:14
+
+from django.db import migrations, models
+
+
+def normalize_msisdn(raw):
+    """Frozen copy of wallet.utils.normalize_msisdn as of this migration."""
+    if raw is None:
+        return None
+    raw = str(raw).strip()
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    if not digits:
+        return None
+
+    if raw.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        digits = "254" + digits[1:]
+    elif len(digits) == 9:
+        digits = "254" + digits
+
+    if not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+def normalize_phones(apps, schema_editor):
+    CustomUser = apps.get_model('wallet', 'CustomUser')
+    WalletTransaction = apps.get_model('wallet', 'WalletTransaction')
+    MpesaSTKRequest = apps.get_model('wallet', 'MpesaSTKRequest')
+
+    users = list(CustomUser.objects.exclude(mobile__isnull=True).exclude(mobile='').only('pk', 'mobile'))
+    for user in users:
+        user.mobile_e164 = normalize_msisdn(user.mobile)
+    CustomUser.objects.bulk_update(users, ['mobile_e164'], batch_size=1000)
+
+    # Only M-Pesa deposits carry a phone; Flutterwave withdrawals keep the bank account number there.
+    txs = [tx for tx in WalletTransaction.objects.filter(type='deposit').exclude(phone__isnull=True).only('pk', 'phone')
+           if normalize_msisdn(tx.phone)]
+    for tx in txs:
+        tx.phone = normalize_msisdn(tx.phone)
+    WalletTransaction.objects.bulk_update(txs, ['phone'], batch_size=1000)
+
+    stk = [req for req in MpesaSTKRequest.objects.exclude(phone__isnull=True).only('pk', 'phone')
+           if normalize_msisdn(req.phone)]
+    for req in stk:
+        req.phone = normalize_msisdn(req.phone)
+    MpesaSTKRequest.objects.bulk_update(stk, ['phone'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0014_transaction_provider_reference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='mobile_e164',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=16, null=True),
+        ),
+        migrations.AlterField(
+            model_name='wallettransaction',
+            name='phone',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.RunPython(normalize_phones, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0015_phone_e164'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallettransaction',
+            name='conversation_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='wallettransaction',
+            name='originator_conversation_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
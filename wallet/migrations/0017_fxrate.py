@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0016_wallettransaction_conversation_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='fx_rate_version',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='FxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField()),
+                ('base', models.CharField(max_length=3)),
+                ('currency', models.CharField(max_length=3)),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=24)),
+                ('fetched_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('version', 'currency'), name='fxrate_version_currency_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:20
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0017_fxrate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FxQuote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quote_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('currency_from', models.CharField(choices=[('KES', 'Kenyan Shilling'), ('UGX', 'Ugandan Shilling'), ('TZS', 'Tanzanian Shilling'), ('RWF', 'Rwandan Franc'), ('BIF', 'Burundi Franc'), ('ZAR', 'South African Rand'), ('USD', 'US Dollar'), ('GBP', 'British Pound'), ('EUR', 'Euro'), ('AED', 'UAE Dirham'), ('SAR', 'Saudi Riyal'), ('EGP', 'Egyptian Pound'), ('NGN', 'Nigerian Naira')], max_length=3)),
+                ('currency_to', models.CharField(choices=[('KES', 'Kenyan Shilling'), ('UGX', 'Ugandan Shilling'), ('TZS', 'Tanzanian Shilling'), ('RWF', 'Rwandan Franc'), ('BIF', 'Burundi Franc'), ('ZAR', 'South African Rand'), ('USD', 'US Dollar'), ('GBP', 'British Pound'), ('EUR', 'Euro'), ('AED', 'UAE Dirham'), ('SAR', 'Saudi Riyal'), ('EGP', 'Egyptian Pound'), ('NGN', 'Nigerian Naira')], max_length=3)),
+                ('converted_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('rate', models.DecimalField(decimal_places=8, max_digits=18)),
+                ('fx_rate_version', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('consumed_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fx_quotes', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0018_fxquote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fxrate',
+            name='provider',
+            field=models.CharField(blank=True, default='', max_length=30),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0019_fxrate_provider'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayoutOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('MPESA', 'M-Pesa'), ('FLUTTERWAVE', 'Flutterwave')], max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('SENDING', 'Sending'), ('SENT', 'Sent'), ('FAILED', 'Failed'), ('UNKNOWN', 'Unknown')], default='PENDING', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('maybe_sent', models.BooleanField(default=False)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('wallet_transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='payout', to='wallet.wallettransaction')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'PENDING')), fields=['next_attempt_at', 'id'], name='payout_due_idx'), models.Index(condition=models.Q(('status', 'SENDING')), fields=['locked_until'], name='payout_sending_idx')],
+            },
+        ),
+    ]
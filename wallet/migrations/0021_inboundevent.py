@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0020_payoutoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('MPESA_STK', 'M-Pesa STK callback'), ('MPESA_B2C', 'M-Pesa B2C result'), ('FLUTTERWAVE', 'Flutterwave webhook')], max_length=20)),
+                ('payload', models.JSONField()),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'PENDING')), fields=['next_attempt_at', 'id'], name='inbound_due_idx'), models.Index(condition=models.Q(('status', 'PROCESSING')), fields=['locked_until'], name='inbound_processing_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0021_inboundevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inboundevent',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('DUPLICATE', 'Duplicate'), ('FAILED', 'Failed')], default='PENDING', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ProcessedEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=150, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='wallet.inboundevent')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0022_processedevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Bank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(max_length=2)),
+                ('code', models.CharField(max_length=20)),
+                ('name', models.CharField(max_length=150)),
+                ('flutterwave_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('country', 'code'), name='bank_country_code_uniq')],
+            },
+        ),
+    ]
@@ -11,9 +11,19 @@ import random
 
 #  Custom User model
 class CustomUser(AbstractUser):
-    mobile = models.CharField(max_length=15, blank=True, null=True)
+    mobile = models.CharField(max_length=15, blank=True, null=True, db_index=True)
+    # Canonical form of `mobile` (e.g. +254712345678), kept in sync on save
+    mobile_e164 = models.CharField(max_length=16, blank=True, null=True, db_index=True, editable=False)
     pin = models.CharField(max_length=128, blank=True, null=True, help_text="Hashed 6-digit PIN for transfers")
 
+    def save(self, *args, **kwargs):
+        from .utils import normalize_msisdn
+        self.mobile_e164 = normalize_msisdn(self.mobile)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'mobile' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'mobile_e164'}
+        super().save(*args, **kwargs)
+
     def set_pin(self, raw_pin):
         """Hash and store the 6-digit PIN."""
         from django.contrib.auth.hashers import make_password
@@ -34,6 +44,16 @@ class OTP(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_verified = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # verify_otp / send_otp only ever look at a user's unverified codes
+            models.Index(
+                fields=['user', '-created_at'],
+                name='otp_user_unverified_idx',
+                condition=models.Q(is_verified=False),
+            ),
+        ]
+
     def __str__(self):
         return f"OTP for {self.user.username} - {self.code}"
 
@@ -69,6 +89,8 @@ class Wallet(models.Model):
     balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
     currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='KES')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Bumped by every ledger update; lets clients detect "nothing changed" cheaply
+    version = models.PositiveBigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username}'s Wallet ({self.currency})"
@@ -90,6 +112,12 @@ class Transaction(models.Model):
         ('FAILED', 'Failed'),
     ]
 
+    #  Payment provider that carries the money in/out of the wallet
+    PROVIDER_CHOICES = [
+        ('MPESA', 'M-Pesa'),
+        ('FLUTTERWAVE', 'Flutterwave'),
+    ]
+
     transaction_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='transactions')
     transaction_type = models.CharField(max_length=10, choices=TRANSACTION_TYPES)
@@ -101,7 +129,28 @@ class Transaction(models.Model):
     counterparty = models.EmailField(null=True, blank=True)  # for receiver/sender email
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
     timestamp = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     description = models.TextField(blank=True, null=True)
+    provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES, null=True, blank=True)
+    provider_reference = models.CharField(max_length=100, null=True, blank=True)
+    # FxRate.version the exchange_rate was taken from (null when no conversion happened)
+    fx_rate_version = models.PositiveBigIntegerField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # One history row per provider reference; callbacks match on it directly
+            models.UniqueConstraint(
+                fields=['provider', 'provider_reference'],
+                name='txn_provider_reference_uniq',
+                condition=models.Q(provider_reference__isnull=False),
+            ),
+        ]
+        indexes = [
+            # Keyset pagination of a wallet's history (see wallet/pagination.py)
+            models.Index(fields=['wallet', '-timestamp', '-id'], name='txn_wallet_ts_id_idx'),
+            # "Changes since" sync (see wallet/sync.py)
+            models.Index(fields=['wallet', 'updated_at', 'id'], name='txn_wallet_updated_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.transaction_type} - {self.amount} {self.currency_from} → {self.currency_to} ({self.status})"
@@ -126,21 +175,274 @@ class WalletTransaction(models.Model):
     )
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
-    phone = models.CharField(max_length=15, null=True, blank=True)
+    # E.164 for M-Pesa rows (see utils.normalize_msisdn); Flutterwave withdrawals store the account number
+    phone = models.CharField(max_length=16, null=True, blank=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     status = models.CharField(max_length=20, default="pending")
     reference = models.CharField(max_length=50, unique=True)
+    # Returned by the M-Pesa B2C payment request and echoed in its result callback
+    conversation_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    originator_conversation_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Pending rows are a small, hot subset (callbacks, status polling, reconciliation)
+            models.Index(
+                fields=['type', 'id'],
+                name='wallettx_pending_type_idx',
+                condition=models.Q(status='pending'),
+            ),
+        ]
+
     def __str__(self):
         return f"{self.user} - {self.type} - {self.amount}"
    
     
+#  Payouts committed with the wallet debit and sent by the run_payouts worker
+class PayoutOutbox(models.Model):
+    PROVIDER_CHOICES = [
+        ('MPESA', 'M-Pesa'),
+        ('FLUTTERWAVE', 'Flutterwave'),
+    ]
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('SENDING', 'Sending'),
+        ('SENT', 'Sent'),
+        ('FAILED', 'Failed'),
+        # A send was interrupted and the provider may or may not have the payout
+        ('UNKNOWN', 'Unknown'),
+    ]
+
+    wallet_transaction = models.OneToOneField(WalletTransaction, on_delete=models.CASCADE, related_name='payout')
+    provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES)
+    # Provider-specific destination fields (M-Pesa msisdn, bank code/account, narration)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # An earlier attempt may have reached the provider; never refund automatically
+    maybe_sent = models.BooleanField(default=False)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    response = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                name='payout_due_idx',
+                condition=models.Q(status='PENDING'),
+            ),
+            models.Index(
+                fields=['locked_until'],
+                name='payout_sending_idx',
+                condition=models.Q(status='SENDING'),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} payout {self.wallet_transaction.reference} ({self.status})"
+
+
+#  Raw provider callbacks, applied by the process_inbound_events worker
+class InboundEvent(models.Model):
+    SOURCE_CHOICES = [
+        ('MPESA_STK', 'M-Pesa STK callback'),
+        ('MPESA_B2C', 'M-Pesa B2C result'),
+        ('FLUTTERWAVE', 'Flutterwave webhook'),
+    ]
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('PROCESSING', 'Processing'),
+        ('DONE', 'Done'),
+        # Redelivery of an event that was already applied (see wallet/dedup.py)
+        ('DUPLICATE', 'Duplicate'),
+        ('FAILED', 'Failed'),
+    ]
+
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    payload = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                name='inbound_due_idx',
+                condition=models.Q(status='PENDING'),
+            ),
+            models.Index(
+                fields=['locked_until'],
+                name='inbound_processing_idx',
+                condition=models.Q(status='PROCESSING'),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.source} event {self.pk} ({self.status})"
+
+
+#  Provider event identities that have been applied once
+class ProcessedEvent(models.Model):
+    """One row per applied event key, e.g. ``mpesa_stk:<CheckoutRequestID>``; the unique key rejects redeliveries."""
+    key = models.CharField(max_length=150, unique=True)
+    event = models.ForeignKey(InboundEvent, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+
 #  M-Pesa STK Push
 class MpesaSTKRequest(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     checkout_request_id = models.CharField(max_length=100, unique=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     phone = models.CharField(max_length=20, null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)   
\ No newline at end of file
+    created_at = models.DateTimeField(auto_now_add=True)   
+
+#  Double-entry ledger (source of truth for wallet balances)
+class LedgerEntry(models.Model):
+    """A journal: one balanced group of postings (debits == credits per currency)."""
+    entry_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Entry {self.entry_id} - {self.description}"
+
+
+class Posting(models.Model):
+    DIRECTION_CHOICES = [
+        ('DEBIT', 'Debit'),
+        ('CREDIT', 'Credit'),
+    ]
+
+    entry = models.ForeignKey(LedgerEntry, on_delete=models.CASCADE, related_name='postings')
+    # Set for wallet postings; system accounts (external:mpesa, clearing:fx, ...) have no wallet.
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='postings', null=True, blank=True)
+    account = models.CharField(max_length=50)
+    direction = models.CharField(max_length=6, choices=DIRECTION_CHOICES)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=3, choices=CURRENCY_CHOICES, default='KES')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', 'id'], name='posting_wallet_id_idx'),
+            models.Index(fields=['wallet', 'created_at'], name='posting_wallet_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.direction} {self.account} {self.amount} {self.currency}"
+
+
+class BalanceSnapshot(models.Model):
+    """Wallet balance as of ``last_posting_id``; balance queries replay only the tail after it."""
+    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='snapshots')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    last_posting_id = models.BigIntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['wallet', '-taken_at'], name='snapshot_wallet_taken_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.wallet} @ {self.taken_at}: {self.balance}"
+
+
+#  Exchange rates written by the refresh_fx_rates command
+class FxRate(models.Model):
+    """Rate of ``currency`` against ``base``; every row written by one refresh shares ``version``."""
+    version = models.PositiveBigIntegerField()
+    base = models.CharField(max_length=3)
+    currency = models.CharField(max_length=3)
+    rate = models.DecimalField(max_digits=24, decimal_places=10)
+    provider = models.CharField(max_length=30, blank=True, default='')
+    fetched_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['version', 'currency'], name='fxrate_version_currency_uniq'),
+        ]
+
+    def __str__(self):
+        return f"v{self.version} 1 {self.base} = {self.rate} {self.currency}"
+
+
+#  Flutterwave bank directory written by the refresh_banks command
+class Bank(models.Model):
+    """A transfer destination bank; ``code`` is the ``account_bank`` Flutterwave expects."""
+    country = models.CharField(max_length=2)
+    code = models.CharField(max_length=20)
+    name = models.CharField(max_length=150)
+    flutterwave_id = models.PositiveIntegerField(null=True, blank=True)
+    # Banks missing from the latest refresh are kept but no longer offered
+    active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['country', 'code'], name='bank_country_code_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.country} {self.code} {self.name}"
+
+
+#  Rate locked by convert_preview and consumed by one transfer
+class FxQuote(models.Model):
+    quote_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='fx_quotes')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency_from = models.CharField(max_length=3, choices=CURRENCY_CHOICES)
+    currency_to = models.CharField(max_length=3, choices=CURRENCY_CHOICES)
+    converted_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    rate = models.DecimalField(max_digits=18, decimal_places=8)
+    fx_rate_version = models.PositiveBigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    consumed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.quote_id}: {self.amount} {self.currency_from} -> {self.converted_amount} {self.currency_to}"
+
+
+#  Idempotency keys for money-moving endpoints
+class IdempotencyKey(models.Model):
+    STATUS_CHOICES = [
+        ('IN_PROGRESS', 'In progress'),
+        ('COMPLETED', 'Completed'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    key = models.CharField(max_length=255)
+    endpoint = models.CharField(max_length=100)
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='IN_PROGRESS')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    # Lease of the request running under an IN_PROGRESS key; a later request may take over once it passes
+    locked_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='idempotency_user_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.endpoint} {self.key} ({self.status})"
@@ -2,14 +2,34 @@ import requests
 import base64
 import logging
 from datetime import datetime
+
+import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.core.cache import cache
+
+from . import singleflight
+from .http_client import AsyncProviderClient, ProviderClient
 
 logger = logging.getLogger(__name__)
 
+client = ProviderClient("mpesa", settings.MPESA_BASE_URL)
+aclient = AsyncProviderClient("mpesa", settings.MPESA_BASE_URL)
+
+STK_PUSH_URL = "/mpesa/stkpush/v1/processrequest"
+STK_QUERY_URL = "/mpesa/stkpushquery/v1/query"
+B2C_PAYMENT_URL = "/mpesa/b2c/v1/paymentrequest"
+
+TOKEN_CACHE_KEY = "mpesa_access_token"
+# Refresh this many seconds before Safaricom's expires_in runs out
+TOKEN_EXPIRY_MARGIN = getattr(settings, "MPESA_TOKEN_EXPIRY_MARGIN", 60)
+
+
 def generate_access_token():
-    url = f"{settings.MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
+    """Request a new OAuth token; returns (token, expires_in) or None."""
+    url = "/oauth/v1/generate?grant_type=client_credentials"
     try:
-        response = requests.get(url, auth=(settings.MPESA_CONSUMER_KEY, settings.MPESA_CONSUMER_SECRET), timeout=10)
+        response = client.get(url, auth=(settings.MPESA_CONSUMER_KEY, settings.MPESA_CONSUMER_SECRET))
         logger.info("MPesa token request: %s - status %s", url, response.status_code)
         data = response.json()
         if response.status_code != 200:
@@ -19,12 +39,79 @@ def generate_access_token():
         if not token:
             logger.warning("No access_token in response: %s", data)
             return None
-        return token
+        return token, int(data.get('expires_in') or 3599)
     except Exception as e:
         logger.exception("Error generating M-Pesa access token: %s", e)
         return None
 
 
+def _refresh_access_token():
+    result = generate_access_token()
+    if not result:
+        return None
+    token, expires_in = result
+    cache.set(TOKEN_CACHE_KEY, token, max(expires_in - TOKEN_EXPIRY_MARGIN, 1))
+    return token
+
+
+def get_access_token():
+    """Cached OAuth token; concurrent misses share one token request (see wallet/singleflight.py)."""
+    token = cache.get(TOKEN_CACHE_KEY)
+    if token:
+        return token
+    try:
+        return singleflight.do(TOKEN_CACHE_KEY, _refresh_access_token, recheck=lambda: cache.get(TOKEN_CACHE_KEY))
+    except singleflight.SingleFlightTimeout:
+        logger.warning("Timed out waiting for M-Pesa access token refresh")
+        return None
+
+
+def invalidate_access_token(token):
+    """Drop ``token`` from the cache unless another worker has already replaced it."""
+    if cache.get(TOKEN_CACHE_KEY) == token:
+        cache.delete(TOKEN_CACHE_KEY)
+
+
+def _authorized_post(url, payload):
+    """POST with the cached token; on 401 refresh the token and retry once. Returns None without a token."""
+    token = get_access_token()
+    if not token:
+        return None
+    response = client.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    if response.status_code == 401:
+        logger.info("M-Pesa rejected the cached access token; refreshing")
+        invalidate_access_token(token)
+        token = get_access_token()
+        if not token:
+            return None
+        response = client.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    return response
+
+
+async def aget_access_token():
+    """Async ``get_access_token``; a cache miss refreshes through the sync single-flight path."""
+    token = await cache.aget(TOKEN_CACHE_KEY)
+    if token:
+        return token
+    return await sync_to_async(get_access_token, thread_sensitive=False)()
+
+
+async def _aauthorized_post(url, payload):
+    """Async ``_authorized_post``."""
+    token = await aget_access_token()
+    if not token:
+        return None
+    response = await aclient.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    if response.status_code == 401:
+        logger.info("M-Pesa rejected the cached access token; refreshing")
+        await sync_to_async(invalidate_access_token)(token)
+        token = await aget_access_token()
+        if not token:
+            return None
+        response = await aclient.post(url, json=payload, headers={"Authorization": f"Bearer {token}"})
+    return response
+
+
 def generate_password():
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
     data = settings.MPESA_SHORTCODE + settings.MPESA_PASSKEY + timestamp
@@ -32,18 +119,9 @@ def generate_password():
     return encoded, timestamp
 
 
-def stk_push(phone, amount, account_reference="Wallet Deposit"):
-    token = generate_access_token()
-    if not token:
-        return {"error": "Failed to generate access token"}
-
+def _stk_payload(phone, amount, account_reference):
     password, timestamp = generate_password()
-
-    url = f"{settings.MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
-    
-    headers = {"Authorization": f"Bearer {token}"}
-
-    payload = {
+    return {
         "BusinessShortCode": settings.MPESA_SHORTCODE,
         "Password": password,
         "Timestamp": timestamp,
@@ -57,63 +135,82 @@ def stk_push(phone, amount, account_reference="Wallet Deposit"):
         "TransactionDesc": "Wallet Funding"
     }
 
+
+def _stk_result(response):
+    if response is None:
+        return {"error": "Failed to generate access token"}
+    logger.info("STK push response status: %s", response.status_code)
+    try:
+        data = response.json()
+    except ValueError:
+        data = {"error": "Invalid JSON in STK response", "text": response.text}
+        logger.warning("Invalid JSON response from STK push: %s", response.text)
+    logger.info("STK push response body: %s", data)
+
+    # Return the parsed response or an error wrapper
+    if response.status_code not in (200, 201):
+        return {"error": "STK push failed", "status": response.status_code, "response": data}
+
+    return data
+
+
+def stk_push(phone, amount, account_reference="Wallet Deposit"):
+    payload = _stk_payload(phone, amount, account_reference)
     try:
         logger.info("STK push payload: %s", payload)
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
-        logger.info("STK push response status: %s", response.status_code)
-        try:
-            data = response.json()
-        except ValueError:
-            data = {"error": "Invalid JSON in STK response", "text": response.text}
-            logger.warning("Invalid JSON response from STK push: %s", response.text)
-        logger.info("STK push response body: %s", data)
-
-        # Return the parsed response or an error wrapper
-        if response.status_code not in (200, 201):
-            return {"error": "STK push failed", "status": response.status_code, "response": data}
-
-        return data
+        return _stk_result(_authorized_post(STK_PUSH_URL, payload))
     except requests.exceptions.RequestException as e:
         logger.exception("STK push request exception: %s", e)
         return {"error": str(e)}
 
-#--- M-Pesa Withdrawal ---
-def mpesa_withdraw(phone, amount):
+
+async def astk_push(phone, amount, account_reference="Wallet Deposit"):
+    payload = _stk_payload(phone, amount, account_reference)
     try:
-        token = generate_access_token()
-
-        url = f"{settings.MPESA_BASE_URL}/mpesa/b2c/v1/paymentrequest"
-        headers = {"Authorization": f"Bearer {token}"}
-
-        payload = {
-            "InitiatorName": getattr(settings, 'MPESA_B2C_INITIATOR_NAME', 'testapi'),
-            "SecurityCredential": getattr(settings, 'MPESA_B2C_SECURITY_CREDENTIAL', 'Safaricom111!'),
-            "CommandID": "BusinessPayment",
-            "Amount": int(amount),
-            "PartyA": getattr(settings, 'MPESA_B2C_SHORTCODE', '600000'),
-            "PartyB": phone,
-            "Remarks": "Wallet Withdrawal",
-            "QueueTimeOutURL": getattr(settings, 'MPESA_B2C_TIMEOUT_URL', 'https://dierdre-nondialyzing-asthmatically.ngrok-free.dev/mpesa/b2c/timeout/'),
-            "ResultURL": getattr(settings, 'MPESA_B2C_RESULT_URL', 'https://dierdre-nondialyzing-asthmatically.ngrok-free.dev/mpesa/b2c/result/'),
-            "Occasion": "withdrawal"
-        }
-        print("B2C Callback payload:", payload)
-
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Request Exception: {e}")
-        return {"error": str(e)}
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error: {e}")
-        return {"error": str(e)}
-    except requests.exceptions.ConnectionError as e:
-        print(f"Connection Error: {e}")
-        return {"error": str(e)}
-    except requests.exceptions.Timeout as e:
-        print(f"Timeout Error: {e}")
+        logger.info("STK push payload: %s", payload)
+        return _stk_result(await _aauthorized_post(STK_PUSH_URL, payload))
+    except httpx.HTTPError as e:
+        logger.exception("STK push request exception: %s", e)
         return {"error": str(e)}
-    except Exception as e:
-        print(f"General Exception: {e}")
+
+def stk_query(checkout_request_id):
+    """Ask Safaricom for the result of an STK push; returns the response body or {"error": ...}."""
+    password, timestamp = generate_password()
+    payload = {
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id,
+    }
+    try:
+        response = _authorized_post(STK_QUERY_URL, payload)
+        if response is None:
+            return {"error": "Failed to generate access token"}
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning("STK query for %s failed: %s", checkout_request_id, e)
         return {"error": str(e)}
+    if response.status_code != 200:
+        # Safaricom answers 500 "The transaction is being processed" until the payer responds
+        return {"error": data.get("errorMessage") or "STK query failed", "status": response.status_code, "response": data}
+    return data
+
+#--- M-Pesa Withdrawal ---
+def _b2c_payload(phone, amount):
+    return {
+        "InitiatorName": getattr(settings, 'MPESA_B2C_INITIATOR_NAME', 'testapi'),
+        "SecurityCredential": getattr(settings, 'MPESA_B2C_SECURITY_CREDENTIAL', 'Safaricom111!'),
+        "CommandID": "BusinessPayment",
+        "Amount": int(amount),
+        "PartyA": getattr(settings, 'MPESA_B2C_SHORTCODE', '600000'),
+        "PartyB": phone,
+        "Remarks": "Wallet Withdrawal",
+        "QueueTimeOutURL": getattr(settings, 'MPESA_B2C_TIMEOUT_URL', 'https://dierdre-nondialyzing-asthmatically.ngrok-free.dev/mpesa/b2c/timeout/'),
+        "ResultURL": getattr(settings, 'MPESA_B2C_RESULT_URL', 'https://dierdre-nondialyzing-asthmatically.ngrok-free.dev/mpesa/b2c/result/'),
+        "Occasion": "withdrawal"
+    }
+
+
+def b2c_request(phone, amount):
+    """Send a B2C payment request and return the raw response (None without a token)."""
+    return _authorized_post(B2C_PAYMENT_URL, _b2c_payload(phone, amount))
@@ -0,0 +1,63 @@
+# wallet/pagination.py
+"""
+Keyset (cursor) pagination for transaction history.
+
+Pages are ordered by ``(timestamp, id)`` descending and the cursor encodes
+the last row of the previous page, so fetching page N costs the same index
+range scan as page 1 (see the ``txn_wallet_ts_id_idx`` index) instead of an
+OFFSET over the wallet's whole history.
+"""
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor cannot be decoded."""
+
+
+def encode_cursor(timestamp, pk):
+    raw = f"{timestamp.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def parse_page_size(raw):
+    """Clamp a requested page size to ``1..MAX_PAGE_SIZE``."""
+    try:
+        size = int(raw)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def keyset_page(queryset, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """Return ``(rows, next_cursor)`` for the page after ``cursor``.
+
+    ``next_cursor`` is None on the last page.
+    """
+    queryset = queryset.order_by("-timestamp", "-id")
+    if cursor:
+        timestamp, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.timestamp, last.pk)
+    return rows, next_cursor
@@ -0,0 +1,72 @@
+# wallet/payments.py
+"""
+Database side of provider-backed payments.
+
+The sync views in ``views.py`` and the ASGI views in ``async_views.py`` call
+the provider differently but record the outcome the same way; these helpers
+hold that shared bookkeeping. They are plain sync functions - async callers
+wrap them in ``sync_to_async``.
+"""
+import logging
+from decimal import Decimal
+
+from .models import MpesaSTKRequest, Transaction, Wallet, WalletTransaction
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------- M-PESA STK PUSH ----------------
+def record_stk_push(user, phone, amount, res):
+    """Persist the STK request mapping and pending records once Safaricom accepts the push."""
+    try:
+        ref = res.get('CheckoutRequestID') or res.get('MerchantRequestID')
+        if res.get('ResponseCode') != '0' or not ref:
+            return
+
+        try:
+            amount_dec = Decimal(str(amount))
+        except Exception:
+            amount_dec = Decimal('0.00')
+
+        # The callback maps CheckoutRequestID back to the user through this row
+        MpesaSTKRequest.objects.get_or_create(
+            checkout_request_id=ref,
+            defaults={'user': user, 'amount': amount_dec, 'phone': phone},
+        )
+        if not WalletTransaction.objects.filter(reference=ref).exists():
+            WalletTransaction.objects.create(
+                user=user,
+                phone=phone,
+                amount=amount_dec,
+                type='deposit',
+                status='pending',
+                reference=ref,
+            )
+        # Pending Transaction so the deposit appears in history straight away
+        wallet_obj, _ = Wallet.objects.get_or_create(user=user)
+        if not Transaction.objects.filter(provider='MPESA', provider_reference=ref).exists():
+            Transaction.objects.create(
+                wallet=wallet_obj,
+                transaction_type='DEPOSIT',
+                amount=amount_dec,
+                currency_from='KES',
+                currency_to=getattr(wallet_obj, 'currency', 'KES'),
+                converted_amount=amount_dec,
+                status='PENDING',
+                provider='MPESA',
+                provider_reference=ref,
+                description=f'M-Pesa deposit reference {ref} initiated',
+            )
+    except Exception:
+        logger.exception('Failed to record STK push for pending transaction creation: %s', res)
+
+
+# ---------------- FLUTTERWAVE DEPOSIT ----------------
+def record_flutterwave_deposit(user, amount, tx_ref):
+    WalletTransaction.objects.create(
+        user=user,
+        type="deposit",
+        amount=Decimal(str(amount)),
+        reference=tx_ref,
+        status="pending",
+    )
@@ -0,0 +1,317 @@
+# wallet/payouts.py
+"""
+Transactional outbox for M-Pesa B2C and Flutterwave payouts.
+
+Withdrawal views call ``enqueue_mpesa_withdrawal`` /
+``enqueue_flutterwave_withdrawal``, which debit the wallet and write the
+pending ``WalletTransaction``, ``Transaction`` and ``PayoutOutbox`` rows in
+one transaction. The request never waits on the provider, and a crash can
+no longer leave money moved with nothing recorded.
+
+The ``run_payouts`` command drains the outbox. Due rows are claimed with
+``SELECT ... FOR UPDATE SKIP LOCKED`` (several workers can run side by side)
+and leased as SENDING, then sent from a bounded thread pool, throttled per
+provider. Each send ends in one of:
+
+* accepted  -> SENT; the B2C result callback or transfer webhook settles it
+* rejected  -> FAILED and the reservation is refunded in the same transaction
+* transient -> back to PENDING with jittered exponential backoff (the request
+  never reached the provider: connection errors, 401/429/503, no token);
+  FAILED and refunded after ``PAYOUT_MAX_ATTEMPTS``
+* ambiguous -> read timeouts and other 5xx may have been processed.
+  Flutterwave rows are resent, since it deduplicates on ``reference`` (a
+  refused resend is looked up by reference and recorded against the
+  existing transfer), but are never refunded automatically once flagged
+  ``maybe_sent``. M-Pesa B2C has no such key, so those rows become UNKNOWN
+  for manual review.
+
+A lease that expires mid-send (worker killed) is treated as ambiguous.
+"""
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import flutterwave, ledger, mpesa
+from .models import PayoutOutbox, Transaction, Wallet, WalletTransaction
+from .utils import mpesa_msisdn
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = getattr(settings, "PAYOUT_MAX_ATTEMPTS", 5)
+RETRY_BACKOFF = getattr(settings, "PAYOUT_RETRY_BACKOFF", 30)
+LEASE_SECONDS = getattr(settings, "PAYOUT_LEASE_SECONDS", 120)
+# Sends per second, per provider and per worker process
+RATE_LIMITS = getattr(settings, "PAYOUT_RATE_LIMITS", {"MPESA": 5, "FLUTTERWAVE": 10})
+
+ACCOUNTS = {"MPESA": ledger.MPESA_ACCOUNT, "FLUTTERWAVE": ledger.FLUTTERWAVE_ACCOUNT}
+LABELS = {"MPESA": "M-Pesa", "FLUTTERWAVE": "Flutterwave"}
+
+
+class PayoutRetry(Exception):
+    """The provider did not receive the payout; safe to send again."""
+
+
+class PayoutRejected(Exception):
+    """The provider refused the payout; the reservation is refunded."""
+
+
+class InvalidPayout(Exception):
+    """The payout cannot be sent as requested; nothing is reserved."""
+
+
+# ---------------- ENQUEUE ----------------
+def _enqueue(user, provider, amount, destination, payload):
+    wallet = Wallet.objects.get(user=user)
+    reference = str(uuid.uuid4())
+    label = LABELS[provider]
+    with transaction.atomic():
+        ledger.debit(wallet, amount, ACCOUNTS[provider], f'{label} withdrawal to {destination}')
+        wallet_tx = WalletTransaction.objects.create(
+            user=user,
+            phone=destination,
+            type='withdraw',
+            amount=amount,
+            status='pending',
+            reference=reference,
+        )
+        Transaction.objects.create(
+            wallet=wallet,
+            transaction_type='WITHDRAWAL',
+            amount=amount,
+            currency_from=wallet.currency,
+            currency_to=wallet.currency,
+            converted_amount=amount,
+            status='PENDING',
+            provider=provider,
+            provider_reference=reference,
+            description=f'{label} withdraw reference {reference} to {destination}',
+        )
+        PayoutOutbox.objects.create(wallet_transaction=wallet_tx, provider=provider, payload=payload)
+    return wallet, wallet_tx
+
+
+def enqueue_mpesa_withdrawal(user, phone, amount):
+    """Reserve ``amount`` and queue a B2C payout to E.164 ``phone``; raises ``InsufficientFunds``."""
+    # B2C pays whole shillings only; reserving cents it cannot send would keep them
+    if Decimal(str(amount)) % 1:
+        raise InvalidPayout("M-Pesa withdrawals must be a whole number of shillings.")
+    return _enqueue(user, 'MPESA', amount, phone, {'msisdn': mpesa_msisdn(phone)})
+
+
+def enqueue_flutterwave_withdrawal(user, amount, account_bank, account_number, narration):
+    """Reserve ``amount`` and queue a bank transfer; raises ``InsufficientFunds``."""
+    payload = {
+        'account_bank': str(account_bank),
+        'account_number': str(account_number),
+        'narration': narration,
+    }
+    return _enqueue(user, 'FLUTTERWAVE', amount, str(account_number), payload)
+
+
+# ---------------- CLAIMING ----------------
+def claim_due(limit):
+    """Lease up to ``limit`` due rows to this worker; other workers skip them."""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            PayoutOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING', next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')
+            .values_list('id', flat=True)[:limit]
+        )
+        PayoutOutbox.objects.filter(pk__in=ids).update(
+            status='SENDING',
+            locked_until=now + timedelta(seconds=LEASE_SECONDS),
+            attempts=F('attempts') + 1,
+        )
+    return list(PayoutOutbox.objects.filter(pk__in=ids).select_related('wallet_transaction').order_by('id'))
+
+
+def recover_expired_leases():
+    """Handle rows whose worker died mid-send; returns how many were found."""
+    expired = list(
+        PayoutOutbox.objects.filter(status='SENDING', locked_until__lt=timezone.now())
+        .select_related('wallet_transaction')
+    )
+    for outbox in expired:
+        logger.warning("Payout %s lease expired mid-send", outbox.wallet_transaction.reference)
+        _ambiguous(outbox, "Lease expired before the send finished")
+    return len(expired)
+
+
+# ---------------- RATE LIMITING ----------------
+class RateLimiter:
+    """Token bucket shared by the worker's threads."""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters = {provider: RateLimiter(rate) for provider, rate in RATE_LIMITS.items()}
+
+
+# ---------------- SENDING ----------------
+def _check_status(response):
+    if response.status_code in (401, 429, 503):
+        raise PayoutRetry(f"HTTP {response.status_code}")
+    if response.status_code >= 500:
+        # May have been processed before the error; see _ambiguous.
+        raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+    if response.status_code >= 400:
+        raise PayoutRejected(response.text[:500])
+
+
+def _send_mpesa(outbox):
+    wallet_tx = outbox.wallet_transaction
+    response = mpesa.b2c_request(outbox.payload['msisdn'], wallet_tx.amount)
+    if response is None:
+        raise PayoutRetry("Failed to generate access token")
+    _check_status(response)
+    data = response.json()
+    if data.get("ResponseCode") != "0":
+        raise PayoutRejected(str(data))
+    # The B2C result callback matches on these
+    return data, {
+        'conversation_id': data.get('ConversationID'),
+        'originator_conversation_id': data.get('OriginatorConversationID'),
+    }
+
+
+def _send_flutterwave(outbox):
+    reference = outbox.wallet_transaction.reference
+    # Development fallback: avoids Flutterwave's IP whitelisting when testing locally
+    if settings.DEBUG and os.getenv('FLW_MOCK_TRANSFERS', '1') == '1':
+        return {'status': 'success', 'data': {'id': 'mock', 'reference': reference}}, {}
+
+    response = flutterwave.transfer_request(
+        outbox.wallet_transaction.amount,
+        outbox.payload['account_bank'],
+        outbox.payload['account_number'],
+        reference,
+        narration=outbox.payload.get('narration') or "Wallet Withdrawal",
+    )
+    if outbox.attempts > 1 and response.status_code == 400:
+        # The refusal may be of a duplicate of an earlier attempt that got
+        # through; only a transfer Flutterwave holds under this reference counts.
+        transfer = flutterwave.find_transfer(reference)
+        if transfer:
+            return {'status': 'success', 'duplicate': True, 'data': transfer}, {}
+    _check_status(response)
+    data = response.json()
+    if data.get("status") != "success":
+        raise PayoutRejected(str(data))
+    return data, {}
+
+
+SENDERS = {"MPESA": _send_mpesa, "FLUTTERWAVE": _send_flutterwave}
+
+
+def process(outbox):
+    """Send one leased row and record the outcome; returns the new status."""
+    reference = outbox.wallet_transaction.reference
+    limiter = _limiters.get(outbox.provider)
+    if limiter:
+        limiter.acquire()
+    try:
+        response, fields = SENDERS[outbox.provider](outbox)
+    except PayoutRetry as e:
+        return _retry_later(outbox, str(e))
+    except PayoutRejected as e:
+        logger.warning("Payout %s rejected: %s", reference, e)
+        return _fail(outbox, str(e))
+    except requests.exceptions.ReadTimeout as e:
+        return _ambiguous(outbox, str(e))
+    except requests.exceptions.ConnectionError as e:
+        # Includes ConnectTimeout: nothing reached the provider.
+        return _retry_later(outbox, str(e))
+    except Exception as e:
+        logger.exception("Payout %s send failed", reference)
+        return _ambiguous(outbox, str(e))
+    return _mark_sent(outbox, response, fields)
+
+
+# ---------------- OUTCOMES ----------------
+# Every transition is conditional on the row still being leased, so a worker
+# whose lease already expired cannot overwrite what recovery decided.
+def _mark_sent(outbox, response, fields):
+    with transaction.atomic():
+        if not PayoutOutbox.objects.filter(pk=outbox.pk, status='SENDING').update(
+                status='SENT', response=response, locked_until=None, last_error=''):
+            return None
+        if fields:
+            WalletTransaction.objects.filter(pk=outbox.wallet_transaction_id).update(**fields)
+    return 'SENT'
+
+
+def _fail(outbox, error):
+    """Mark FAILED and refund the reservation unless the withdrawal was already settled."""
+    wallet_tx = outbox.wallet_transaction
+    with transaction.atomic():
+        if not PayoutOutbox.objects.filter(pk=outbox.pk, status='SENDING').update(
+                status='FAILED', locked_until=None, last_error=error):
+            return None
+        if WalletTransaction.objects.filter(pk=wallet_tx.pk, status='pending').update(status='failed'):
+            ledger.credit(Wallet.objects.get(user_id=wallet_tx.user_id), wallet_tx.amount,
+                          ACCOUNTS[outbox.provider],
+                          f'{LABELS[outbox.provider]} withdrawal {wallet_tx.reference} failed')
+            Transaction.objects.filter(provider=outbox.provider, provider_reference=wallet_tx.reference).update(
+                status='FAILED', updated_at=timezone.now()
+            )
+    return 'FAILED'
+
+
+def _unknown(outbox, error):
+    logger.error("Payout %s outcome unknown, needs manual review: %s", outbox.wallet_transaction.reference, error)
+    updated = PayoutOutbox.objects.filter(pk=outbox.pk, status='SENDING').update(
+        status='UNKNOWN', locked_until=None, last_error=error
+    )
+    return 'UNKNOWN' if updated else None
+
+
+def _retry_later(outbox, error, maybe_sent=False):
+    maybe_sent = maybe_sent or outbox.maybe_sent
+    if outbox.attempts >= MAX_ATTEMPTS:
+        logger.warning("Payout %s gave up after %d attempts: %s", outbox.wallet_transaction.reference, outbox.attempts, error)
+        # Never refund a payout an earlier attempt may have delivered.
+        return _unknown(outbox, error) if maybe_sent else _fail(outbox, error)
+    delay = RETRY_BACKOFF * 2 ** (outbox.attempts - 1) + random.uniform(0, RETRY_BACKOFF)
+    updated = PayoutOutbox.objects.filter(pk=outbox.pk, status='SENDING').update(
+        status='PENDING',
+        next_attempt_at=timezone.now() + timedelta(seconds=delay),
+        locked_until=None,
+        last_error=error,
+        maybe_sent=maybe_sent,
+    )
+    return 'PENDING' if updated else None
+
+
+def _ambiguous(outbox, error):
+    if outbox.provider == 'FLUTTERWAVE':
+        return _retry_later(outbox, error, maybe_sent=True)
+    return _unknown(outbox, error)
@@ -0,0 +1,220 @@
+# wallet/reconcile.py
+"""
+Reconcilers for deposits and payouts whose provider callback never arrived.
+
+Both walk pending ``WalletTransaction`` rows in keyset chunks
+(``id > last_id`` on the pending partial index) and check them with the
+provider from a bounded, rate-limited thread pool. Every final answer is
+stored as a synthetic callback and applied through ``events.record``, so
+it runs the same dedup and handler code as the real callback. A real
+callback that turns up later is dropped or finds nothing pending. A run can
+be resumed with ``after_id`` from the last id handed to ``progress``.
+
+* ``reconcile_stk``: pending M-Pesa deposits, via the STK Push Query API.
+* ``reconcile_flutterwave``: sent Flutterwave transfers, via
+  ``verify_withdrawal``. A failed transfer is refunded in the transaction
+  that marks it failed.
+"""
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import events, flutterwave, mpesa
+from .models import MpesaSTKRequest, WalletTransaction
+from .payouts import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def pending_chunks(queryset, chunk_size, after_id=0):
+    """Yield lists of rows from ``queryset`` in ascending id order, ``chunk_size`` at a time."""
+    last_id = after_id
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).order_by('id')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+
+
+class Report:
+    """Outcome counts and throughput for one reconciler run."""
+
+    def __init__(self):
+        self.outcomes = Counter()
+        self.started = time.monotonic()
+
+    @property
+    def checked(self):
+        return sum(self.outcomes.values())
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        rate = self.checked / self.elapsed if self.elapsed else 0.0
+        counts = ", ".join(f"{k}={v}" for k, v in sorted(self.outcomes.items())) or "nothing to do"
+        return f"Checked {self.checked} in {self.elapsed:.1f}s ({rate:.1f}/s): {counts}"
+
+    @property
+    def unresolved(self):
+        return self.outcomes["stuck"] + self.outcomes["error"]
+
+
+def _run(queryset, check, chunk_size, workers, rate, limit, after_id=0, progress=None):
+    report = Report()
+    limiter = RateLimiter(rate) if rate else None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in pending_chunks(queryset, chunk_size, after_id):
+            if limit is not None:
+                chunk = chunk[:max(0, limit - report.checked)]
+                if not chunk:
+                    break
+            for outcome in pool.map(lambda row: check(row, limiter), chunk):
+                report.outcomes[outcome] += 1
+            # Every row up to here has been checked; safe to resume after it.
+            if progress:
+                progress(chunk[-1].id, report)
+    return report
+
+
+def _apply(source, payload, reference):
+    """Apply a synthetic callback; returns the event status, or None when already applied."""
+    try:
+        event = events.record(source, payload, apply=True)
+    except Exception:
+        logger.exception("Failed to finalise %s", reference)
+        return 'FAILED'
+    return None if event is None or event.status == 'DUPLICATE' else event.status
+
+
+# ---------------- M-PESA STK ----------------
+# Query ResultCodes that settle a push: paid, insufficient balance, cancelled,
+# payer unreachable, wrong PIN. Anything else (4999 "still under processing")
+# is retried on the next pass.
+STK_FINAL_RESULT_CODES = {0, 1, 1032, 1037, 2001}
+
+
+def pending_stk_deposits(older_than):
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return WalletTransaction.objects.filter(
+        Exists(MpesaSTKRequest.objects.filter(checkout_request_id=OuterRef('reference'))),
+        type='deposit',
+        status='pending',
+        timestamp__lte=cutoff,
+    )
+
+
+def _stk_callback_payload(checkout_request_id, result):
+    """Shape an STK query answer like the callback Safaricom failed to deliver."""
+    return {
+        "Body": {
+            "stkCallback": {
+                "MerchantRequestID": result.get("MerchantRequestID"),
+                "CheckoutRequestID": checkout_request_id,
+                "ResultCode": int(result["ResultCode"]),
+                "ResultDesc": result.get("ResultDesc"),
+            }
+        },
+        "source": "stk_query",
+    }
+
+
+def _stk_result_code(result):
+    try:
+        return int(result.get("ResultCode"))
+    except (TypeError, ValueError):
+        return None
+
+
+def reconcile_stk_deposit(wallet_tx, limiter=None):
+    """Query one pending deposit and finalise it if Safaricom has an answer; returns the outcome."""
+    if limiter:
+        limiter.acquire()
+    result = mpesa.stk_query(wallet_tx.reference)
+    result_code = _stk_result_code(result)
+    if result_code not in STK_FINAL_RESULT_CODES:
+        # Still waiting on the payer (e.g. 4999), or the query itself failed.
+        # A synthetic callback would claim the dedup key and drop the real one.
+        logger.info("STK %s still unresolved: %s", wallet_tx.reference,
+                    result.get("error") or result.get("ResultDesc") or result_code)
+        return 'stuck'
+    status = _apply('MPESA_STK', _stk_callback_payload(wallet_tx.reference, result), wallet_tx.reference)
+    if status is None:
+        return 'already_final'
+    if status != 'DONE':
+        return 'error'
+    return 'success' if result_code == 0 else 'failed'
+
+
+def reconcile_stk(older_than=120, chunk_size=200, workers=8, rate=10, limit=None, after_id=0, progress=None):
+    """Reconcile pending STK deposits; returns a ``Report``."""
+    return _run(pending_stk_deposits(older_than), reconcile_stk_deposit,
+                chunk_size, workers, rate, limit, after_id, progress)
+
+
+# ---------------- FLUTTERWAVE TRANSFERS ----------------
+TRANSFER_EVENTS = {"SUCCESSFUL": "transfer.successful", "FAILED": "transfer.failed"}
+
+
+def pending_flutterwave_withdrawals(older_than):
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    # Only SENT payouts have a Flutterwave transfer id to verify
+    return WalletTransaction.objects.filter(
+        type='withdraw',
+        status='pending',
+        timestamp__lte=cutoff,
+        payout__provider='FLUTTERWAVE',
+        payout__status='SENT',
+    ).select_related('payout')
+
+
+def _transfer_id(outbox):
+    data = (outbox.response or {}).get('data') or {}
+    return data.get('id')
+
+
+def reconcile_flutterwave_withdrawal(wallet_tx, limiter=None):
+    """Verify one sent transfer and settle or refund it if Flutterwave has a final status; returns the outcome."""
+    reference = wallet_tx.reference
+    transfer_id = _transfer_id(wallet_tx.payout)
+    if not transfer_id:
+        # No transfer id was recorded when it was sent; only the webhook can settle it
+        logger.info("Transfer %s has no Flutterwave id to verify", reference)
+        return 'stuck'
+    if limiter:
+        limiter.acquire()
+    try:
+        data = flutterwave.verify_withdrawal(transfer_id).get('data') or {}
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.warning("Verifying transfer %s (%s) failed: %s", reference, transfer_id, e)
+        return 'error'
+
+    if data.get('reference') and data['reference'] != reference:
+        logger.error("Transfer %s belongs to %s, not %s", transfer_id, data['reference'], reference)
+        return 'error'
+    event = TRANSFER_EVENTS.get(str(data.get('status') or '').upper())
+    if not event:
+        # NEW / PENDING: Flutterwave is still processing it
+        return 'stuck'
+
+    payload = {"event": event, "data": {**data, "reference": reference}, "source": "verify_withdrawal"}
+    status = _apply('FLUTTERWAVE', payload, reference)
+    if status is None:
+        return 'already_final'
+    if status != 'DONE':
+        return 'error'
+    return 'success' if event == "transfer.successful" else 'refunded'
+
+
+def reconcile_flutterwave(older_than=600, chunk_size=200, workers=8, rate=10, limit=None, after_id=0, progress=None):
+    """Reconcile sent Flutterwave withdrawals that are still pending; returns a ``Report``."""
+    return _run(pending_flutterwave_withdrawals(older_than), reconcile_flutterwave_withdrawal,
+                chunk_size, workers, rate, limit, after_id, progress)
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import Wallet, Transaction
+from .utils import normalize_msisdn
 
 # Get the custom user model
 User = get_user_model()
@@ -27,6 +28,11 @@ class RegisterSerializer(serializers.ModelSerializer):
         model = User
         fields = ['first_name', 'last_name', 'username', 'email', 'mobile', 'password', 'confirm_password', 'currency', 'pin', 'pin_confirm']
 
+    def validate_mobile(self, value):
+        if value and not normalize_msisdn(value):
+            raise serializers.ValidationError("Enter a valid phone number.")
+        return value
+
     def validate(self, data):
         if data.get('password') != data.get('confirm_password'):
             raise serializers.ValidationError({"password": "Passwords do not match."})
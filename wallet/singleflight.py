@@ -0,0 +1,114 @@
+# wallet/singleflight.py
+"""
+Single-flight: collapse concurrent loads of the same key into one.
+
+Within a process, the first caller for a key runs the loader and every
+concurrent caller waits on its ``Future``. When a ``recheck`` callable is
+given the leader also takes a short cache lock, so leaders in other worker
+processes poll ``recheck`` (usually a cache read of the value the winner
+stores) instead of loading a second time.
+
+``stats()`` reports, per key, how many calls reached the loader
+("upstream"), how many were served by another caller's load ("coalesced")
+and how many gave up waiting ("timeouts").
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+WAIT_TIMEOUT = getattr(settings, "SINGLEFLIGHT_WAIT_TIMEOUT", 5)
+LOCK_TTL = getattr(settings, "SINGLEFLIGHT_LOCK_TTL", 30)
+POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+_inflight = {}
+_stats = defaultdict(Counter)
+
+
+class SingleFlightTimeout(Exception):
+    """Raised when a caller waited ``timeout`` seconds for another caller's load."""
+
+
+def stats():
+    """Per-key counters: ``{key: {"upstream": n, "coalesced": n, "timeouts": n}}``."""
+    with _lock:
+        return {key: dict(counter) for key, counter in _stats.items()}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def _count(key, name):
+    with _lock:
+        _stats[key][name] += 1
+
+
+def do(key, fn, recheck=None, timeout=WAIT_TIMEOUT):
+    """Return ``fn()``, running it at most once at a time per ``key``."""
+    with _lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+
+    if not leader:
+        _count(key, "coalesced")
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            _count(key, "timeouts")
+            raise SingleFlightTimeout(f"Timed out waiting for {key}")
+
+    try:
+        result = _load(key, fn, recheck, timeout)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+def _load(key, fn, recheck, timeout):
+    if recheck is None:
+        _count(key, "upstream")
+        return fn()
+
+    lock_key = f"singleflight_{key}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    while not cache.add(lock_key, token, LOCK_TTL):
+        # Another process is loading; use its result as soon as it lands.
+        value = recheck()
+        if value is not None:
+            _count(key, "coalesced")
+            return value
+        if time.monotonic() >= deadline:
+            _count(key, "timeouts")
+            raise SingleFlightTimeout(f"Timed out waiting for {key}")
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        # The previous holder may have finished between our miss and the lock.
+        value = recheck()
+        if value is not None:
+            _count(key, "coalesced")
+            return value
+        _count(key, "upstream")
+        return fn()
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
@@ -0,0 +1,72 @@
+# wallet/sync.py
+"""
+Incremental "changes since" sync for the wallet frontend.
+
+A sync token encodes the wallet ``version`` the client last saw plus a
+``(updated_at, id)`` position in the wallet's ``Transaction`` rows. A sync
+call returns only rows created or changed after that position and the
+current balance, or nothing at all when neither moved.
+
+The position handed back never runs ahead of ``now - SYNC_LAG`` so rows
+written by transactions that commit slightly out of order are picked up on
+the next call; clients upsert rows by ``transaction_id``.
+"""
+import base64
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Transaction
+
+SYNC_BATCH_SIZE = getattr(settings, "WALLET_SYNC_BATCH_SIZE", 200)
+SYNC_LAG = timedelta(seconds=getattr(settings, "WALLET_SYNC_LAG_SECONDS", 2))
+
+
+class InvalidSyncToken(ValueError):
+    """Raised when a sync token cannot be decoded."""
+
+
+def encode_token(version, updated_at, pk):
+    stamp = updated_at.isoformat() if updated_at else ""
+    raw = f"{version}|{stamp}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        version, stamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return int(version), (datetime.fromisoformat(stamp) if stamp else None), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidSyncToken(f"Invalid sync token: {token}") from e
+
+
+def current_token(wallet):
+    """Token for a client that has just loaded the wallet's state in full."""
+    return encode_token(wallet.version, timezone.now() - SYNC_LAG, 0)
+
+
+def changes_since(wallet, token=None):
+    """Return ``(rows, next_token, has_more)``, or None when nothing changed since ``token``."""
+    version, updated_at, last_pk = decode_token(token) if token else (None, None, 0)
+
+    qs = Transaction.objects.filter(wallet=wallet).order_by("updated_at", "id")
+    if updated_at is not None:
+        qs = qs.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=last_pk))
+
+    rows = list(qs[:SYNC_BATCH_SIZE + 1])
+    has_more = len(rows) > SYNC_BATCH_SIZE
+    rows = rows[:SYNC_BATCH_SIZE]
+
+    if not rows and version == wallet.version:
+        return None
+
+    if rows:
+        updated_at, last_pk = rows[-1].updated_at, rows[-1].pk
+        horizon = timezone.now() - SYNC_LAG
+        if not has_more and updated_at > horizon:
+            updated_at, last_pk = horizon, 0
+
+    return rows, encode_token(wallet.version, updated_at, last_pk), has_more
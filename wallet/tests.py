@@ -1,3 +1,1289 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import itertools
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+import requests
+import urllib3
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (
+    banks, circuitbreaker, disbursement, events, flutterwave, fx, http_client, idempotency, ledger, mpesa,
+    payments, payouts, reconcile, singleflight, sync,
+)
+from .idempotency import idempotent, note_side_effect
+from .utils import normalize_msisdn
+from .models import (
+    Bank, CustomUser, FxQuote, FxRate, IdempotencyKey, InboundEvent, LedgerEntry, MpesaSTKRequest, OTP,
+    PayoutOutbox, ProcessedEvent, Transaction, Wallet, WalletTransaction,
+)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plan checks need PostgreSQL')
+class HotQueryPlanTests(TestCase):
+    """Fail if a hot lookup can only be answered with a sequential scan.
+
+    Sequential scans are disabled for the test transaction, so the planner
+    only picks one when no index can serve the query at all.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        users = CustomUser.objects.bulk_create([
+            CustomUser(username=f'user{i}', email=f'user{i}@example.com', mobile=f'2547000{i:05d}')
+            for i in range(200)
+        ])
+        wallets = Wallet.objects.bulk_create([Wallet(user=u) for u in users])
+        Transaction.objects.bulk_create([
+            Transaction(wallet=w, transaction_type='DEPOSIT', amount=Decimal('10.00'), status='SUCCESS')
+            for w in wallets for _ in range(5)
+        ])
+        WalletTransaction.objects.bulk_create([
+            WalletTransaction(
+                user=u,
+                phone=u.mobile,
+                amount=Decimal('10.00'),
+                type='withdraw' if i % 2 else 'deposit',
+                status='pending' if i % 10 == 0 else 'success',
+                reference=f'ref-{i}',
+            )
+            for i, u in enumerate(users)
+        ])
+        OTP.objects.bulk_create([OTP(user=u, code='123456') for u in users])
+        cls.user = users[0]
+        cls.wallet = wallets[0]
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertIndexScan(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan, plan)
+
+    def test_wallet_history(self):
+        self.assertIndexScan(Transaction.objects.filter(wallet=self.wallet).order_by('-timestamp', '-id')[:20])
+
+    def test_wallet_sync(self):
+        since = timezone.now() - timedelta(minutes=5)
+        self.assertIndexScan(
+            Transaction.objects.filter(wallet=self.wallet, updated_at__gt=since).order_by('updated_at', 'id')
+        )
+
+    def test_pending_wallet_transaction_by_reference(self):
+        self.assertIndexScan(WalletTransaction.objects.filter(reference='ref-0', status='pending'))
+
+    def test_stale_pending_stk_deposits(self):
+        self.assertIndexScan(
+            reconcile.pending_stk_deposits(older_than=120).filter(id__gt=0).order_by('id')[:200]
+        )
+
+    def test_stale_sent_flutterwave_withdrawals(self):
+        self.assertIndexScan(
+            reconcile.pending_flutterwave_withdrawals(older_than=600).filter(id__gt=0).order_by('id')[:200]
+        )
+
+    def test_transaction_by_provider_reference(self):
+        self.assertIndexScan(Transaction.objects.filter(provider='MPESA', provider_reference='ws_CO_123'))
+
+    def test_withdrawal_by_conversation_id(self):
+        self.assertIndexScan(WalletTransaction.objects.filter(conversation_id='AG_20191219_00005797af5d7d75f652'))
+
+    def test_withdrawal_by_originator_conversation_id(self):
+        self.assertIndexScan(WalletTransaction.objects.filter(originator_conversation_id='16740-34861180-1'))
+
+    def test_due_payouts(self):
+        self.assertIndexScan(
+            PayoutOutbox.objects.filter(status='PENDING', next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id').values_list('id', flat=True)[:50]
+        )
+
+    def test_expired_payout_leases(self):
+        self.assertIndexScan(PayoutOutbox.objects.filter(status='SENDING', locked_until__lt=timezone.now()))
+
+    def test_due_inbound_events(self):
+        self.assertIndexScan(
+            InboundEvent.objects.filter(status='PENDING', next_attempt_at__lte=timezone.now())
+            .order_by('next_attempt_at', 'id').values_list('id', flat=True)[:8]
+        )
+
+    def test_processed_event_by_key(self):
+        self.assertIndexScan(ProcessedEvent.objects.filter(key='mpesa_stk:ws_CO_123'))
+
+    def test_user_by_mobile(self):
+        self.assertIndexScan(CustomUser.objects.filter(mobile=self.user.mobile))
+
+    def test_user_by_e164_mobile(self):
+        self.assertIndexScan(CustomUser.objects.filter(mobile_e164='+254700000000'))
+
+    def test_latest_fx_rates(self):
+        self.assertIndexScan(FxRate.objects.order_by('-version').values_list('version', flat=True)[:1])
+        self.assertIndexScan(FxRate.objects.filter(version=1))
+
+    def test_active_banks_by_country(self):
+        self.assertIndexScan(Bank.objects.filter(country='KE', active=True).values('code', 'name', 'updated_at'))
+
+    def test_unverified_otp(self):
+        since = timezone.now() - timedelta(minutes=5)
+        self.assertIndexScan(
+            OTP.objects.filter(user=self.user, is_verified=False, created_at__gte=since).order_by('-created_at')[:1]
+        )
+
+
+_mobiles = itertools.count(10000000)
+
+
+def _wallet(username, balance='0.00', currency='KES'):
+    user = CustomUser.objects.create_user(
+        username=username, email=f'{username}@example.com', password=None, mobile=f'07{next(_mobiles)}'
+    )
+    wallet = Wallet.objects.get(user=user)
+    if wallet.currency != currency:
+        wallet.currency = currency
+        wallet.save(update_fields=['currency'])
+    if Decimal(balance) > 0:
+        ledger.credit(wallet, balance, ledger.EXTERNAL_ACCOUNT, 'Opening balance')
+    wallet.refresh_from_db()
+    return wallet
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.alice = _wallet('alice', '100.00')
+        self.bob = _wallet('bob')
+
+    def assertBalanced(self, entry):
+        totals = {}
+        for p in entry.postings.all():
+            totals.setdefault(p.currency, Decimal('0'))
+            totals[p.currency] += p.amount if p.direction == ledger.DEBIT else -p.amount
+        self.assertTrue(totals)
+        self.assertEqual(set(totals.values()), {Decimal('0')}, totals)
+
+    def test_overdraft_debit_is_rejected(self):
+        entries = LedgerEntry.objects.count()
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.debit(self.alice, '100.01', ledger.MPESA_ACCOUNT)
+        self.assertEqual(ledger.refresh_balance(self.alice), Decimal('100.00'))
+        self.assertEqual(LedgerEntry.objects.count(), entries)
+
+    def test_transfer_writes_balanced_postings(self):
+        entry = ledger.transfer(self.alice, self.bob, '40.00')
+        self.assertBalanced(entry)
+        self.assertEqual(ledger.refresh_balance(self.alice), Decimal('60.00'))
+        self.assertEqual(ledger.refresh_balance(self.bob), Decimal('40.00'))
+        self.assertEqual(ledger.balance_at(self.bob), Decimal('40.00'))
+
+    def test_cross_currency_transfer_balances_per_currency(self):
+        carol = _wallet('carol', currency='USD')
+        entry = ledger.transfer(self.alice, carol, '10.00', converted_amount='0.08')
+        self.assertBalanced(entry)
+        self.assertEqual(ledger.refresh_balance(carol), Decimal('0.08'))
+
+    def test_transfer_updates_wallets_in_pk_order(self):
+        low, high = sorted([self.alice, self.bob], key=lambda w: w.pk)
+        ledger.credit(high, '50.00')
+        with CaptureQueriesContext(connection) as queries:
+            ledger.transfer(high, low, '5.00')
+        updated = [
+            int(re.search(r'"id" = (\d+)', q['sql']).group(1))
+            for q in queries.captured_queries if q['sql'].startswith('UPDATE "wallet_wallet"')
+        ]
+        self.assertEqual(updated, [low.pk, high.pk])
+
+    def test_failed_leg_rolls_back_transfer(self):
+        # bob's credit leg runs first when he has the lower pk; alice's debit must undo it
+        sender, receiver = (self.alice, self.bob) if self.bob.pk < self.alice.pk else (self.bob, self.alice)
+        before = {w.pk: ledger.refresh_balance(w) for w in (sender, receiver)}
+        entries = LedgerEntry.objects.count()
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.transfer(sender, receiver, before[sender.pk] + 1)
+        self.assertEqual({w.pk: ledger.refresh_balance(w) for w in (sender, receiver)}, before)
+        self.assertEqual(LedgerEntry.objects.count(), entries)
+
+
+class BalanceSnapshotTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+
+    def test_balance_replays_snapshot_plus_tail(self):
+        snapshot = ledger.take_snapshot(self.wallet)
+        self.assertEqual(snapshot.balance, Decimal('100.00'))
+        self.assertIsNone(ledger.take_snapshot(self.wallet))
+
+        ledger.debit(self.wallet, '30.00')
+        ledger.credit(self.wallet, '5.00')
+        self.assertEqual(ledger.balance_at(self.wallet), Decimal('75.00'))
+        self.assertEqual(ledger.balance_at(self.wallet, snapshot.taken_at), Decimal('100.00'))
+
+        opening, postings = ledger.statement(self.wallet, snapshot.taken_at)
+        self.assertEqual(opening, Decimal('100.00'))
+        self.assertEqual([p.direction for p in postings], [ledger.DEBIT, ledger.CREDIT])
+
+    def test_verify_reports_only_real_drift(self):
+        out, err = StringIO(), StringIO()
+        call_command('snapshot_balances', '--verify', '--lag', '0', stdout=out, stderr=err)
+        self.assertIn('Wallets out of sync: 0', out.getvalue())
+
+        Wallet.objects.filter(pk=self.wallet.pk).update(balance=Decimal('90.00'))
+        call_command('snapshot_balances', '--verify', '--lag', '0', stdout=out, stderr=err)
+        self.assertIn('Wallets out of sync: 1', out.getvalue())
+        self.assertIn('cached 90.00 != ledger 100.00', err.getvalue())
+
+
+class BulkDisbursementTests(TestCase):
+    def setUp(self):
+        self.alice = _wallet('alice', '100.00')
+        self.bob = _wallet('bob')
+        self.carol = _wallet('carol', currency='USD')
+        fx.store_rate_table(fx.RateTable('USD', {'KES': Decimal('130'), 'USD': Decimal('1')}))
+        self.addCleanup(cache.clear)
+
+    def test_bad_lines_fail_without_sinking_the_batch(self):
+        results, _ = disbursement.disburse(self.alice.user, [
+            {'recipient': 'bob', 'amount': '10'},
+            'foo',
+            {'recipient': 'carol', 'amount': '0.01'},
+        ])
+        self.assertEqual([r['status'] for r in results], ['success', 'failed', 'failed'])
+        self.assertIn('must be an object', results[1]['error'])
+        self.assertIn('too small', results[2]['error'])
+        self.assertEqual(ledger.refresh_balance(self.alice), Decimal('90.00'))
+        self.assertEqual(ledger.refresh_balance(self.carol), Decimal('0.00'))
+
+
+@api_view(['POST'])
+@idempotent
+def _idempotent_view(request):
+    """Test view; ``action`` picks what it does before answering."""
+    action = request.data.get('action')
+    wallet = Wallet.objects.get(user=request.user)
+    if action in ('debit', 'debit_then_raise', 'debit_then_502'):
+        ledger.debit(wallet, '10.00')
+    if action == 'provider_then_502':
+        note_side_effect()
+    if action in ('raise', 'debit_then_raise'):
+        raise RuntimeError('boom')
+    if action.endswith('502'):
+        return Response({'error': 'provider down'}, status=502)
+    return Response({'balance': str(ledger.refresh_balance(wallet))}, status=201)
+
+
+class IdempotencyTests(TransactionTestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        self.addCleanup(cache.clear)
+
+    def call(self, action, key='key-1', **data):
+        request = APIRequestFactory().post('/test/', {'action': action, **data}, format='json', HTTP_IDEMPOTENCY_KEY=key)
+        force_authenticate(request, user=self.wallet.user)
+        return _idempotent_view(request)
+
+    def test_replay_returns_stored_response(self):
+        first = self.call('debit')
+        second = self.call('debit')
+        self.assertEqual((second.status_code, second.data), (201, first.data))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('90.00'))
+
+    def test_key_reused_with_other_body_is_rejected(self):
+        self.call('debit')
+        self.assertEqual(self.call('debit', note='other').status_code, 422)
+
+    def test_failure_without_changes_releases_key(self):
+        with self.assertRaises(RuntimeError):
+            self.call('raise')
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.call('raise_502').status_code, 502)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_failure_after_commit_is_replayed_not_rerun(self):
+        with self.assertRaises(RuntimeError):
+            self.call('debit_then_raise')
+        retry = self.call('debit_then_raise')
+        self.assertEqual((retry.status_code, retry['Idempotent-Replayed']), (500, 'true'))
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('90.00'))
+
+        self.assertEqual(self.call('debit_then_502', key='key-2').status_code, 502)
+        self.assertEqual(self.call('debit_then_502', key='key-2')['Idempotent-Replayed'], 'true')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('80.00'))
+
+    def test_provider_call_counts_as_a_change(self):
+        self.call('provider_then_502')
+        self.assertEqual(self.call('provider_then_502')['Idempotent-Replayed'], 'true')
+
+    def test_expired_lease_is_taken_over(self):
+        fingerprint = idempotency._fingerprint('POST', '/test/', {'action': 'debit'})
+        record = IdempotencyKey.objects.create(
+            user=self.wallet.user, key='key-1', endpoint='_idempotent_view', fingerprint=fingerprint,
+            expires_at=timezone.now() + timedelta(hours=1), locked_until=timezone.now() + timedelta(minutes=1),
+        )
+        with mock.patch.object(idempotency, 'WAIT_TIMEOUT', 0.2):
+            self.assertEqual(self.call('debit').status_code, 409)
+
+        IdempotencyKey.objects.filter(pk=record.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.call('debit').status_code, 201)
+        self.assertEqual(IdempotencyKey.objects.get(pk=record.pk).status, 'COMPLETED')
+
+
+class RateTableTests(SimpleTestCase):
+    def setUp(self):
+        self.table = fx.RateTable('USD', {'KES': Decimal('129.5'), 'GBP': Decimal('0.79')})
+
+    def test_direct_rate_from_base(self):
+        self.assertEqual(self.table.rate('USD', 'KES'), Decimal('129.50000000'))
+        self.assertEqual(self.table.rate('KES', 'KES'), Decimal('1'))
+
+    def test_inverse_rate_into_base(self):
+        self.assertEqual(self.table.rate('KES', 'USD'), Decimal('0.00772201'))
+
+    def test_cross_rate_through_base(self):
+        self.assertEqual(self.table.rate('GBP', 'KES'), Decimal('163.92405063'))
+
+    def test_converted_amount_rounds_half_up_to_cents(self):
+        self.assertEqual(self.table.convert('10', 'KES', 'USD'), (Decimal('0.08'), Decimal('0.00772201')))
+        self.assertEqual(self.table.convert('0.1', 'GBP', 'KES')[0], Decimal('16.39'))
+        half = fx.RateTable('USD', {'KES': Decimal('100.5')})
+        self.assertEqual(half.convert('0.01', 'USD', 'KES')[0], Decimal('1.01'))
+
+    def test_missing_currency_raises(self):
+        with self.assertRaisesMessage(fx.FxError, 'No exchange rate for EUR'):
+            self.table.rate('EUR', 'KES')
+        with self.assertRaisesMessage(fx.FxError, 'No exchange rate for EUR'):
+            self.table.convert('1', 'USD', 'EUR')
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        singleflight.reset_stats()
+        self.addCleanup(cache.clear)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_load(self):
+        self.calls += 1
+        self.release.wait(5)
+        return 'loaded'
+
+    def run_concurrently(self, count, **kwargs):
+        results = []
+
+        def call():
+            try:
+                results.append(singleflight.do('key', self.slow_load, **kwargs))
+            except singleflight.SingleFlightTimeout as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        threads[0].start()
+        while 'key' not in singleflight._inflight:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_callers_share_one_load(self):
+        threads, results = self.run_concurrently(5)
+        while singleflight.stats().get('key', {}).get('coalesced', 0) < 4:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['loaded'] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(singleflight.stats()['key'], {'upstream': 1, 'coalesced': 4})
+
+    def test_waiter_gives_up_after_timeout(self):
+        threads, results = self.run_concurrently(2, timeout=0.05)
+        threads[1].join()
+        self.release.set()
+        threads[0].join()
+        self.assertIsInstance(results[0], singleflight.SingleFlightTimeout)
+        self.assertEqual(results[1], 'loaded')
+        self.assertEqual(singleflight.stats()['key'], {'upstream': 1, 'coalesced': 1, 'timeouts': 1})
+
+    def test_other_process_holding_the_lock_is_waited_on(self):
+        cache.add('singleflight_key', 'other-process')
+        polls = iter([None, None, 'theirs'])
+        self.assertEqual(singleflight.do('key', self.slow_load, recheck=lambda: next(polls)), 'theirs')
+        self.assertEqual(self.calls, 0)
+
+        with self.assertRaises(singleflight.SingleFlightTimeout):
+            singleflight.do('key', self.slow_load, recheck=lambda: None, timeout=0.1)
+        self.assertEqual(singleflight.stats()['key'], {'coalesced': 1, 'timeouts': 1})
+
+    def test_rate_table_reload_timeout_is_rates_unavailable(self):
+        cache.clear()
+        with mock.patch.object(singleflight, 'do', side_effect=singleflight.SingleFlightTimeout('busy')):
+            with self.assertRaises(fx.RatesUnavailable):
+                fx.get_rate_table()
+
+
+class FxRateTableTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        self.api = APIClient()
+        self.api.force_authenticate(self.wallet.user)
+        self.addCleanup(cache.clear)
+        cache.clear()
+
+    def preview(self):
+        return self.api.post('/api/convert-preview/', {'amount': '100', 'currency_to': 'USD'}, format='json')
+
+    def test_preview_before_first_refresh_says_rates_not_loaded(self):
+        response = self.preview()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('not loaded', response.json()['error'])
+
+    def test_readers_fall_back_to_stored_version(self):
+        fx.store_rate_table(fx.RateTable('USD', {'KES': Decimal('130')}, provider='test'))
+        # Another process refreshed: this one's cache never saw the write
+        cache.clear()
+        response = self.preview()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['converted_amount'], '0.77')
+
+    def test_stale_table_is_refused(self):
+        stale = timezone.now() - fx.FX_MAX_STALENESS - timedelta(minutes=1)
+        fx.store_rate_table(fx.RateTable('USD', {'KES': Decimal('130')}, fetched_at=stale))
+        self.assertEqual(self.preview().status_code, 503)
+
+
+class FxQuoteTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        fx.store_rate_table(fx.RateTable('USD', {'KES': Decimal('130')}, provider='test'))
+        self.sender = _wallet('alice', '1000.00')
+        self.recipient = _wallet('bob', currency='USD')
+        self.api = APIClient()
+        self.api.force_authenticate(self.sender.user)
+
+    def test_preview_for_recipient_uses_their_wallet_currency(self):
+        response = self.api.post('/api/convert-preview/', {'amount': '130', 'recipient': 'bob'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['currency_to'], 'USD')
+        self.assertEqual(response.json()['converted_amount'], '1.00')
+
+    def test_transfer_settles_at_the_quoted_rate(self):
+        preview = self.api.post('/api/convert-preview/', {'amount': '130', 'recipient': 'bob'}, format='json').json()
+        fx.store_rate_table(fx.RateTable('USD', {'KES': Decimal('100')}, provider='test'))
+        with mock.patch.object(CustomUser, 'check_pin', return_value=True):
+            response = self.api.post('/api/transfer/', {
+                'recipient': 'bob', 'amount': '130', 'pin': '123456', 'quote_id': preview['quote_id'],
+            }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(ledger.refresh_balance(self.recipient), Decimal('1.00'))
+
+    def test_multi_target_preview_prices_without_locking(self):
+        response = self.api.post('/api/convert-preview/', {'amount': '130', 'currency_to': 'all'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        usd = next(c for c in response.json()['conversions'] if c['currency_to'] == 'USD')
+        self.assertEqual(usd['converted_amount'], '1.00')
+        self.assertNotIn('quote_id', usd)
+        self.assertFalse(FxQuote.objects.exists())
+
+
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.breaker = circuitbreaker.CircuitBreaker('test', threshold=2, reset_timeout=60)
+        self.now = 1000.0
+        patcher = mock.patch.object(circuitbreaker.time, 'time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def trip(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_half_open_lets_one_trial_through(self):
+        self.trip()
+        self.assertFalse(self.breaker.allow())
+        self.now += 61
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        self.trip()
+        self.now += 61
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+        self.now += 61
+        self.assertTrue(self.breaker.allow())
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        self.client = Client(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.wallet.user)}')
+
+    def post(self, path, data):
+        return self.client.post(path, data, content_type='application/json')
+
+    def test_withdraw_rejects_non_positive_amounts(self):
+        with mock.patch.object(CustomUser, 'check_pin', return_value=True):
+            for amount in ('-5', '0', 'NaN', 'Infinity'):
+                response = self.post('/api/async/mpesa/withdraw/',
+                                     {'phone': '0712345678', 'amount': amount, 'pin': '123456'})
+                self.assertEqual(response.status_code, 400, amount)
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+
+    def test_deposit_reports_provider_failure_as_bad_gateway(self):
+        failure = mock.AsyncMock(side_effect=httpx.ConnectError('connection refused'))
+        with mock.patch.object(flutterwave.aclient, 'post', failure):
+            response = self.post('/api/async/flutterwave/deposit/', {'amount': '100'})
+        self.assertEqual(response.status_code, 502)
+        self.assertIn('Flutterwave request failed', response.json()['error'])
+
+
+def _provider_response(status_code, data):
+    return mock.Mock(status_code=status_code, text=str(data), json=mock.Mock(return_value=data))
+
+
+class PayoutOutboxTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        payouts.enqueue_mpesa_withdrawal(self.wallet.user, '+254712345678', Decimal('40.00'))
+        # No throttling between sends in tests
+        patcher = mock.patch.dict(payouts._limiters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, **b2c):
+        with mock.patch.object(payouts.mpesa, 'b2c_request', **b2c):
+            (outbox,) = payouts.claim_due(10)
+            return payouts.process(outbox)
+
+    def test_enqueue_reserves_funds_and_queues_the_payout(self):
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+        outbox = PayoutOutbox.objects.get()
+        self.assertEqual((outbox.status, outbox.payload['msisdn']), ('PENDING', '254712345678'))
+        self.assertEqual(outbox.wallet_transaction.status, 'pending')
+
+    def test_accepted_payout_is_sent_and_matched_by_conversation_id(self):
+        accepted = {'ResponseCode': '0', 'ConversationID': 'AG_1', 'OriginatorConversationID': 'OC_1'}
+        self.assertEqual(self.send(return_value=_provider_response(200, accepted)), 'SENT')
+        self.assertEqual(WalletTransaction.objects.get().conversation_id, 'AG_1')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+
+    def test_rejected_payout_fails_and_refunds(self):
+        self.assertEqual(self.send(return_value=_provider_response(400, {'errorMessage': 'Bad MSISDN'})), 'FAILED')
+        self.assertEqual(WalletTransaction.objects.get().status, 'failed')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+
+    def test_connection_error_is_retried_later(self):
+        self.assertEqual(self.send(side_effect=requests.exceptions.ConnectionError('refused')), 'PENDING')
+        self.assertGreater(PayoutOutbox.objects.get().next_attempt_at, timezone.now())
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+
+    def test_ambiguous_mpesa_payout_is_held_for_review_without_refund(self):
+        self.assertEqual(self.send(side_effect=requests.exceptions.ReadTimeout('read timed out')), 'UNKNOWN')
+        self.assertEqual(WalletTransaction.objects.get().status, 'pending')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+
+
+class FlutterwaveResendTests(TestCase):
+    DUPLICATE = {'status': 'error', 'message': 'Duplicate transfer reference'}
+
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        _, self.wallet_tx = payouts.enqueue_flutterwave_withdrawal(
+            self.wallet.user, Decimal('40.00'), '01', '0123456789', 'Rent')
+        # An earlier attempt timed out after the request may have reached Flutterwave
+        PayoutOutbox.objects.update(attempts=1)
+        patcher = mock.patch.dict(payouts._limiters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def resend(self, found):
+        with mock.patch.object(payouts.flutterwave, 'transfer_request',
+                               return_value=_provider_response(400, self.DUPLICATE)), \
+                mock.patch.object(payouts.flutterwave, 'find_transfer', return_value=found) as find:
+            (outbox,) = payouts.claim_due(10)
+            status = payouts.process(outbox)
+        find.assert_called_once_with(self.wallet_tx.reference)
+        return status
+
+    def test_refused_duplicate_is_sent_with_the_existing_transfer_id(self):
+        transfer = {'id': 4321, 'reference': self.wallet_tx.reference, 'status': 'NEW'}
+        self.assertEqual(self.resend(transfer), 'SENT')
+        self.assertEqual(reconcile._transfer_id(PayoutOutbox.objects.get()), 4321)
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+
+    def test_refusal_without_an_existing_transfer_fails_and_refunds(self):
+        self.assertEqual(self.resend(None), 'FAILED')
+        self.assertEqual(WalletTransaction.objects.get().status, 'failed')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+
+    def test_find_transfer_matches_the_reference_exactly(self):
+        listing = {'status': 'success', 'data': [{'id': 1, 'reference': 'other'}, {'id': 2, 'reference': 'ref-1'}]}
+        with mock.patch.object(flutterwave.client, 'get', return_value=_provider_response(200, listing)) as get:
+            self.assertEqual(flutterwave.find_transfer('ref-1')['id'], 2)
+            self.assertIsNone(flutterwave.find_transfer('ref-2'))
+        self.assertEqual(get.call_args.kwargs['params'], {'reference': 'ref-2'})
+
+
+def _stk_callback(reference, receipt, amount='50'):
+    return {'Body': {'stkCallback': {
+        'MerchantRequestID': 'mr-1',
+        'CheckoutRequestID': reference,
+        'ResultCode': 0,
+        'ResultDesc': 'The service request is processed successfully.',
+        'CallbackMetadata': {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'PhoneNumber', 'Value': 254712345678},
+        ]},
+    }}}
+
+
+class WithdrawalAmountTests(TestCase):
+    BAD_AMOUNTS = (None, '', 'abc', 'NaN', 'Infinity', '0', '-5')
+
+    def setUp(self):
+        self.wallet = _wallet('alice', '100.00')
+        self.api = APIClient()
+        self.api.force_authenticate(self.wallet.user)
+        patcher = mock.patch.object(CustomUser, 'check_pin', return_value=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertRejected(self, path, **fields):
+        for amount in self.BAD_AMOUNTS:
+            data = dict(fields, pin='123456', **({} if amount is None else {'amount': amount}))
+            response = self.api.post(path, data, format='json')
+            self.assertEqual(response.status_code, 400, amount)
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+        self.assertFalse(PayoutOutbox.objects.exists())
+
+    def test_mpesa_withdrawal_rejects_invalid_amounts(self):
+        self.assertRejected('/api/mpesa/withdraw/', phone='0712345678')
+        data = {'phone': '0712345678', 'amount': '40', 'pin': '123456'}
+        response = self.api.post('/api/mpesa/withdraw/', data, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('60.00'))
+
+    def test_mpesa_withdrawal_rejects_fractional_shillings(self):
+        data = {'phone': '0712345678', 'amount': '40.50', 'pin': '123456'}
+        response = self.api.post('/api/mpesa/withdraw/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('whole number', response.json()['error'])
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+        with self.assertRaises(payouts.InvalidPayout):
+            payouts.enqueue_mpesa_withdrawal(self.wallet.user, '+254712345678', Decimal('0.50'))
+
+    def test_flutterwave_withdrawal_rejects_invalid_amounts(self):
+        self.assertRejected('/api/flutterwave/withdraw/', account_bank='01', account_number='0123456789')
+
+
+class InboundEventTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice')
+        payments.record_stk_push(self.wallet.user, '+254712345678', '50',
+                                 {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1'})
+
+    def test_callback_is_stored_then_applied_by_the_worker(self):
+        response = APIClient().post('/api/mpesa/callback/', _stk_callback('ws_CO_1', 'RCP1'), format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(InboundEvent.objects.get().status, 'PENDING')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('0.00'))
+
+        (event,) = events.claim_due(10)
+        self.assertEqual(events.process(event), 'DONE')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+        self.assertEqual(WalletTransaction.objects.get(reference='ws_CO_1').status, 'success')
+
+    def test_result_for_unrecorded_payout_is_retried(self):
+        events.record('MPESA_B2C', {'Result': {'ResultCode': 0, 'ConversationID': 'AG_unknown'}})
+        (event,) = events.claim_due(10)
+        self.assertEqual(events.process(event), 'PENDING')
+        event.refresh_from_db()
+        self.assertIn('AG_unknown', event.last_error)
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        self.assertEqual(events.claim_due(10), [])
+
+
+class CallbackDedupTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.wallet = _wallet('alice')
+        payments.record_stk_push(self.wallet.user, '+254712345678', '50',
+                                 {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1'})
+
+    def test_redelivered_callback_is_credited_once(self):
+        events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1'))
+        events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1'))
+        with self.captureOnCommitCallbacks(execute=True):
+            statuses = [events.process(event) for event in events.claim_due(10)]
+        self.assertEqual(statuses, ['DONE', 'DUPLICATE'])
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+        self.assertEqual(ProcessedEvent.objects.count(), 2)
+
+        # Once applied, later redeliveries are dropped before they are stored
+        self.assertIsNone(events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1')))
+        self.assertEqual(InboundEvent.objects.count(), 2)
+
+    def test_same_receipt_under_another_request_is_a_duplicate(self):
+        events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1'))
+        events.record('MPESA_STK', _stk_callback('ws_CO_2', 'RCP1'))
+        statuses = [events.process(event) for event in events.claim_due(10)]
+        self.assertEqual(statuses, ['DONE', 'DUPLICATE'])
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+
+
+class ReconcileStkTests(TestCase):
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.wallet = _wallet('alice')
+        payments.record_stk_push(self.wallet.user, '+254712345678', '50',
+                                 {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_1'})
+        self.wallet_tx = WalletTransaction.objects.get(reference='ws_CO_1')
+
+    def reconcile(self, result):
+        with mock.patch.object(reconcile.mpesa, 'stk_query', return_value=result), \
+                self.captureOnCommitCallbacks(execute=True):
+            return reconcile.reconcile_stk_deposit(self.wallet_tx)
+
+    def query_result(self, code, desc):
+        return {'ResponseCode': '0', 'MerchantRequestID': 'mr-1', 'CheckoutRequestID': 'ws_CO_1',
+                'ResultCode': code, 'ResultDesc': desc}
+
+    def test_paid_deposit_is_credited(self):
+        self.assertEqual(self.reconcile(self.query_result('0', 'The service request is processed successfully.')),
+                         'success')
+        self.assertEqual(WalletTransaction.objects.get(reference='ws_CO_1').status, 'success')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+
+        # The late real callback is dropped
+        self.assertEqual(self.reconcile(self.query_result('0', 'processed')), 'already_final')
+        self.assertIsNone(events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1')))
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+
+    def test_cancelled_deposit_is_failed(self):
+        self.assertEqual(self.reconcile(self.query_result('1032', 'Request cancelled by user')), 'failed')
+        self.assertEqual(WalletTransaction.objects.get(reference='ws_CO_1').status, 'failed')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('0.00'))
+
+    def test_deposit_still_processing_is_left_for_the_real_callback(self):
+        self.assertEqual(self.reconcile(self.query_result('4999', 'The transaction is still under processing')),
+                         'stuck')
+        self.assertFalse(InboundEvent.objects.exists())
+        self.assertEqual(WalletTransaction.objects.get(reference='ws_CO_1').status, 'pending')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            event = events.record('MPESA_STK', _stk_callback('ws_CO_1', 'RCP1'), apply=True)
+        self.assertEqual(event.status, 'DONE')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('50.00'))
+
+    def test_failed_query_is_left_pending(self):
+        self.assertEqual(self.reconcile({'error': 'The transaction is being processed', 'status': 500}), 'stuck')
+        self.assertFalse(InboundEvent.objects.exists())
+        self.assertEqual(WalletTransaction.objects.get(reference='ws_CO_1').status, 'pending')
+
+
+class ReconcileFlutterwaveTests(TransactionTestCase):
+    # The reconciler verifies rows from a thread pool, so the rows must be committed
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.wallet = _wallet('alice', '100.00')
+        self.withdrawals = []
+        for transfer_id in (101, 102, 103):
+            _, wallet_tx = payouts.enqueue_flutterwave_withdrawal(
+                self.wallet.user, Decimal('10.00'), '01', '0123456789', 'Rent')
+            PayoutOutbox.objects.filter(wallet_transaction=wallet_tx).update(
+                status='SENT', response={'status': 'success', 'data': {'id': transfer_id}})
+            self.withdrawals.append(wallet_tx)
+        self.statuses = {}
+
+    def verify(self, transfer_id):
+        wallet_tx = self.withdrawals[transfer_id - 101]
+        status, reference = self.statuses.get(transfer_id, ('NEW', wallet_tx.reference))
+        return {'status': 'success', 'data': {'id': transfer_id, 'reference': reference, 'status': status}}
+
+    def run_reconciler(self, **options):
+        with mock.patch.object(reconcile.flutterwave, 'verify_withdrawal', side_effect=self.verify) as verify:
+            report = reconcile.reconcile_flutterwave(older_than=0, workers=2, rate=0, **options)
+        return report, sorted(call.args[0] for call in verify.call_args_list)
+
+    def test_failed_transfer_is_refunded_once(self):
+        self.statuses = {101: ('FAILED', self.withdrawals[0].reference)}
+        report, _ = self.run_reconciler()
+        self.assertEqual(dict(report.outcomes), {'refunded': 1, 'stuck': 2})
+        self.assertEqual(WalletTransaction.objects.get(pk=self.withdrawals[0].pk).status, 'failed')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('80.00'))
+
+        # A rerun no longer sees it, and re-checking the stale row does not refund again
+        report, verified = self.run_reconciler()
+        self.assertEqual(verified, [102, 103])
+        self.withdrawals[0].payout.refresh_from_db()  # cached by enqueue, before the transfer id was set
+        with mock.patch.object(reconcile.flutterwave, 'verify_withdrawal', side_effect=self.verify):
+            self.assertEqual(reconcile.reconcile_flutterwave_withdrawal(self.withdrawals[0]), 'already_final')
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('80.00'))
+
+    def test_transfer_for_another_reference_is_skipped(self):
+        self.statuses = {102: ('FAILED', 'someone-else')}
+        report, _ = self.run_reconciler()
+        self.assertEqual(report.outcomes['error'], 1)
+        self.assertEqual(WalletTransaction.objects.get(pk=self.withdrawals[1].pk).status, 'pending')
+        self.assertFalse(InboundEvent.objects.exists())
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('70.00'))
+
+    def test_command_resumes_from_checkpoint(self):
+        self.statuses = {102: ('SUCCESSFUL', self.withdrawals[1].reference),
+                         103: ('FAILED', self.withdrawals[2].reference)}
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        checkpoint = os.path.join(tmp.name, 'reconcile.checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write(str(self.withdrawals[0].pk))
+        out = StringIO()
+        with mock.patch.object(reconcile.flutterwave, 'verify_withdrawal', side_effect=self.verify) as verify:
+            call_command('reconcile_flutterwave', '--older-than', '0', '--chunk-size', '1', '--rate', '0',
+                         '--checkpoint', checkpoint, stdout=out)
+        self.assertIn(f'Resuming after id {self.withdrawals[0].pk}', out.getvalue())
+        self.assertEqual([call.args[0] for call in verify.call_args_list], [102, 103])
+        self.assertFalse(os.path.exists(checkpoint))
+        statuses = WalletTransaction.objects.filter(type='withdraw').order_by('id').values_list('status', flat=True)
+        self.assertEqual(list(statuses), ['pending', 'success', 'failed'])
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('80.00'))
+
+
+class BankDirectoryTests(TestCase):
+    BANKS = [{'id': 1, 'code': '01', 'name': 'KCB Bank'}, {'id': 2, 'code': '68', 'name': 'Equity Bank'}]
+
+    def setUp(self):
+        self.addCleanup(cache.clear)
+        self.refresh(self.BANKS)
+        self.wallet = _wallet('alice', '100.00')
+        self.api = APIClient()
+        self.api.force_authenticate(self.wallet.user)
+
+    def refresh(self, data):
+        with mock.patch.object(banks.flutterwave, 'fetch_banks', return_value={'data': data}):
+            return banks.refresh_banks('KE')
+
+    def test_unchanged_list_revalidates_with_304(self):
+        first = self.api.get('/api/banks/KE/')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual([b['code'] for b in first.json()['banks']], ['68', '01'])
+
+        again = self.api.get('/api/banks/KE/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], first['ETag'])
+
+        self.refresh(self.BANKS + [{'id': 3, 'code': '11', 'name': 'Co-operative Bank'}])
+        changed = self.api.get('/api/banks/KE/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_withdrawal_to_unknown_bank_is_rejected(self):
+        with mock.patch.object(CustomUser, 'check_pin', return_value=True):
+            response = self.api.post('/api/flutterwave/withdraw/', {
+                'amount': '50', 'account_bank': '99', 'account_number': '0123456789', 'pin': '123456',
+            }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Unknown bank code', response.json()['error'])
+        self.assertEqual(ledger.refresh_balance(self.wallet), Decimal('100.00'))
+        self.assertFalse(PayoutOutbox.objects.exists())
+
+    def test_reload_timeout_is_reported_as_unavailable(self):
+        cache.clear()
+        with mock.patch.object(singleflight, 'do', side_effect=singleflight.SingleFlightTimeout('busy')):
+            self.assertEqual(self.api.get('/api/banks/KE/').status_code, 503)
+            self.assertTrue(banks.is_known_bank('99', 'KE'))
+
+
+class TransactionHistoryTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice')
+        self.api = APIClient()
+        self.api.force_authenticate(self.wallet.user)
+        noon = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        # Three pairs of rows share a timestamp, so only the id breaks the tie
+        for i in range(7):
+            t = Transaction.objects.create(
+                wallet=self.wallet, transaction_type='DEPOSIT' if i % 2 else 'TRANSFER',
+                amount=Decimal(i + 1), status='SUCCESS',
+            )
+            Transaction.objects.filter(pk=t.pk).update(timestamp=noon - timedelta(minutes=i // 2))
+
+    def pages(self, **params):
+        seen, cursor = [], None
+        while True:
+            query = dict(params, **({'cursor': cursor} if cursor else {}))
+            response = self.api.get('/api/transactions/', query)
+            self.assertEqual(response.status_code, 200)
+            seen += [r['transaction_id'] for r in response.json()['results']]
+            cursor = response.json()['next_cursor']
+            if not cursor:
+                return seen
+
+    def expected(self, **filters):
+        rows = Transaction.objects.filter(wallet=self.wallet, **filters).order_by('-timestamp', '-id')
+        return [str(t.transaction_id) for t in rows]
+
+    def test_pages_through_ties_without_gaps_or_duplicates(self):
+        for size in (1, 2, 3):
+            self.assertEqual(self.pages(page_size=size), self.expected(), size)
+
+    def test_filters_apply_to_every_page(self):
+        self.assertEqual(self.pages(page_size=1, type='deposit'), self.expected(transaction_type='DEPOSIT'))
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('not-a-cursor', 'bm9waXBl'):
+            response = self.api.get('/api/transactions/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+class WalletSyncTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice')
+        self.api = APIClient()
+        self.api.force_authenticate(self.wallet.user)
+
+    def add(self, count, age=timedelta(minutes=1)):
+        for i in range(count):
+            t = Transaction.objects.create(
+                wallet=self.wallet, transaction_type='DEPOSIT', amount=Decimal('1.00'), status='SUCCESS'
+            )
+            if age:
+                Transaction.objects.filter(pk=t.pk).update(updated_at=timezone.now() - age)
+
+    def sync(self, since=None):
+        return self.api.get('/api/wallet/sync/', {'since': since} if since else {})
+
+    def test_unchanged_token_gets_304(self):
+        self.add(2)
+        token = self.sync().json()['sync_token']
+        self.assertEqual(self.sync(token).status_code, 304)
+
+        self.add(1)
+        changed = self.sync(token)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(changed.json()['changes']), 1)
+
+    def test_has_more_continues_from_the_last_row(self):
+        self.add(5)
+        seen, token, pages = [], None, 0
+        with mock.patch.object(sync, 'SYNC_BATCH_SIZE', 2):
+            while True:
+                body = self.sync(token).json()
+                pages += 1
+                seen += [c['transaction_id'] for c in body['changes']]
+                token = body['sync_token']
+                if not body['has_more']:
+                    break
+        self.assertEqual(pages, 3)
+        ids = Transaction.objects.values_list('transaction_id', flat=True)
+        self.assertEqual(sorted(seen), sorted(str(t) for t in ids))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_token_stays_behind_the_lag_window(self):
+        self.add(1, age=None)
+        body = self.sync().json()
+        _, position, _ = sync.decode_token(body['sync_token'])
+        self.assertLessEqual(position, timezone.now() - sync.SYNC_LAG)
+        # A row inside the lag window is sent again rather than risk skipping a late commit
+        again = self.sync(body['sync_token']).json()
+        self.assertEqual([c['transaction_id'] for c in again['changes']],
+                         [c['transaction_id'] for c in body['changes']])
+
+
+class BackfillProviderReferenceTests(TestCase):
+    def setUp(self):
+        self.wallet = _wallet('alice')
+        descriptions = [
+            'M-Pesa deposit reference ws_CO_1 receipt RCP1',
+            'Failed M-Pesa deposit reference ws_CO_2 receipt n/a',
+            'Flutterwave withdraw reference flw-1 to 0123456789',
+            'Flutterwave withdrawal: flw-1',
+            'Transfer to bob@example.com',
+            'M-Pesa deposit reference None receipt n/a',
+        ]
+        self.rows = [
+            Transaction.objects.create(
+                wallet=self.wallet, transaction_type='DEPOSIT', amount=Decimal('1.00'), description=d
+            )
+            for d in descriptions
+        ]
+
+    def backfill(self):
+        out = StringIO()
+        call_command('backfill_provider_references', chunk_size=2, stdout=out)
+        return out.getvalue()
+
+    def references(self):
+        return [
+            (t.provider, t.provider_reference)
+            for t in Transaction.objects.filter(pk__in=[r.pk for r in self.rows]).order_by('pk')
+        ]
+
+    def test_fills_references_and_reruns_cleanly(self):
+        self.assertIn('Backfill complete: 3 updated, 1 duplicates skipped', self.backfill())
+        expected = [
+            ('MPESA', 'ws_CO_1'),
+            ('MPESA', 'ws_CO_2'),
+            ('FLUTTERWAVE', 'flw-1'),
+            # The completion row of flw-1: the earlier pending row keeps the reference
+            (None, None),
+            (None, None),
+            (None, None),
+        ]
+        self.assertEqual(self.references(), expected)
+
+        self.assertIn('Backfill complete: 0 updated, 1 duplicates skipped', self.backfill())
+        self.assertEqual(self.references(), expected)
+
+
+class PhoneNormalizationTests(TestCase):
+    CASES = {
+        '0712345678': '+254712345678',
+        '712345678': '+254712345678',
+        '254712345678': '+254712345678',
+        '+254 712 345 678': '+254712345678',
+        '00254712345678': '+254712345678',
+        '+447911123456': '+447911123456',
+        254712345678: '+254712345678',
+        '': None,
+        'not a phone': None,
+        '12345': None,
+        '+1234567890123456': None,
+        None: None,
+    }
+
+    def test_normalize_msisdn(self):
+        for raw, expected in self.CASES.items():
+            self.assertEqual(normalize_msisdn(raw), expected, raw)
+
+    def test_save_keeps_e164_mobile_in_step(self):
+        user = _wallet('alice').user
+        user.mobile = '0722000111'
+        user.save(update_fields=['mobile'])
+        user.refresh_from_db()
+        self.assertEqual(user.mobile_e164, '+254722000111')
+
+    def test_data_migration_normalizes_stored_phones(self):
+        migration = importlib.import_module('wallet.migrations.0015_phone_e164')
+        for raw, expected in self.CASES.items():
+            self.assertEqual(migration.normalize_msisdn(raw), expected, raw)
+
+        user = _wallet('alice').user
+        CustomUser.objects.filter(pk=user.pk).update(mobile='0722000111', mobile_e164=None)
+        deposit = WalletTransaction.objects.create(
+            user=user, phone='0722000111', amount=Decimal('5.00'), type='deposit', status='success', reference='ws_CO_1'
+        )
+        bank = WalletTransaction.objects.create(
+            user=user, phone='0123456789', amount=Decimal('5.00'), type='withdraw', status='success', reference='flw-1'
+        )
+        stk = MpesaSTKRequest.objects.create(
+            user=user, checkout_request_id='ws_CO_1', amount=Decimal('5.00'), phone='722000111'
+        )
+
+        migration.normalize_phones(apps, None)
+
+        user.refresh_from_db()
+        self.assertEqual(user.mobile_e164, '+254722000111')
+        self.assertEqual(WalletTransaction.objects.get(pk=deposit.pk).phone, '+254722000111')
+        # Flutterwave rows keep the bank account number as it was
+        self.assertEqual(WalletTransaction.objects.get(pk=bank.pk).phone, '0123456789')
+        self.assertEqual(MpesaSTKRequest.objects.get(pk=stk.pk).phone, '+254722000111')
+
+
+def _raw_response(status, body=b'{}'):
+    return urllib3.HTTPResponse(
+        body=io.BytesIO(body), status=status, headers={'Content-Type': 'application/json'}, preload_content=False
+    )
+
+
+class ProviderClientTests(SimpleTestCase):
+    """Retries are exercised through the real HTTPAdapter/urllib3 Retry, with only the wire mocked."""
+
+    def setUp(self):
+        http_client.reset_stats()
+        self.client = http_client.ProviderClient('test', 'http://provider.test', retries=2)
+        sleep = mock.patch('urllib3.util.retry.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def wire(self, *outcomes):
+        def make_request(*args, **kwargs):
+            outcome = next(results)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return _raw_response(outcome)
+        results = iter(outcomes)
+        patcher = mock.patch.object(urllib3.HTTPConnectionPool, '_make_request', side_effect=make_request)
+        wire = patcher.start()
+        self.addCleanup(patcher.stop)
+        return wire
+
+    def read_timeout(self):
+        return urllib3.exceptions.ReadTimeoutError(None, '/pay', 'read timed out')
+
+    def test_post_is_not_retried_on_5xx(self):
+        wire = self.wire(503, 200)
+        self.assertEqual(self.client.post('/pay', json={}).status_code, 503)
+        self.assertEqual(wire.call_count, 1)
+
+    def test_post_is_not_retried_on_read_error(self):
+        wire = self.wire(self.read_timeout(), 200)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.client.post('/pay', json={})
+        self.assertEqual(wire.call_count, 1)
+
+    def test_post_is_retried_when_the_connection_was_never_made(self):
+        refused = urllib3.exceptions.NewConnectionError(None, 'connection refused')
+        wire = self.wire(refused, 200)
+        self.assertEqual(self.client.post('/pay', json={}).status_code, 200)
+        self.assertEqual(wire.call_count, 2)
+
+    def test_get_is_retried_with_backoff(self):
+        wire = self.wire(503, self.read_timeout(), 200)
+        self.assertEqual(self.client.get('/status').status_code, 200)
+        self.assertEqual(wire.call_count, 3)
+        # urllib3 retries the first failure at once and backs off from the second
+        self.assertEqual(self.sleep.call_count, 1)
+        self.assertGreater(self.sleep.call_args.args[0], 0)
+
+    def test_get_gives_up_after_the_retry_budget(self):
+        wire = self.wire(503, 503, 503, 200)
+        self.assertEqual(self.client.get('/status').status_code, 503)
+        self.assertEqual(wire.call_count, 3)
+
+    def test_calls_errors_and_latency_are_recorded(self):
+        self.wire(200, 503)
+        self.client.get('/status')
+        self.client.post('/pay', json={})
+        stats = http_client.stats()['test']
+        self.assertEqual((stats['calls'], stats['errors']), (2, 1))
+        self.assertGreaterEqual(stats['max_ms'], stats['avg_ms'])
+        self.assertGreater(stats['total_ms'], 0)
+
+    def test_each_process_gets_its_own_session(self):
+        session = self.client.session
+        self.assertIs(self.client.session, session)
+        with mock.patch.object(http_client.os, 'getpid', return_value=-1):
+            forked = self.client.session
+        self.assertIsNot(forked, session)
+
+
+class AsyncProviderClientTests(SimpleTestCase):
+    def setUp(self):
+        http_client.reset_stats()
+        self.client = http_client.AsyncProviderClient('test', 'http://provider.test', retries=2)
+        self.sent = []
+        sleep = mock.patch.object(http_client.asyncio, 'sleep', mock.AsyncMock())
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def call(self, method, *outcomes):
+        results = iter(outcomes)
+
+        def handler(request):
+            self.sent.append(request.method)
+            outcome = next(results)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return httpx.Response(outcome, json={})
+
+        async def run():
+            with mock.patch.object(self.client, '_build_client',
+                                   return_value=httpx.AsyncClient(transport=httpx.MockTransport(handler))):
+                try:
+                    return await self.client.request(method, '/pay')
+                finally:
+                    await self.client.aclose()
+        return asyncio.run(run())
+
+    def test_post_is_not_retried_on_5xx_or_read_error(self):
+        self.assertEqual(self.call('POST', 502, 200).status_code, 502)
+        with self.assertRaises(httpx.ReadTimeout):
+            self.call('POST', httpx.ReadTimeout('read timed out'), 200)
+        self.assertEqual(self.sent, ['POST', 'POST'])
+        self.assertEqual(http_client.stats()['test']['errors'], 2)
+
+    def test_get_is_retried_with_backoff(self):
+        self.assertEqual(self.call('GET', 503, httpx.ReadTimeout('read timed out'), 200).status_code, 200)
+        self.assertEqual(self.sent, ['GET'] * 3)
+        self.assertEqual(self.sleep.await_count, 2)
+
+
+class MpesaAccessTokenTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.issued = itertools.count(1)
+        self.token_get = self.patch('get', side_effect=self.issue_token)
+        self.now = 1_000_000.0
+        clock = mock.patch('django.core.cache.backends.locmem.time.time', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def patch(self, method, **kwargs):
+        patcher = mock.patch.object(mpesa.client, method, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def issue_token(self, *args, **kwargs):
+        return _provider_response(200, {'access_token': f'tok{next(self.issued)}', 'expires_in': '3599'})
+
+    def bearer(self, call):
+        return call.kwargs['headers']['Authorization']
+
+    def test_token_is_reused_until_the_expiry_margin(self):
+        self.assertEqual(mpesa.get_access_token(), 'tok1')
+        self.now += 3599 - mpesa.TOKEN_EXPIRY_MARGIN - 1
+        self.assertEqual(mpesa.get_access_token(), 'tok1')
+        self.assertEqual(self.token_get.call_count, 1)
+
+        # Refreshed inside the margin, before Safaricom would reject it
+        self.now += 2
+        self.assertEqual(mpesa.get_access_token(), 'tok2')
+        self.assertEqual(self.token_get.call_count, 2)
+
+    def test_401_refreshes_the_token_and_retries_once(self):
+        post = self.patch('post', side_effect=[_provider_response(401, {}), _provider_response(200, {'ok': True})])
+        response = mpesa._authorized_post(mpesa.STK_PUSH_URL, {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([self.bearer(c) for c in post.call_args_list], ['Bearer tok1', 'Bearer tok2'])
+        self.assertEqual(mpesa.get_access_token(), 'tok2')
+
+    def test_second_401_is_returned_without_another_retry(self):
+        post = self.patch('post', return_value=_provider_response(401, {}))
+        self.assertEqual(mpesa._authorized_post(mpesa.STK_PUSH_URL, {}).status_code, 401)
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(self.token_get.call_count, 2)
+
+    def test_no_token_means_no_request(self):
+        self.token_get.side_effect = None
+        self.token_get.return_value = _provider_response(400, {'errorMessage': 'Invalid credentials'})
+        post = self.patch('post')
+        self.assertIsNone(mpesa._authorized_post(mpesa.STK_PUSH_URL, {}))
+        post.assert_not_called()
@@ -1,10 +1,13 @@
 from django.urls import path
 from rest_framework.response import Response
 from .webhook import flutterwave_webhook
+from . import async_views
 from .views import (
     WalletView,
     DepositView,
     TransactionFlowView,
+    bank_list,
+    bulk_transfer,
     convert_preview,
     currencies_list,
     register_user,
@@ -12,6 +15,8 @@ from .views import (
     login_user,
     verify_otp,
     user_profile,
+    transaction_history,
+    wallet_sync,
     initiate_stk,
     get_stk_status,
     get_withdraw_status,
@@ -26,14 +31,18 @@ from .views import (
 urlpatterns = [
     # Wallet endpoints
     path('user/profile/', user_profile, name='user-profile'),
+    path('transactions/', transaction_history, name='transaction_history'),
+    path('wallet/sync/', wallet_sync, name='wallet_sync'),
     path('wallet/', WalletView.as_view(), name='wallet'),
     path('deposit/', DepositView.as_view(), name='deposit'),
     # Backwards-compatible routes mapped to unified transaction flow
     path('transfer/', TransactionFlowView.as_view(), name='transfer'),
     path('withdraw/', TransactionFlowView.as_view(), name='withdraw_and_send'),
     path('transaction/', TransactionFlowView.as_view(), name='transaction_flow'),
+    path('transfers/bulk/', bulk_transfer, name='bulk_transfer'),
     path('convert-preview/', convert_preview, name='convert_preview'),
     path('currencies/', currencies_list, name='currencies_list'),
+    path('banks/<str:country>/', bank_list, name='bank_list'),
     path('mpesa/stk/', initiate_stk, name='initiate_stk'),
     path('mpesa/stk/status/', get_stk_status, name='mpesa_stk_status'),
     path('mpesa/withdraw/status/', get_withdraw_status, name='mpesa_withdraw_status'),
@@ -46,6 +55,11 @@ urlpatterns = [
     path("flutterwave/webhook/", flutterwave_webhook, name='flutterwave_webhook'),
     path("flutterwave/withdraw/", flutterwave_withdraw, name='flutterwave_withdraw'),
 
+    # Async provider endpoints (serve through wallet_backend/asgi.py)
+    path('async/mpesa/stk/', async_views.initiate_stk, name='async_initiate_stk'),
+    path('async/mpesa/withdraw/', async_views.withdraw_from_wallet, name='async_mpesa_withdraw'),
+    path('async/flutterwave/deposit/', async_views.flutterwave_deposit, name='async_flutterwave_deposit'),
+
 
 
     # Authentication endpoints
@@ -4,13 +4,9 @@ from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.conf import settings
 import random
-import requests
 from decimal import Decimal, ROUND_HALF_UP
-from django.core.cache import cache
 from .models import OTP
 from django.utils import timezone
-import os
-from dotenv import load_dotenv
 
 
 # --- Activation Email ---
@@ -59,11 +55,43 @@ def send_otp(user):
 
     return otp
 
-# --- Currency Conversion ---
-load_dotenv()
+# --- Phone Numbers ---
+DEFAULT_COUNTRY_CODE = "254"
+
 
-EXCHANGE_API = "https://api.exchangerate.host/convert"
-EXCHANGE_API_KEY = os.getenv("EXCHANGE_API_KEY", "")
+def normalize_msisdn(raw, default_country_code=DEFAULT_COUNTRY_CODE):
+    """
+    Return ``raw`` as an E.164 number ('+254712345678'), or None if it can't be parsed.
+    Accepts local ('0712345678', '712345678'), international ('254712345678',
+    '+254 712 345 678') and '00'-prefixed forms.
+    """
+    if raw is None:
+        return None
+    raw = str(raw).strip()
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    if not digits:
+        return None
+
+    if raw.startswith("+"):
+        pass
+    elif digits.startswith("00"):
+        digits = digits[2:]
+    elif digits.startswith("0"):
+        digits = default_country_code + digits[1:]
+    elif len(digits) == 9:
+        digits = default_country_code + digits
+
+    if not 8 <= len(digits) <= 15:
+        return None
+    return "+" + digits
+
+
+def mpesa_msisdn(phone):
+    """Safaricom APIs take the E.164 number without the leading '+'."""
+    e164 = normalize_msisdn(phone)
+    return e164[1:] if e164 else None
+
+# --- Currency Conversion ---
 def get_currency_choices():
     return [
         ("KES", "KES"),
@@ -76,7 +104,7 @@ def get_currency_choices():
 def convert_currency(amount: Decimal, from_currency: str, to_currency: str):
     """
     Returns (converted_amount: Decimal, rate: Decimal)
-    Uses exchangerate.host convert endpoint and caches the 1-unit rate for 5 minutes.
+    Cross rates come from the last refreshed rate table in wallet.fx (no network call).
     Raises Exception on failure.
     """
     if not from_currency:
@@ -87,67 +115,18 @@ def convert_currency(amount: Decimal, from_currency: str, to_currency: str):
     # same-currency short circuit
     if from_currency == to_currency:
         return (
-            amount.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP),
+            Decimal(str(amount)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP),
             Decimal("1.0"),
         )
 
-    cache_key = f"rate_{from_currency}_{to_currency}"
-    rate = cache.get(cache_key)
-
-    if rate is None:
-        params = {"from": from_currency.upper(), "to": to_currency.upper(), "amount": 1}
-        # Include API key under common parameter names if provided by env/settings.
-        if EXCHANGE_API_KEY:
-            # some providers expect access_key, others apikey/key
-            params.update({
-                "access_key": EXCHANGE_API_KEY,
-                "apikey": EXCHANGE_API_KEY,
-                "key": EXCHANGE_API_KEY,
-            })
-        try:
-            print(f"[CONVERT_CURRENCY] Requesting rate: {from_currency} -> {to_currency}, API key present: {bool(EXCHANGE_API_KEY)}")
-            resp = requests.get(EXCHANGE_API, params=params, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-            print(f"[CONVERT_CURRENCY] API response: {data}")
-        except Exception as e:
-            print(f"[CONVERT_CURRENCY] Error: {e}")
-            raise Exception(f"Exchange rate fetch failed: {e}")
-
-        # If API returned an explicit error (e.g., missing access key), surface it
-        if isinstance(data, dict) and data.get("success") is False:
-            raise Exception(f"Exchange API error: {data.get('error')}")
-
-        # Defensive parsing for multiple possible provider formats
-        raw_rate = None
-        # exchangerate.host returns 'info':{'rate':...} and 'result'
-        if isinstance(data, dict):
-            raw_rate = data.get("info", {}).get("rate") or data.get("result")
-            # some APIs return rates mapping for base->symbols
-            rates = data.get("rates")
-            if raw_rate is None and isinstance(rates, dict):
-                # try to pick to_currency in rates
-                raw_rate = rates.get(to_currency.upper())
-
-        if raw_rate in (None, "", "NaN"):
-            raise Exception(f"Unexpected response format from exchange API: {data}")
-
-        try:
-            rate = Decimal(str(raw_rate))
-        except Exception:
-            raise Exception(f"Invalid rate value returned: {raw_rate}")
-
-        # Cache the rate for 5 minutes
-        cache.set(cache_key, rate, 300)
-
     # Make sure amount is safely parsed as Decimal
     try:
         amount = Decimal(str(amount))
     except Exception:
         raise Exception(f"Invalid amount value: {amount}")
 
-    # Compute converted amount
-    converted = (amount * rate).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    from .fx import convert
+    converted, rate, _ = convert(amount, from_currency.upper(), to_currency.upper())
     return converted, rate
 
 # Utility function for converting currency (used in views)
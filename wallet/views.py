@@ -6,11 +6,11 @@ from rest_framework.decorators import api_view, permission_classes, authenticati
 from django.views.decorators.csrf import csrf_exempt
 import logging
 from django.contrib.auth import get_user_model, authenticate
-from django.utils.http import urlsafe_base64_decode
+from django.utils.http import parse_etags, quote_etag, urlsafe_base64_decode
 from django.contrib.auth.tokens import default_token_generator
 from django.core.cache import cache
 from django.conf import settings
-from datetime import timedelta
+from datetime import datetime, timedelta
 from django.utils import timezone
 from .models import Wallet, Transaction, OTP, CustomUser, CURRENCY_CHOICES, WalletTransaction
 import uuid
@@ -32,7 +32,8 @@ from .models import CustomUser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.permissions import AllowAny
 from django.db import transaction
-from .utils import convert_currency
+from django.db.models import Q
+from .utils import mpesa_msisdn, normalize_msisdn
 from .models import MpesaSTKRequest
 from rest_framework.parsers import JSONParser, FormParser, MultiPartParser
 from django.views.decorators.csrf import csrf_exempt
@@ -40,7 +41,13 @@ from rest_framework.decorators import parser_classes
 import json
 import hashlib, hmac
 import os
-from wallet.flutterwave import create_beneficiary, initiate_transfer
+from . import banks, events, fx, ledger, payments, payouts
+from .ledger import InsufficientFunds
+from .disbursement import disburse, parse_amount, DisbursementError
+from .idempotency import idempotent
+from .pagination import keyset_page, parse_page_size, InvalidCursor
+from .sync import changes_since, current_token, InvalidSyncToken
+from django.utils.dateparse import parse_date, parse_datetime
 
 
 
@@ -164,24 +171,30 @@ def verify_otp(request):
 
 
 # ---------------- USER PROFILE ----------------
+def _transaction_data(t):
+    return {
+        'transaction_id': str(t.transaction_id),
+        'transaction_type': t.transaction_type,
+        'amount': str(t.amount),
+        'currency_from': t.currency_from,
+        'currency_to': t.currency_to,
+        'converted_amount': str(t.converted_amount) if t.converted_amount is not None else None,
+        'status': t.status,
+        'description': t.description,
+        'timestamp': t.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        'counterparty': t.counterparty or 'N/A',  # Email or 'external'
+    }
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_profile(request):
     user = request.user
     wallet, _ = Wallet.objects.get_or_create(user=user)
-    
-    # Get user's transactions (Transaction model has transaction_type, amount, description, counterparty)
-    transactions = Transaction.objects.filter(wallet=wallet).order_by('-timestamp')
-    transaction_data = [
-        {
-            'transaction_type': t.transaction_type,
-            'amount': str(t.amount),
-            'description': t.description,
-            'timestamp': t.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            'counterparty': t.counterparty or 'N/A',  # Email or 'external'
-        }
-        for t in transactions
-    ]
+
+    # Only the first page of history; the rest is fetched from /transactions/?cursor=...
+    sync_token = current_token(wallet)
+    transactions, next_cursor = keyset_page(Transaction.objects.filter(wallet=wallet))
 
     return Response({
         'id': user.id,
@@ -189,11 +202,112 @@ def user_profile(request):
         'email': user.email,
         'wallet_balance': str(wallet.balance),
         'wallet_currency': getattr(wallet, 'currency', 'KES'),
-        'transactions': transaction_data,
+        'transactions': [_transaction_data(t) for t in transactions],
+        'transactions_next_cursor': next_cursor,
+        'sync_token': sync_token,
+    })
+
+
+# ---------------- TRANSACTION HISTORY ----------------
+def _parse_time_bound(raw):
+    """Parse an ISO datetime or date; returns (aware datetime, is_bare_date)."""
+    value = parse_datetime(raw)
+    is_date = value is None
+    if is_date:
+        day = parse_date(raw)
+        if day is None:
+            raise ValueError(f"Invalid date: {raw}")
+        value = datetime.combine(day, datetime.min.time())
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value, is_date
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def transaction_history(request):
+    """Cursor-paginated transaction history for the caller's wallet.
+
+    Query parameters (all optional):
+      cursor, page_size (max 100), type, status, currency, from, to (ISO date/datetime)
+
+    Returns:
+      { "results": [...], "next_cursor": "..." | null }
+    """
+    wallet, _ = Wallet.objects.get_or_create(user=request.user)
+    params = request.query_params
+    qs = Transaction.objects.filter(wallet=wallet)
+
+    if params.get('type'):
+        qs = qs.filter(transaction_type=params['type'].upper())
+    if params.get('status'):
+        qs = qs.filter(status__iexact=params['status'])
+    if params.get('currency'):
+        currency = params['currency'].upper()
+        qs = qs.filter(Q(currency_from=currency) | Q(currency_to=currency))
+    try:
+        if params.get('from'):
+            start, _ = _parse_time_bound(params['from'])
+            qs = qs.filter(timestamp__gte=start)
+        if params.get('to'):
+            end, is_date = _parse_time_bound(params['to'])
+            # a bare date includes the whole day
+            qs = qs.filter(timestamp__lt=end + timedelta(days=1)) if is_date else qs.filter(timestamp__lte=end)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=400)
+
+    try:
+        rows, next_cursor = keyset_page(qs, params.get('cursor'), parse_page_size(params.get('page_size')))
+    except InvalidCursor as e:
+        return Response({'error': str(e)}, status=400)
+
+    return Response({
+        'results': [_transaction_data(t) for t in rows],
+        'next_cursor': next_cursor,
+    })
+
+
+# ---------------- WALLET SYNC ----------------
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def wallet_sync(request):
+    """Return transactions created or changed since a sync token, plus the current balance.
+
+    Query parameter: since (the sync_token from the previous call; omit on first sync)
+
+    Returns 304 with an empty body when nothing changed, otherwise:
+      { "wallet_balance": "...", "wallet_currency": "KES", "changes": [...],
+        "sync_token": "...", "has_more": false }
+    """
+    wallet, _ = Wallet.objects.get_or_create(user=request.user)
+    try:
+        delta = changes_since(wallet, request.query_params.get('since'))
+    except InvalidSyncToken as e:
+        return Response({'error': str(e)}, status=400)
+
+    if delta is None:
+        return Response(status=status.HTTP_304_NOT_MODIFIED)
+
+    rows, sync_token, has_more = delta
+    return Response({
+        'wallet_balance': str(wallet.balance),
+        'wallet_currency': wallet.currency,
+        'changes': [_transaction_data(t) for t in rows],
+        'sync_token': sync_token,
+        'has_more': has_more,
     })
 
 
 # ---------------- CONVERT PREVIEW ----------------
+def _quote_data(quote):
+    return {
+        "converted_amount": str(quote.converted_amount),
+        "rate": str(quote.rate),
+        "currency_to": quote.currency_to,
+        "quote_id": str(quote.quote_id),
+        "expires_at": quote.expires_at.isoformat(),
+    }
+
 
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
@@ -202,8 +316,21 @@ def convert_preview(request):
     Expects JSON:
       { "amount": "1000", "currency_from": "KES" (optional), "currency_to": "GBP" }
 
+    Instead of currency_to, a wallet->wallet transfer may pass "recipient" (username or
+    email); the preview is then priced into that recipient's wallet currency.
+
     Returns:
-      { "converted_amount": "5.30", "rate": "0.00530", "currency_from":"KES","currency_to":"GBP" }
+      { "converted_amount": "5.30", "rate": "0.00530", "currency_from":"KES","currency_to":"GBP",
+        "quote_id": "...", "expires_at": "..." }
+
+    currency_to may also be a list of codes or "all"; every target is priced from the
+    same rate table and the response carries one entry per target:
+      { "amount": "1000", "currency_from": "KES",
+        "conversions": [ { "currency_to": "GBP", "converted_amount": ..., "rate": ... }, ... ] }
+    These are indicative only and carry no quote; preview the chosen currency on its own
+    to lock a rate.
+
+    Passing quote_id to /transfer/ or /withdraw/ before expires_at settles at exactly this rate.
     """
     try:
         amount_raw = request.data.get("amount")
@@ -214,21 +341,54 @@ def convert_preview(request):
         amount = Decimal(str(amount_raw))
 
         # prefer explicit currency_from; otherwise use the user's wallet currency
-        wallet, _ = Wallet.objects.get_or_create(user=request.user)
-        from_currency = request.data.get("currency_from") or getattr(wallet, "currency", "KES")
+        from_currency = request.data.get("currency_from")
+        if not from_currency:
+            wallet, _ = Wallet.objects.get_or_create(user=request.user)
+            from_currency = wallet.currency
         to_currency = request.data.get("currency_to")
+        recipient = request.data.get("recipient")
+        if recipient and not to_currency:
+            field = "user__email" if "@" in recipient else "user__username"
+            recv_wallet = Wallet.objects.filter(**{field: recipient}).first()
+            if recv_wallet is None:
+                return Response({"error": "Recipient not found."}, status=status.HTTP_400_BAD_REQUEST)
+            to_currency = recv_wallet.currency
         if not to_currency:
             return Response({"error": "Missing 'currency_to'."}, status=status.HTTP_400_BAD_REQUEST)
 
-        converted_amount, rate = convert_currency(amount, from_currency, to_currency)
-
+        if not isinstance(to_currency, list) and to_currency != "all":
+            quote = fx.issue_quote(request.user, amount, from_currency, to_currency)
+            return Response({
+                "amount": str(quote.amount),
+                "currency_from": from_currency,
+                **_quote_data(quote),
+            }, status=status.HTTP_200_OK)
+
+        codes = [code for code, _ in CURRENCY_CHOICES]
+        if to_currency == "all":
+            targets = [code for code in codes if code != from_currency]
+        else:
+            targets = list(dict.fromkeys(to_currency))
+            unknown = [code for code in targets if code not in codes]
+            if unknown:
+                return Response({"error": f"Unsupported currency: {', '.join(map(str, unknown))}"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        conversions = []
+        for code, priced in fx.convert_many(amount, from_currency, targets).items():
+            if isinstance(priced, Exception):
+                conversions.append({"currency_to": code, "error": str(priced)})
+            else:
+                converted, rate = priced
+                conversions.append({"currency_to": code, "converted_amount": str(converted), "rate": str(rate)})
         return Response({
-            "converted_amount": str(converted_amount),
-            "rate": str(rate),
+            "amount": str(amount.quantize(Decimal("0.01"))),
             "currency_from": from_currency,
-            "currency_to": to_currency
+            "conversions": conversions,
         }, status=status.HTTP_200_OK)
 
+    except fx.RatesUnavailable as e:
+        return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
     except Exception as e:
         # Don't expose internal trace in production — return helpful message
         return Response({"error": f"Conversion failed: {str(e)}"}, status=status.HTTP_502_BAD_GATEWAY)
@@ -243,6 +403,37 @@ def currencies_list(request):
     return Response({'currencies': data})
 
 
+# ---------------- BANK DIRECTORY ----------------
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def bank_list(request, country):
+    """Return the banks Flutterwave transfers can be sent to in ``country``.
+
+    Served from the stored directory (see wallet/banks.py). Send the ETag
+    back as If-None-Match to get 304 until the list changes.
+    """
+    try:
+        directory = banks.get_directory(country)
+    except banks.BankDirectoryUnavailable as e:
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except banks.BankDirectoryError as e:
+        return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+    etag = quote_etag(directory.etag)
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response({
+            'country': directory.country,
+            'banks': directory.banks,
+            'updated_at': directory.updated_at.isoformat(),
+        })
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={banks.BANKS_TTL}'
+    return response
+
+
 # ---------------- WALLET VIEW ----------------
 class WalletView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -257,6 +448,7 @@ class WalletView(APIView):
 class DepositView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
+    @idempotent
     def post(self, request):
         try:
             amount = Decimal(request.data.get('amount', '0'))
@@ -264,19 +456,19 @@ class DepositView(APIView):
                 return Response({'error': 'Amount must be greater than zero'}, status=400)
 
             wallet, _ = Wallet.objects.get_or_create(user=request.user)
-            wallet.balance += amount
-            wallet.save()
-
-            Transaction.objects.create(
-                wallet=wallet,
-                transaction_type='DEPOSIT',
-                amount=amount,
-                description='Deposit successful'
-            )
+            with transaction.atomic():
+                ledger.credit(wallet, amount, description='Deposit')
+
+                Transaction.objects.create(
+                    wallet=wallet,
+                    transaction_type='DEPOSIT',
+                    amount=amount,
+                    description='Deposit successful'
+                )
 
             return Response({
                 'message': 'Deposit successful',
-                'new_balance': str(wallet.balance)
+                'new_balance': str(ledger.refresh_balance(wallet))
             })
 
         except Exception as e:
@@ -284,6 +476,17 @@ class DepositView(APIView):
 
 
 # ---------------- UNIFIED TRANSACTION FLOW ----------------
+def _price_transfer(user, quote_id, amount, currency_from, currency_to):
+    """Return ``(converted_amount, rate, fx_rate_version, quote)``, priced before any DB transaction opens."""
+    if quote_id:
+        quote = fx.get_quote(quote_id, user, amount, currency_from, currency_to)
+        return quote.converted_amount, quote.rate, quote.fx_rate_version, quote
+    if currency_from == currency_to:
+        return amount, Decimal('1.00'), None, None
+    converted_amount, rate, fx_version = fx.convert(amount, currency_from, currency_to)
+    return converted_amount, rate, fx_version, None
+
+
 class TransactionFlowView(APIView):
     """Unified transaction endpoint.
 
@@ -294,6 +497,7 @@ class TransactionFlowView(APIView):
       - recipient: username or email when destination is 'wallet' (optional — defaults to request.user)
       - receiver_email: email when destination is 'external'
       - currency_to: target currency code (e.g., 'KES', 'USD')
+      - quote_id: optional quote from /convert-preview/ to settle at the previewed rate
       - otp: optional otp for large transfers
 
     This view supports these flows:
@@ -306,6 +510,7 @@ class TransactionFlowView(APIView):
 
     permission_classes = [permissions.IsAuthenticated]
 
+    @idempotent
     def post(self, request):
         try:
             amount = Decimal(request.data.get('amount', '0'))
@@ -317,6 +522,7 @@ class TransactionFlowView(APIView):
             currency_to = request.data.get('currency_to')
             otp = request.data.get('otp')
             pin = request.data.get('pin')
+            quote_id = request.data.get('quote_id')
 
             if amount <= 0:
                 return Response({'error': 'Positive amount is required.'}, status=400)
@@ -353,18 +559,14 @@ class TransactionFlowView(APIView):
                 if amount >= LARGE_TRANSFER_THRESHOLD and not otp:
                     return Response({'error': 'OTP required for large transfers.'}, status=400)
 
-                with transaction.atomic():
-                    if sender_wallet.currency == recv_wallet.currency:
-                        rate = Decimal('1.00')
-                        converted_amount = amount
-                    else:
-                        converted_amount, rate = convert_currency(amount, sender_wallet.currency, recv_wallet.currency)
-
-                    sender_wallet.balance -= amount
-                    sender_wallet.save()
+                converted_amount, rate, fx_version, quote = _price_transfer(
+                    request.user, quote_id, amount, sender_wallet.currency, recv_wallet.currency)
 
-                    recv_wallet.balance += converted_amount
-                    recv_wallet.save()
+                with transaction.atomic():
+                    if quote:
+                        fx.consume_quote(quote)
+                    ledger.transfer(sender_wallet, recv_wallet, amount, converted_amount,
+                                    description=f'Transfer {request.user.email} -> {recv_user.email}')
 
                     Transaction.objects.create(
                         wallet=sender_wallet,
@@ -374,6 +576,7 @@ class TransactionFlowView(APIView):
                         currency_to=recv_wallet.currency,
                         converted_amount=converted_amount,
                         exchange_rate=rate,
+                        fx_rate_version=fx_version,
                         counterparty=recv_user.email,
                         status='SUCCESS',
                         description=f'Sent to {recv_user.email}'
@@ -387,12 +590,13 @@ class TransactionFlowView(APIView):
                         currency_to=recv_wallet.currency,
                         converted_amount=converted_amount,
                         exchange_rate=rate,
+                        fx_rate_version=fx_version,
                         counterparty=request.user.email,
                         status='SUCCESS',
                         description=f'Received from {request.user.email}'
                     )
 
-                return Response({'message': 'Transfer successful', 'sender_balance': str(sender_wallet.balance)}, status=200)
+                return Response({'message': 'Transfer successful', 'sender_balance': str(ledger.refresh_balance(sender_wallet))}, status=200)
 
             # wallet -> external (withdraw/send out)
             if source == 'wallet' and destination == 'external':
@@ -404,15 +608,13 @@ class TransactionFlowView(APIView):
                 if wallet.balance < amount:
                     return Response({'error': 'Insufficient balance.'}, status=400)
 
-                with transaction.atomic():
-                    if wallet.currency == currency_to:
-                        converted_amount = amount
-                        rate = Decimal('1.00')
-                    else:
-                        converted_amount, rate = convert_currency(amount, wallet.currency, currency_to)
+                converted_amount, rate, fx_version, quote = _price_transfer(
+                    request.user, quote_id, amount, wallet.currency, currency_to or wallet.currency)
 
-                    wallet.balance -= amount
-                    wallet.save()
+                with transaction.atomic():
+                    if quote:
+                        fx.consume_quote(quote)
+                    ledger.debit(wallet, amount, description=f'Withdrawal to {receiver_email}')
 
                     Transaction.objects.create(
                         wallet=wallet,
@@ -422,17 +624,18 @@ class TransactionFlowView(APIView):
                         currency_to=currency_to,
                         converted_amount=converted_amount,
                         exchange_rate=rate,
+                        fx_rate_version=fx_version,
                         counterparty=receiver_email,
                         status='PENDING',
                         description=f'Withdrawal to {receiver_email}'
                     )
 
-                    return Response({
-                        'message': 'Withdrawal initiated',
-                        'new_balance': str(wallet.balance),
-                        'converted_amount': str(converted_amount),
-                        'rate': str(rate)
-                    }, status=200)
+                return Response({
+                    'message': 'Withdrawal initiated',
+                    'new_balance': str(ledger.refresh_balance(wallet)),
+                    'converted_amount': str(converted_amount),
+                    'rate': str(rate)
+                }, status=200)
 
             # external -> wallet (deposit from external source)
             if source == 'external' and destination == 'wallet':
@@ -450,15 +653,13 @@ class TransactionFlowView(APIView):
 
                 recv_wallet, _ = Wallet.objects.get_or_create(user=recipient_user)
 
-                with transaction.atomic():
-                    if recv_wallet.currency == currency_to or not currency_to:
-                        converted_amount = amount
-                        rate = Decimal('1.00')
-                    else:
-                        converted_amount, rate = convert_currency(amount, currency_to, recv_wallet.currency)
+                converted_amount, rate, fx_version, quote = _price_transfer(
+                    request.user, quote_id, amount, currency_to or recv_wallet.currency, recv_wallet.currency)
 
-                    recv_wallet.balance += converted_amount
-                    recv_wallet.save()
+                with transaction.atomic():
+                    if quote:
+                        fx.consume_quote(quote)
+                    ledger.credit(recv_wallet, converted_amount, description='Deposit from external source')
 
                     Transaction.objects.create(
                         wallet=recv_wallet,
@@ -468,22 +669,76 @@ class TransactionFlowView(APIView):
                         currency_to=recv_wallet.currency,
                         converted_amount=converted_amount,
                         exchange_rate=rate,
+                        fx_rate_version=fx_version,
                         counterparty='external',
                         status='SUCCESS',
                         description=f'Deposit from external source'
                     )
 
-                return Response({'message': 'Deposit successful', 'new_balance': str(recv_wallet.balance)}, status=200)
+                return Response({'message': 'Deposit successful', 'new_balance': str(ledger.refresh_balance(recv_wallet))}, status=200)
 
             return Response({'error': 'Unsupported source/destination combination.'}, status=400)
 
+        except InsufficientFunds:
+            return Response({'error': 'Insufficient balance.'}, status=400)
+        except fx.QuoteError as e:
+            return Response({'error': str(e)}, status=400)
+        except fx.RatesUnavailable as e:
+            return Response({'error': str(e)}, status=503)
         except Exception as e:
             return Response({'error': str(e)}, status=500)
 
 
+# ---------------- BULK TRANSFER ----------------
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@idempotent
+def bulk_transfer(request):
+    """Pay many wallets from the caller's wallet in one commit.
+
+    Expected JSON:
+      { "pin": "123456", "description": "October payroll" (optional), "otp": optional,
+        "transfers": [ {"recipient": "alice@example.com", "amount": "1500"}, ... ] }
+
+    Returns a per-line report. Lines that fail validation are reported and
+    skipped; the rest succeed or fail together.
+    """
+    pin = request.data.get('pin')
+    otp = request.data.get('otp')
+    transfers = request.data.get('transfers')
+    description = request.data.get('description') or 'Bulk disbursement'
+
+    if not pin:
+        return Response({'error': 'PIN is required for transfers.'}, status=400)
+    if not request.user.check_pin(pin):
+        return Response({'error': 'Invalid PIN.'}, status=401)
+    if not isinstance(transfers, list):
+        return Response({'error': "'transfers' must be a list."}, status=400)
+
+    requested_total = sum(
+        (parse_amount(t.get('amount')) or Decimal('0') for t in transfers if isinstance(t, dict)),
+        Decimal('0'),
+    )
+    if requested_total >= LARGE_TRANSFER_THRESHOLD and not otp:
+        return Response({'error': 'OTP required for large transfers.'}, status=400)
+
+    try:
+        results, sender_wallet = disburse(request.user, transfers, description=description)
+    except DisbursementError as e:
+        return Response({'error': str(e)}, status=400)
+
+    succeeded = sum(1 for r in results if r['status'] == 'success')
+    return Response({
+        'message': f'{succeeded} of {len(results)} transfers succeeded',
+        'sender_balance': str(ledger.refresh_balance(sender_wallet)),
+        'results': results,
+    }, status=200)
+
+
 # ---------------- M-PESA STK PUSH ----------------
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent
 def initiate_stk(request):
     phone = request.data.get("phone")
     amount = request.data.get("amount")
@@ -498,8 +753,12 @@ def initiate_stk(request):
     if not phone or not amount:
         return Response({"error": "Phone and amount required"}, status=400)
 
+    phone = normalize_msisdn(phone)
+    if not phone:
+        return Response({"error": "Invalid phone number"}, status=400)
+
     from .mpesa import stk_push
-    res = stk_push(phone, amount)
+    res = stk_push(mpesa_msisdn(phone), amount)
 
     # Debug/trace: log full STK response so we can see what's returned by Safaricom
     try:
@@ -512,66 +771,9 @@ def initiate_stk(request):
     if isinstance(res, dict) and res.get("error"):
         return Response(res, status=500)
 
-    # If STK push looks successful, create a pending WalletTransaction that the
-    # callback can later match using CheckoutRequestID or MerchantRequestID.
-    try:
-        ref = res.get('CheckoutRequestID') or res.get('MerchantRequestID')
-        response_code = res.get('ResponseCode')
-
-        # When sandbox returns success (accepted for processing), persist a
-        # MpesaSTKRequest (so callback can map back to the user) and create a
-        # pending WalletTransaction as a fallback (if not already created).
-        if response_code == '0' and ref:
-            print("✔ STK push looks successful")
-            try:
-                # Create or get the STK request mapping
-                amount_dec = None
-                try:
-                    amount_dec = Decimal(str(amount))
-                except Exception:
-                    pass
-
-                MpesaSTKRequest.objects.get_or_create(
-                    checkout_request_id=ref,
-                    defaults={
-                        'user': request.user,
-                        'amount': amount_dec or Decimal('0.00'),
-                        'phone': phone,
-                    }
-                )
-                print("✔ Saved STK request record for callback mapping")
-
-                # Ensure we have a pending WalletTransaction tied to the reference
-                tx_ref = ref
-                if not WalletTransaction.objects.filter(reference=tx_ref).exists():
-                    WalletTransaction.objects.create(
-                        user=request.user,
-                        phone=phone,
-                        amount=amount_dec or Decimal('0.00'),
-                        type='deposit',
-                        status='pending',
-                        reference=tx_ref
-                    )
-                # Create a pending Transaction record so the deposit appears in history
-                try:
-                    wallet_obj, _ = Wallet.objects.get_or_create(user=request.user)
-                    if not Transaction.objects.filter(wallet=wallet_obj, description__icontains=str(tx_ref)).exists():
-                        Transaction.objects.create(
-                            wallet=wallet_obj,
-                            transaction_type='DEPOSIT',
-                            amount=amount_dec or Decimal('0.00'),
-                            currency_from='KES',
-                            currency_to=getattr(wallet_obj, 'currency', 'KES'),
-                            converted_amount=amount_dec or Decimal('0.00'),
-                            status='PENDING',
-                            description=f'M-Pesa deposit reference {tx_ref} initiated'
-                        )
-                except Exception:
-                    logger.exception('Failed to create pending Transaction record for STK ref=%s', tx_ref)
-            except Exception as e:
-                logger.exception('Failed to save STK request or pending transaction: %s', e)
-    except Exception:
-        logger.exception('Failed to process STK push response for pending transaction creation')
+    # If STK push looks successful, record it so the callback can match it
+    # using CheckoutRequestID or MerchantRequestID.
+    payments.record_stk_push(request.user, phone, amount, res)
 
     return Response(res)
 
@@ -581,256 +783,10 @@ def initiate_stk(request):
 @csrf_exempt
 @permission_classes([AllowAny])
 def mpesa_callback(request):
-    data = request.data
-
-    # Log raw callback body for debugging
-    try:
-        logger.info("Raw STK callback payload: %s", data)
-        print("[STK CALLBACK RAW]:", data)
-    except Exception:
-        pass
-
-    try:
-        result = data.get("Body", {}).get("stkCallback", {})
-        result_code = result.get("ResultCode")
-
-        # Try to find a stable reference id
-        reference = result.get("CheckoutRequestID") or result.get("MerchantRequestID")
-        user = None
-        if reference:
-            try:
-                req = MpesaSTKRequest.objects.get(checkout_request_id=reference)
-                user = req.user
-                print("✔ Matched user using MpesaSTKRequest:", user)
-            except MpesaSTKRequest.DoesNotExist:
-                pass
-
-        # Callback metadata may be missing in failure cases
-        callback_meta = result.get("CallbackMetadata", {}).get("Item", [])
-
-        # Helper to extract item by Name or fallback to indices
-        def _get_item_value(items, name=None, idx=None):
-            try:
-                if name:
-                    for it in items:
-                        if isinstance(it, dict) and it.get("Name") == name:
-                            return it.get("Value")
-                if idx is not None and idx < len(items):
-                    it = items[idx]
-                    return it.get("Value") if isinstance(it, dict) else None
-            except Exception:
-                return None
-            return None
-
-        amount = (
-    _get_item_value(callback_meta, name="Amount") or
-    _get_item_value(callback_meta, name="TransAmount") or
-    _get_item_value(callback_meta, name="amount") or
-    _get_item_value(callback_meta, idx=0)
-)
-        phone = _get_item_value(callback_meta, name="PhoneNumber", idx=4)
-        # try MpesaReceiptNumber too for better reference
-        mpesa_receipt = _get_item_value(callback_meta, name="MpesaReceiptNumber", idx=1)
-        if not reference:
-            reference = mpesa_receipt
-
-        # Cast amount safely
-        try:
-            amount_val = Decimal(str(amount)) if amount is not None else None
-        except Exception:
-            amount_val = None
-            print("[CALLBACK] Extracted Amount =", amount_val)
-
-       # ---------- PRIMARY MATCH: WalletTransaction (pending) ----------
-        tx_by_ref = None
-        if reference:
-            try:
-                tx_by_ref = WalletTransaction.objects.filter(
-    reference=reference,
-    status="pending"
-).first()
-                if tx_by_ref:
-                    user = tx_by_ref.user
-                    try:
-                        amount_val = tx_by_ref.amount if tx_by_ref.amount is not None else amount_val
-                    except Exception:
-                        pass
-                    logger.info("Found pending WalletTransaction by reference %s -> user=%s amount=%s", reference, user, amount_val)
-            except Exception:
-                tx_by_ref = None
-
-        # ---------- SECOND MATCH: MpesaSTKRequest fallback ----------
-        if not user and reference:
-            try:
-                locked_user = MpesaSTKRequest.objects.get(checkout_request_id=reference).user
-                user = locked_user
-                logger.info("Matched user using MpesaSTKRequest fallback")
-            except MpesaSTKRequest.DoesNotExist:
-                pass
-
-        # ---------- THIRD MATCH: Phone number (only if allowed) ----------
-        # IMPORTANT: DO NOT reset user = None here (this was breaking everything)
-        if not user and phone:
-            try:
-                phone_str = str(phone).strip()
-            except Exception:
-                phone_str = None
-
-            if phone_str:
-                digits = ''.join(ch for ch in phone_str if ch.isdigit())
-            else:
-                digits = None
-
-            lookup_candidates = set()
-            if digits:
-                lookup_candidates.add(digits)
-                lookup_candidates.add(digits.lstrip('+'))
-
-                if digits.startswith('0') and not digits.startswith('254'):
-                    lookup_candidates.add('254' + digits.lstrip('0'))
-
-                if digits.startswith('254'):
-                    lookup_candidates.add('0' + digits[3:])
-
-                last9 = digits[-9:]
-                lookup_candidates.add(last9)
-
-            logger.info("STK callback phone normalization: raw=%s digits=%s candidates=%s",
-                        phone, digits, lookup_candidates)
-
-            from .models import CustomUser
-            for p in list(lookup_candidates):
-                try:
-                    if not p:
-                        continue
-                    found = CustomUser.objects.filter(mobile=p).first()
-                    if found:
-                        user = found
-                        logger.info("Matched user by mobile exact: %s -> %s", p, user)
-                        break
-                except Exception:
-                    pass
-
-            if not user and digits:
-                try:
-                    last9 = digits[-9:]
-                    found = CustomUser.objects.filter(mobile__endswith=last9).first()
-                    if found:
-                        user = found
-                        logger.info("Matched user by mobile endswith last9: %s -> %s", last9, user)
-                except Exception:
-                    pass
-
-        # ---------- FINAL PROTECTION ----------
-        if not user:
-            logger.error(f"Callback arrived but NO USER matched. REF={reference}")
-            return Response({"Result": "Callback received (no user matched)"})
-
-        # ---------- PROCESS SUCCESS ----------
-        if result_code == 0 and amount_val is not None:
-            try:
-                # Ensure wallet + transaction are updated atomically so the UI can rely
-                # on a consistent state when polling status endpoints.
-                with transaction.atomic():
-                    wallet, _ = Wallet.objects.get_or_create(user=user)
-                    wallet.balance += Decimal(amount_val)
-                    wallet.save()
-
-                    if tx_by_ref:
-                        tx_by_ref.status = 'success'
-                        tx_by_ref.amount = amount_val if (tx_by_ref.amount is None) else tx_by_ref.amount
-                        tx_by_ref.phone = phone or tx_by_ref.phone
-                        tx_by_ref.save()
-                        logger.info('Updated existing WalletTransaction %s -> success', tx_by_ref.reference)
-                    else:
-                        ref = reference or str(uuid.uuid4())
-                        WalletTransaction.objects.create(
-                            user=user,
-                            phone=phone,
-                            amount=amount_val,
-                            type="deposit",
-                            status="success",
-                            reference=ref
-                        )
-
-                # Record Transaction history (avoid duplicate entries for the same MPESA ref)
-                try:
-                    wallet_obj, _ = Wallet.objects.get_or_create(user=user)
-                    t = Transaction.objects.filter(
-                        wallet=wallet_obj,
-                        description__icontains=str(reference)
-                    ).order_by('-id').first()
-                    if t:
-                        t.status = 'SUCCESS'
-                        t.amount = Decimal(amount_val)
-                        t.converted_amount = Decimal(amount_val)
-                        t.save()
-                    else:
-                        Transaction.objects.create(
-                            wallet=wallet_obj,
-                            transaction_type='DEPOSIT',
-                            amount=Decimal(amount_val),
-                            currency_from='KES',
-                            currency_to=getattr(wallet_obj, 'currency', 'KES'),
-                            converted_amount=Decimal(amount_val),
-                            status='SUCCESS',
-                            description=f'M-Pesa deposit reference {reference} receipt {mpesa_receipt or "n/a"}'
-                        )
-                except Exception:
-                    logger.exception('Failed to create Transaction record for successful MPesa deposit ref=%s', reference)
-
-                logger.info(f"Credited {amount_val} to {user}. Wallet new balance: {wallet.balance}")
-            except Exception as e:
-                logger.exception("Error crediting wallet on STK callback: %s", e)
-
-        else:
-            # ---------- FAILURE HANDLING ----------
-            try:
-                ref = reference or (mpesa_receipt or f"none-{random.randint(100000,999999)}")
-                if tx_by_ref:
-                    tx_by_ref.status = 'failed'
-                    tx_by_ref.amount = amount_val or tx_by_ref.amount or Decimal('0.00')
-                    tx_by_ref.phone = phone or tx_by_ref.phone
-                    tx_by_ref.save()
-                    logger.info('Marked pending WalletTransaction %s as failed', tx_by_ref.reference)
-                else:
-                    WalletTransaction.objects.create(
-                        user=user,
-                        phone=phone,
-                        amount=amount_val or Decimal('0.00'),
-                        type="deposit",
-                        status="failed",
-                        reference=ref
-                    )
-            except Exception as e:
-                logger.exception("Error recording failed STK callback: %s", e)
-
-                # Also record failed deposit attempt in Transaction history
-                try:
-                    w, _ = Wallet.objects.get_or_create(user=user)
-                    t = Transaction.objects.filter(wallet=w, description__icontains=str(reference)).order_by('-id').first()
-                    if t:
-                        t.status = 'FAILED'
-                        t.amount = Decimal(amount_val or 0)
-                        t.converted_amount = Decimal(amount_val or 0)
-                        t.save()
-                    else:
-                        Transaction.objects.create(
-                            wallet=w,
-                            transaction_type='DEPOSIT',
-                            amount=Decimal(amount_val or 0),
-                            currency_from='KES',
-                            currency_to=getattr(w, 'currency', 'KES'),
-                            converted_amount=Decimal(amount_val or 0),
-                            status='FAILED',
-                            description=f'Failed M-Pesa deposit reference {reference} receipt {mpesa_receipt or "n/a"}'
-                        )
-                except Exception:
-                    logger.exception('Failed to create Transaction record for failed MPesa deposit ref=%s', reference)
-
-    except Exception as e:
-        logger.exception("Callback Error: %s", e)
-
+    # Stored as-is and applied by process_inbound_events (see wallet/events.py)
+    # so the ACK goes back before any wallet work.
+    logger.info("Raw STK callback payload: %s", request.data)
+    events.record('MPESA_STK', request.data)
     return Response({"Result": "Callback received"})
 
 
@@ -945,10 +901,10 @@ def get_withdraw_status(request):
 @api_view(["POST"])
 @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
+@idempotent
 def withdraw_from_wallet(request):
     phone = request.data.get("phone")
     amount_str = request.data.get("amount") 
-    amount = int(float(amount_str)) 
     pin = request.data.get("pin")
 
     print("[WITHDRAW] HTTP_AUTHORIZATION:", request.META.get('HTTP_AUTHORIZATION'))
@@ -973,62 +929,33 @@ def withdraw_from_wallet(request):
     if not request.user.check_pin(pin):
         return Response({"error": "Invalid PIN"}, status=401)
 
+    phone = normalize_msisdn(phone)
+    if not phone:
+        return Response({"error": "Invalid phone number"}, status=400)
+
     # Convert amount to Decimal safely
     try:
-        amount = Decimal(amount_str)
-    except:
+        amount = Decimal(str(amount_str))
+    except InvalidOperation:
         return Response({"error": "Invalid amount format"}, status=400)
+    if not amount.is_finite() or amount <= 0:
+        return Response({"error": "Amount must be a positive number"}, status=400)
 
-    wallet = Wallet.objects.get(user=request.user)
-
-    # Compare Decimal -> Decimal
-    if wallet.balance < amount:
+    # The debit and the queued payout commit together; the run_payouts worker
+    # sends it to Safaricom (see wallet/payouts.py).
+    try:
+        wallet, wallet_tx = payouts.enqueue_mpesa_withdrawal(request.user, phone, amount)
+    except InsufficientFunds:
         return Response({"error": "Insufficient balance"}, status=400)
+    except payouts.InvalidPayout as e:
+        return Response({"error": str(e)}, status=400)
 
-    from .mpesa import mpesa_withdraw
-    res = mpesa_withdraw(phone, amount)
-    reference = str(uuid.uuid4())
-
-    if res.get("ResponseCode") == "0":
-        wallet.balance -= amount
-        wallet.save()
-        WalletTransaction.objects.create(
-            user=request.user,
-            type="withdraw",
-            amount=amount,
-            status="pending",   # update via callback
-            reference=reference,
-        )
-        # Create a pending Transaction record so it appears in the user's
-        # transaction history immediately and can be updated by callback.
-        try:
-            Transaction.objects.create(
-                wallet=wallet,
-                transaction_type='WITHDRAWAL',
-                amount=amount,
-                currency_from=getattr(wallet, 'currency', 'KES'),
-                currency_to=getattr(wallet, 'currency', 'KES'),
-                converted_amount=amount,
-                status='PENDING',
-                description=f'M-Pesa withdraw reference {reference} phone {phone}'
-            )
-        except Exception:
-            logger.exception('Failed to create initial Transaction record for withdraw ref=%s', reference)
-    # Return the provider response plus our internal reference so the frontend
-    # can poll for completion (B2C result) and show an immediate confirmation.
-    payload = {
-        'mpesa_response': res,
-        'reference': reference,
-        'wallet_balance': str(wallet.balance),
-    }
-
-    # If the provider returned success right away, include a friendly message
-    if res.get('ResponseCode') == '0':
-        payload['message'] = 'Withdrawal initiated — awaiting provider confirmation.'
-    else:
-        payload['message'] = 'Withdrawal request failed to start.'
-
-    return Response(payload)
+    # Return our internal reference so the frontend can poll for completion.
+    return Response({
+        'reference': wallet_tx.reference,
+        'wallet_balance': str(ledger.refresh_balance(wallet)),
+        'message': 'Withdrawal queued — awaiting provider confirmation.',
+    }, status=202)
 
 
 # ---------------- M-PESA B2C RESULT CALLBACK ----------------
@@ -1041,97 +968,14 @@ def mpesa_b2c_result(request):
     if "Result" not in result:
         return Response({"status": "ACK received"})
     logger.info("RAW B2C CALLBACK: %s", result)
-
-    try:
-        # If this is a preliminary acknowledgement, return 200
-        if "Result" not in result:
-            logger.info("ACK callback received, returning 200.")
-            return Response({"Result": "Acknowledged"})
-
-        result_obj = result.get("Result", {})
-        result_code = result_obj.get("ResultCode", None)
-        params_list = (
-            result_obj.get("ResultParameters", {})
-            .get("ResultParameter", [])
-        )
-
-        # Clean parsing of parameters
-        params = {p.get("Key"): p.get("Value") for p in params_list if isinstance(p, dict)}
-        logger.info("Parsed parameters: %s", params)
-
-        # Extract amount correctly
-        amount = (
-            params.get("TransactionAmount") or
-            params.get("Amount")
-        )
-
-        receipt = params.get("TransactionReceipt")
-        receiver_info = params.get("ReceiverPartyPublicName")
-
-        if not amount:
-            logger.warning("No amount found in B2C callback. Params: %s", params)
-            return Response({"Result": "Acknowledged"})
-
-        try:
-            amount_val = Decimal(str(amount))
-        except Exception:
-            logger.error("Amount is not numeric: %s", amount)
-            return Response({"Result": "Acknowledged"})
-
-        # Extract phone safely
-        phone_val = None
-        if receiver_info:
-            # Format: "254700123456 - John Doe"
-            phone_val = ''.join(ch for ch in receiver_info if ch.isdigit())
-
-        # --------------- MATCH WALLET TRANSACTION ------------------
-        tx = None
-
-        if phone_val:
-            tx = WalletTransaction.objects.filter(
-                type="withdraw",
-                amount=amount_val,
-                phone__endswith=phone_val
-            ).last()
-
-        if not tx and phone_val:
-            tx = WalletTransaction.objects.filter(
-                type="withdraw",
-                phone__endswith=phone_val,
-                status="pending"
-            ).last()
-
-        if not tx:
-            tx = WalletTransaction.objects.filter(
-                type="withdraw",
-                amount=amount_val,
-                status="pending"
-            ).last()
-
-        if not tx:
-            logger.warning("No matching withdrawal for phone=%s amount=%s", phone_val, amount_val)
-            return Response({"Result": "Received"})
-
-        # ---------------- HANDLE SUCCESS / FAILURE ----------------
-        if result_code == 0:
-            tx.status = "success"
-        else:
-            tx.status = "failed"
-            wallet = Wallet.objects.get(user=tx.user)
-            wallet.balance += tx.amount
-            wallet.save()
-
-        tx.save()
-
-    except Exception as e:
-        logger.exception("B2C Callback Fatal Error: %s", e)
-
+    events.record('MPESA_B2C', result)
     return Response({"Result": "Received"})
 
 
 # ---------------- FLUTTERWAVE DEPOSIT INITIATION ----------------
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent
 def flutterwave_deposit(request):
     from .flutterwave import flutterwave_initialize_deposit
 
@@ -1152,14 +996,7 @@ def flutterwave_deposit(request):
 
     data = flw["data"]
 
-    WalletTransaction.objects.create(
-        user=request.user,
-        type="deposit",
-        amount=Decimal(str(amount)),
-        reference=flw["tx_ref"],
-        status="pending",
-
-)
+    payments.record_flutterwave_deposit(request.user, amount, flw["tx_ref"])
 
     return Response({"payment_link": data["link"]})
 
@@ -1199,6 +1036,7 @@ def flutterwave_callback(request):
 @api_view(["POST"])
 @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
+@idempotent
 def flutterwave_withdraw(request):
     """Initiate a Flutterwave bank transfer withdrawal from user's wallet.
 
@@ -1241,83 +1079,30 @@ def flutterwave_withdraw(request):
 
     try:
         amount = Decimal(str(amount_str))
-    except Exception:
+    except InvalidOperation:
         return Response({"error": "Invalid amount"}, status=400)
+    if not amount.is_finite() or amount <= 0:
+        return Response({"error": "Amount must be a positive number"}, status=400)
 
-    wallet = Wallet.objects.get(user=request.user)
-    if wallet.balance < amount:
-        return Response({"error": "Insufficient balance"}, status=400)
+    # Validate required bank details
+    if not account_bank or not account_number:
+        return Response({"error": "account_bank and account_number are required"}, status=400)
+    if not banks.is_known_bank(account_bank):
+        return Response({"error": f"Unknown bank code {account_bank}"}, status=400)
 
-    # Try to create beneficiary (optional) then initiate transfer
+    # The debit and the queued transfer commit together; the run_payouts
+    # worker sends it to Flutterwave (see wallet/payouts.py).
     try:
-        # Validate required bank details
-        if not account_bank or not account_number:
-            return Response({"error": "account_bank and account_number are required"}, status=400)
-
-        # Development fallback: when DEBUG=True, allow mocking transfers locally
-        # This avoids Flutterwave's IP-whitelisting requirement during local testing.
-        from django.conf import settings as _settings
-        if getattr(_settings, 'DEBUG', False) and os.getenv('FLW_MOCK_TRANSFERS', '1') == '1':
-            reference = str(uuid.uuid4())
-            provider_res = {
-                'status': 'success',
-                'data': {'id': 'mock', 'reference': reference},
-                'reference': reference
-            }
-            logger.info('[FLW WITHDRAW] Using MOCK provider_res (DEBUG) payload')
-        else:
-            # We can either create a beneficiary or transfer directly using bank details
-            provider_res = initiate_transfer(
-                amount=amount,
-                account_bank=account_bank,
-                account_number=account_number,
-                narration=f"Wallet withdrawal for user {request.user.id}"
-            )
-    except Exception as e:
-        logger.exception("Flutterwave transfer initiation failed: %s", e)
-        # Return provider error details in DEBUG mode to help debugging locally
-        from django.conf import settings as _settings
-        if getattr(_settings, 'DEBUG', False):
-            return Response({"error": "Failed to initiate transfer", "details": str(e)}, status=500)
-        return Response({"error": "Failed to initiate transfer"}, status=500)
-
-    # Use provider reference if available, otherwise create our own
-    reference = provider_res.get('reference') or provider_res.get('data', {}).get('reference') or str(uuid.uuid4())
-
-    # Deduct balance and create pending records
-    try:
-        with transaction.atomic():
-            wallet.balance -= amount
-            wallet.save()
-
-            WalletTransaction.objects.create(
-                user=request.user,
-                phone=account_number,
-                amount=amount,
-                type='withdraw',
-                status='pending',
-                reference=reference
-            )
-
-            Transaction.objects.create(
-                wallet=wallet,
-                transaction_type='WITHDRAWAL',
-                amount=amount,
-                currency_from=getattr(wallet, 'currency', 'KES'),
-                currency_to=getattr(wallet, 'currency', 'KES'),
-                converted_amount=amount,
-                status='PENDING',
-                description=f'Flutterwave withdraw reference {reference} to {account_number}'
-            )
-    except Exception as e:
-        logger.exception('Failed to create pending withdraw records: %s', e)
-        return Response({"error": "Server error creating withdrawal record"}, status=500)
+        wallet, wallet_tx = payouts.enqueue_flutterwave_withdrawal(
+            request.user, amount, account_bank, account_number,
+            narration=f"Wallet withdrawal for user {request.user.id}",
+        )
+    except InsufficientFunds:
+        return Response({"error": "Insufficient balance"}, status=400)
 
-    payload = {
-        'flutterwave_response': provider_res,
-        'reference': reference,
-        'wallet_balance': str(wallet.balance),
-        'message': 'Withdrawal initiated — awaiting provider confirmation.'
-    }
+    return Response({
+        'reference': wallet_tx.reference,
+        'wallet_balance': str(ledger.refresh_balance(wallet)),
+        'message': 'Withdrawal queued — awaiting provider confirmation.',
+    }, status=202)
 
-    return Response(payload)
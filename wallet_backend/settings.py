@@ -15,6 +15,7 @@ import os
 from dotenv import load_dotenv
 from urllib.parse import urlparse, parse_qsl
 from datetime import timedelta
+from corsheaders.defaults import default_headers
 
 load_dotenv()
 
@@ -119,12 +120,23 @@ AUTHENTICATION_BACKENDS = [
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # for dev, prints in console
 DEFAULT_FROM_EMAIL = 'noreply@walletapp.com'
 
-# Cache (for OTP)
-CACHES = {
-    'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+# Cache (for OTP, FX rates, provider tokens and circuit breakers)
+# LocMemCache is per process: web workers and management commands do not see each
+# other's entries, and readers fall back to the database. Set REDIS_URL (needs the
+# redis package) to share one cache between them.
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
     }
-}
 
 
 MIDDLEWARE = [
@@ -144,6 +156,11 @@ ROOT_URLCONF = 'wallet_backend.urls'
 AUTH_USER_MODEL = 'wallet.CustomUser'
 
 CORS_ALLOW_ALL_ORIGINS = True  # for testing only
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key")
+
+# Idempotency-Key replay window and how long a duplicate waits for the original (seconds)
+IDEMPOTENCY_KEY_TTL = int(os.getenv("IDEMPOTENCY_KEY_TTL", 24 * 60 * 60))
+IDEMPOTENCY_WAIT_TIMEOUT = int(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", 10))
 
 TEMPLATES = [
     {